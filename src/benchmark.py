@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List
+
+import hydra
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+from tqdm import tqdm
+
+from src.data.utils import get_file_list
+from src.models.edema_net import EdemaNet
+from src.models.stage_timer import StageTimer
+from src.predict import build_edema_net
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def run_benchmark(
+    edema_net: EdemaNet,
+    img_paths: List[str],
+    save_dir: str,
+    num_warmup: int = 2,
+    num_iterations: int = 10,
+) -> Dict[str, List[float]]:
+    """Run the pipeline over a fixed set of images and record the duration of each stage.
+
+    Args:
+        edema_net: an initialized network
+        img_paths: list of images processed in every iteration
+        save_dir: directory where the intermediate outputs of the network are saved
+        num_warmup: number of iterations excluded from the measurements (model loading, CUDA init)
+        num_iterations: number of measured iterations
+    Returns:
+        samples: a dictionary mapping stage names to per-image durations in seconds
+    """
+    samples: Dict[str, List[float]] = {}
+    for iteration in tqdm(range(num_warmup + num_iterations), desc='Benchmark', unit='iteration'):
+        for img_path in img_paths:
+            timer = StageTimer()
+            edema_net.predict(
+                img_path=img_path,
+                save_dir=save_dir,
+                timer=timer,
+            )
+
+            if iteration < num_warmup:
+                continue
+            for stage, duration in timer.durations.items():
+                samples.setdefault(stage, []).append(duration)
+
+    return samples
+
+
+def summarize_samples(
+    samples: Dict[str, List[float]],
+) -> Dict[str, Dict[str, float]]:
+    """Compute latency percentiles and throughput of each stage.
+
+    Args:
+        samples: a dictionary mapping stage names to per-image durations in seconds
+    Returns:
+        report: a dictionary mapping stage names to their statistics
+    """
+    report = {}
+    for stage, durations in samples.items():
+        durations_ms = np.asarray(durations) * 1000
+        p50, p95, p99 = np.percentile(durations_ms, [50, 95, 99])
+        mean = float(durations_ms.mean())
+        report[stage] = {
+            'p50_ms': round(float(p50), 3),
+            'p95_ms': round(float(p95), 3),
+            'p99_ms': round(float(p99), 3),
+            'mean_ms': round(mean, 3),
+            'images_per_sec': round(1000 / mean, 3) if mean > 0 else float('inf'),
+            'num_samples': len(durations_ms),
+        }
+
+    return report
+
+
+def compare_with_baseline(
+    report: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float = 0.1,
+    metric: str = 'p50_ms',
+) -> List[str]:
+    """Find the stages whose latency exceeds the baseline by more than the tolerance.
+
+    Args:
+        report: statistics of the current run
+        baseline: statistics of the reference run
+        tolerance: allowed relative slowdown (0.1 = 10%)
+        metric: statistic used for comparison
+    Returns:
+        regressions: names of the stages that became slower
+    """
+    regressions = []
+    for stage, stats in report.items():
+        if stage not in baseline:
+            log.info(f'Stage {stage} is missing in the baseline')
+            continue
+        reference = baseline[stage][metric]
+        change = (stats[metric] - reference) / reference if reference > 0 else 0.0
+        log.info(f'{stage:<40} {reference:>10.2f} -> {stats[metric]:>10.2f} ms ({change:+.1%})')
+        if change > tolerance:
+            regressions.append(stage)
+
+    return regressions
+
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='benchmark',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+
+    # Use a fixed, sorted subset of images so that runs are comparable
+    img_paths = sorted(
+        get_file_list(
+            src_dirs=cfg.data_dir,
+            ext_list=[
+                '.png',
+                '.jpg',
+                '.jpeg',
+                '.bmp',
+            ],
+        ),
+    )
+    img_paths = img_paths[: cfg.num_images]
+    log.info(f'Number of images..........: {len(img_paths)}')
+
+    edema_net = build_edema_net(cfg)
+    samples = run_benchmark(
+        edema_net=edema_net,
+        img_paths=img_paths,
+        save_dir=cfg.save_dir,
+        num_warmup=cfg.num_warmup,
+        num_iterations=cfg.num_iterations,
+    )
+    report = summarize_samples(samples)
+    for stage, stats in report.items():
+        log.info(f'{stage:<40} {stats}')
+
+    os.makedirs(Path(cfg.report_path).parent, exist_ok=True)
+    with open(cfg.report_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    log.info(f'Report saved to...........: {cfg.report_path}')
+
+    # Compare with the baseline or replace it
+    if cfg.update_baseline or not os.path.isfile(cfg.baseline_path):
+        os.makedirs(Path(cfg.baseline_path).parent, exist_ok=True)
+        with open(cfg.baseline_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        log.info(f'Baseline saved to.........: {cfg.baseline_path}')
+    else:
+        with open(cfg.baseline_path) as file:
+            baseline = json.load(file)
+        regressions = compare_with_baseline(
+            report=report,
+            baseline=baseline,
+            tolerance=cfg.tolerance,
+        )
+        if regressions:
+            msg = f'Stages slower than the baseline by more than {cfg.tolerance:.0%}: {regressions}'
+            if cfg.fail_on_regression:
+                raise RuntimeError(msg)
+            log.warning(msg)
+
+    log.info('Complete')
+
+
+if __name__ == '__main__':
+    main()
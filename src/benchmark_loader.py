@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import hydra
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from src.data.data_classes import EdemaDataModule
+from src.data.data_classes_utils import split_batch
+from src.data.utils_augmentation import BatchAugmentation
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def run_loader_benchmark(
+    dataloader: DataLoader,
+    device: str = 'cpu',
+    step_time: float = 0.0,
+    num_warmup: int = 5,
+    num_batches: int = 100,
+    augmentation: Optional[BatchAugmentation] = None,
+) -> Dict[str, List[float]]:
+    """Iterate over a data loader the way a trainer does and record where the time goes.
+
+    A trainer step is emulated with a sleep of step_time, so the workers keep loading batches
+    while the step runs, as they do while a GPU computes. The loader is restarted when an epoch
+    ends, so the cost of starting workers is measured as well.
+
+    Args:
+        dataloader: loader of EdemaDataModule
+        device: device the batches are moved to
+        step_time: duration of an emulated trainer step in seconds, 0 measures the loader alone
+        num_warmup: number of batches excluded from the measurements (worker startup)
+        num_batches: number of measured batches
+        augmentation: batch augmentation applied on the device as EdemaDataModule does in training
+    Returns:
+        samples: durations in seconds of waiting for a batch ('wait'), moving it to the device
+            ('transfer'), augmenting it ('augment') and the whole iteration ('total'), and the
+            batch sizes ('batch_size')
+    """
+    samples: Dict[str, List[float]] = {
+        'wait': [],
+        'transfer': [],
+        'augment': [],
+        'total': [],
+        'batch_size': [],
+    }
+    iterator = iter(dataloader)
+    for batch_idx in tqdm(
+        range(num_warmup + num_batches),
+        desc='Loader benchmark',
+        unit=' batches',
+    ):
+        start = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            iterator = iter(dataloader)
+            batch = next(iterator)
+        loaded = time.perf_counter()
+
+        images, masks, labels = split_batch(batch, device=device)
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        transferred = time.perf_counter()
+
+        if augmentation is not None:
+            images, masks = augmentation(images, masks, mask_fill=labels[:, 1:].any(dim=1))
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+        augmented = time.perf_counter()
+
+        if step_time > 0:
+            time.sleep(step_time)
+        end = time.perf_counter()
+
+        if batch_idx < num_warmup:
+            continue
+        samples['wait'].append(loaded - start)
+        samples['transfer'].append(transferred - loaded)
+        samples['augment'].append(augmented - transferred)
+        samples['total'].append(end - start)
+        samples['batch_size'].append(len(images))
+
+    return samples
+
+
+def summarize_loader_samples(
+    samples: Dict[str, List[float]],
+    idle_threshold: float = 0.1,
+) -> Dict[str, Any]:
+    """Compute the throughput of a loader and the share of time the trainer waits for data.
+
+    Args:
+        samples: output of run_loader_benchmark
+        idle_threshold: share of waiting time above which the trainer is considered input-bound
+    Returns:
+        report: statistics of the run
+    """
+    wait_ms = np.asarray(samples['wait']) * 1000
+    total_time = float(np.sum(samples['total']))
+    num_samples = int(np.sum(samples['batch_size']))
+    wait_p50, wait_p95 = np.percentile(wait_ms, [50, 95])
+    idle_share = float(np.sum(samples['wait'])) / total_time if total_time > 0 else 0.0
+
+    return {
+        'samples_per_sec': round(num_samples / total_time, 3) if total_time > 0 else float('inf'),
+        'batches_per_sec': round(len(wait_ms) / total_time, 3) if total_time > 0 else float('inf'),
+        'wait_p50_ms': round(float(wait_p50), 3),
+        'wait_p95_ms': round(float(wait_p95), 3),
+        'transfer_mean_ms': round(float(np.mean(samples['transfer'])) * 1000, 3),
+        'augment_mean_ms': round(float(np.mean(samples['augment'])) * 1000, 3),
+        'idle_share': round(idle_share, 4),
+        'input_bound': idle_share > idle_threshold,
+        'num_samples': num_samples,
+    }
+
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='benchmark_loader',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+
+    device = cfg.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    log.info(f'Device....................: {device}')
+    log.info(f'Emulated step time, s.....: {cfg.step_time}')
+
+    datamodule = EdemaDataModule(
+        data_dir=cfg.data_dir,
+        batch_size=cfg.batch_size,
+        resize=tuple(cfg.img_size),
+        cache_dir=cfg.cache_dir,
+        **cfg.loader,
+    )
+    datamodule.setup('fit')
+    samples = run_loader_benchmark(
+        dataloader=datamodule.train_dataloader(),
+        device=device,
+        step_time=cfg.step_time,
+        num_warmup=cfg.num_warmup,
+        num_batches=cfg.num_batches,
+        augmentation=datamodule.augmentation,
+    )
+    report = summarize_loader_samples(samples, idle_threshold=cfg.idle_threshold)
+    report.update({'device': device, 'step_time': cfg.step_time, **cfg.loader})
+    for key, value in report.items():
+        log.info(f'{key:<26}: {value}')
+    if report['input_bound']:
+        log.warning(
+            f'The trainer waits for data {report["idle_share"]:.0%} of the time, '
+            'consider more workers, a larger prefetch_factor or the dataset cache',
+        )
+
+    os.makedirs(Path(cfg.report_path).parent, exist_ok=True)
+    with open(cfg.report_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    log.info(f'Report saved to...........: {cfg.report_path}')
+
+    log.info('Complete')
+
+
+if __name__ == '__main__':
+    main()
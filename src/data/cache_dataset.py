@@ -0,0 +1,56 @@
+import logging
+import os
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from src.data.utils_cache import build_dataset_cache, get_cache_dir
+from src.data.utils_metadata import METADATA_NAME, read_metadata
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='cache_dataset',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+    """Precompute the training data of EdemaDataset at a fixed size.
+
+    Args:
+        data_dir: directory with the intermediate dataset and its metadata
+        cache_dir: directory where caches are saved
+        img_size: target size (width, height) of the cached data
+        linelike_finding_width: width in pixels of the line-like findings
+        num_workers: number of processes, -1 uses all cores
+        chunk_size: number of images processed by a worker per task
+    Returns:
+        None
+    """
+    img_size = tuple(cfg.img_size)
+    cache_dir = get_cache_dir(cfg.cache_dir, img_size)
+    log.info(f'Data directory............: {cfg.data_dir}')
+    log.info(f'Image size................: {img_size}')
+    log.info(f'Cache directory...........: {cache_dir}')
+
+    # Use the same images as EdemaDataModule
+    metadata_df = read_metadata(os.path.join(cfg.data_dir, METADATA_NAME))
+    metadata_df = metadata_df[metadata_df['View'] == 'Frontal']
+
+    build_dataset_cache(
+        metadata_df=metadata_df,
+        cache_dir=cache_dir,
+        target_size=img_size,
+        linelike_finding_width=cfg.linelike_finding_width,
+        num_workers=cfg.num_workers,
+        chunk_size=cfg.chunk_size,
+    )
+
+    log.info('Complete')
+
+
+if __name__ == '__main__':
+    main()
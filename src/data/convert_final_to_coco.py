@@ -1,15 +1,19 @@
 import json
 import logging
 import os
-from typing import List
+from typing import List, Optional
 
 import hydra
 import pandas as pd
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
+import src.data.utils as utils
+import src.data.utils_coco as utils_coco
 from src.data.utils import copy_files
 from src.data.utils_coco import get_ann_info, get_img_info
+from src.data.utils_manifest import MANIFEST_NAME, StageManifest
+from src.data.utils_metadata import METADATA_NAME, read_metadata, write_metadata
 from src.data.utils_sly import FEATURE_MAP
 
 log = logging.getLogger(__name__)
@@ -28,8 +32,7 @@ def process_metadata(
     Returns:
         meta: data frame derived from a meta file
     """
-    df = pd.read_excel(os.path.join(dataset_dir, 'metadata.xlsx'))
-    df.drop('ID', axis=1, inplace=True)
+    df = read_metadata(os.path.join(dataset_dir, METADATA_NAME))
     df = df[~df['Feature'].isin(exclude_features)]
     df = df.dropna(subset=['Class ID'])
 
@@ -39,15 +42,34 @@ def process_metadata(
 def prepare_coco(
     df: pd.DataFrame,
     save_dir: str,
+    manifest: Optional[StageManifest] = None,
+    materialize_mode: str = 'copy',
 ) -> pd.DataFrame:
     """Prepare and save training and test subsets in COCO format.
 
     Args:
         df: data frame containing information about the training and test subsets
         save_dir: directory where split datasets are stored
+        manifest: manifest of the copied images used to skip unchanged ones
+        materialize_mode: hardlink, symlink, reflink or copy, falls back to copy if not supported
     Returns:
         df: COCO data frame with training and test subsets
     """
+    if manifest is None:
+        manifest = StageManifest(
+            manifest_path=os.path.join(save_dir, MANIFEST_NAME),
+            config=None,
+            enabled=False,
+        )
+
+    # Images are identified by their destination, so those moved to another subset are removed
+    df_imgs = df.drop_duplicates(subset=['Split', 'Image path'])
+    dst_paths = {
+        os.path.join(save_dir, split, 'data', os.path.basename(img_path)): img_path
+        for split, img_path in zip(df_imgs['Split'], df_imgs['Image path'])
+    }
+    manifest.remove_deleted_items(list(dst_paths))
+
     categories_coco = []
     class_names = list(df['Feature'].unique())
     filtered_feature_map = {key: value for key, value in FEATURE_MAP.items() if key in class_names}
@@ -90,14 +112,28 @@ def prepare_coco(
             'categories': categories_coco,
         }
 
-        # Save a JSON file with annotations
+        # Copy new or changed images and save a JSON file with annotations
         save_img_dir = os.path.join(save_dir, subset, 'data')
-        files_to_copy = list(df_subset['Image path'].unique())
-        copy_files(file_list=files_to_copy, save_dir=save_img_dir)
+        stale_paths = manifest.get_stale_items(
+            inputs={
+                os.path.join(save_img_dir, os.path.basename(img_path)): [img_path]
+                for img_path in df_subset['Image path'].unique()
+            },
+        )
+        log.info(f'{len(stale_paths)} new or changed image(s) in the {subset} subset')
+        copy_files(
+            file_list=[dst_paths[path] for path in stale_paths],
+            save_dir=save_img_dir,
+            mode=materialize_mode,
+        )
+        for path in stale_paths:
+            manifest.update(key=path, records=[], outputs=[path])
         save_ann_path = os.path.join(save_dir, subset, 'labels.json')
         with open(save_ann_path, 'w') as file:
             json.dump(dataset, file)
 
+    manifest.save()
+
     # Update image paths
     df['Image path'] = df.apply(
         func=lambda row: os.path.join(save_dir, row['Split'], 'data', row['Image name']),
@@ -110,16 +146,13 @@ def prepare_coco(
 def save_subset_metadata(
     df: pd.DataFrame,
     save_dir: str,
+    export_excel: bool = False,
 ) -> None:
     # Save main dataset metadata
-    save_path = os.path.join(save_dir, 'metadata.xlsx')
-    df.reset_index(drop=True, inplace=True)
-    df.index += 1
-    df.to_excel(
-        save_path,
-        sheet_name='Metadata',
-        index=True,
-        index_label='ID',
+    write_metadata(
+        df=df,
+        path=os.path.join(save_dir, METADATA_NAME),
+        export_excel=export_excel,
     )
 
     # Save additional subset metadata
@@ -143,14 +176,11 @@ def save_subset_metadata(
     for subset in subset_list:
         df_subset = df[df['Split'] == subset]
         df_subset = df_subset.drop(labels='Split', axis=1)
-        df_subset.reset_index(drop=True, inplace=True)
-        save_path = os.path.join(save_dir, f'{subset}', 'labels.xlsx')
-        df_subset.index += 1
-        df_subset.to_excel(
-            save_path,
-            sheet_name='Metadata',
-            index=True,
-            index_label='ID',
+        save_path = os.path.join(save_dir, f'{subset}', 'labels.parquet')
+        write_metadata(
+            df=df_subset,
+            path=save_path,
+            export_excel=export_excel,
         )
         log.info(f'{subset.capitalize()} metadata saved.......: {save_path}')
 
@@ -185,11 +215,19 @@ def main(cfg: DictConfig) -> None:
     df = prepare_coco(
         df=df,
         save_dir=cfg.save_dir,
+        manifest=StageManifest(
+            manifest_path=os.path.join(cfg.save_dir, MANIFEST_NAME),
+            config={'materialize_mode': cfg.materialize_mode},
+            sources=[__file__, utils, utils_coco],
+            enabled=cfg.incremental,
+        ),
+        materialize_mode=cfg.materialize_mode,
     )
 
     save_subset_metadata(
         df=df,
         save_dir=cfg.save_dir,
+        export_excel=cfg.export_excel,
     )
 
     log.info('Complete')
@@ -1,18 +1,25 @@
 import logging
 import os
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
+import albumentations as A
 import cv2
 import hydra
 import pandas as pd
+from joblib import Parallel, delayed
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
+import src.data.utils_final as utils_final
+import src.data.utils_metadata as utils_metadata
+import src.data.utils_sly as utils_sly
 from src.data.utils_final import (
     crop_image,
     get_bboxes,
     get_features,
+    get_pad_transform,
+    get_resize_transform,
     modify_box_geometry,
     pad_image,
     resize_image,
@@ -21,104 +28,194 @@ from src.data.utils_final import (
     update_bbox_metadata,
     update_image_metadata,
 )
+from src.data.utils_manifest import MANIFEST_NAME, StageManifest
+from src.data.utils_metadata import (
+    METADATA_NAME,
+    apply_metadata_schema,
+    read_metadata,
+    write_metadata,
+)
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
-def process_images(
-    df: pd.DataFrame,
+def process_image(
+    img_path: str,
+    df_img: pd.DataFrame,
     enable_cropping: bool,
     enable_resizing: bool,
     enable_padding: bool,
     output_size: List[int],
-    save_dir: str,
-) -> pd.DataFrame:
-    # Process images independently
-    df_out = pd.DataFrame(columns=df.columns)
-    img_dir = os.path.join(save_dir, 'img')
-    os.makedirs(img_dir, exist_ok=True)
-    gb = df.groupby(['Image path'])
-
-    for img_path, df_img in tqdm(gb, desc='Processing images', unit=' images'):
-        # Read image and get box dimensions
-        df_img.reset_index(drop=True, inplace=True)
-        img = cv2.imread(img_path)
-        bboxes = get_bboxes(df_img)
-        features = get_features(df_img)
-
-        # Crop using lung coordinates
-        if enable_cropping:
-            df_lungs = df_img.loc[df_img['Feature'] == 'Lungs']
-            assert len(df_lungs) == 1, 'More than one lung object found'
-            x1 = df_lungs.at[df_lungs.index[0], 'x1']
-            y1 = df_lungs.at[df_lungs.index[0], 'y1']
-            x2 = df_lungs.at[df_lungs.index[0], 'x2']
-            y2 = df_lungs.at[df_lungs.index[0], 'y2']
-
-            img, bboxes, features, drop_idx = crop_image(
-                img=img,
-                bboxes=bboxes,
-                features=features,
-                x1=x1,
-                y1=y1,
-                x2=x2,
-                y2=y2,
-            )
-
-            if len(drop_idx) > 0:
-                log.info(f'{len(drop_idx)} object(s) dropped from {Path(img_path).name}')
-                df_img = df_img.drop(drop_idx).reset_index(drop=True)
-
-        # Resize image while keeping aspect ratio
-        if enable_resizing:
-            img, bboxes, features = resize_image(
-                img=img,
-                bboxes=bboxes,
-                features=features,
-                output_size=output_size,
-            )
-
-        # Pad image
-        if enable_padding:
-            img, bboxes, features = pad_image(
-                img=img,
-                bboxes=bboxes,
-                features=features,
-                output_size=output_size,
-            )
+    img_dir: str,
+    resize_transform: A.Compose,
+    pad_transform: A.Compose,
+) -> List[dict]:
+    # Read image and get box dimensions
+    df_img = df_img.reset_index(drop=True)
+    img = cv2.imread(img_path)
+    bboxes = get_bboxes(df_img)
+    features = get_features(df_img)
+
+    # Crop using lung coordinates
+    if enable_cropping:
+        df_lungs = df_img.loc[df_img['Feature'] == 'Lungs']
+        assert len(df_lungs) == 1, 'More than one lung object found'
+        x1 = df_lungs.at[df_lungs.index[0], 'x1']
+        y1 = df_lungs.at[df_lungs.index[0], 'y1']
+        x2 = df_lungs.at[df_lungs.index[0], 'x2']
+        y2 = df_lungs.at[df_lungs.index[0], 'y2']
+
+        img, bboxes, features, drop_idx = crop_image(
+            img=img,
+            bboxes=bboxes,
+            features=features,
+            x1=x1,
+            y1=y1,
+            x2=x2,
+            y2=y2,
+        )
 
-        # Round box coordinates
-        bboxes = [[round(value) for value in tup] for tup in bboxes]
+        if len(drop_idx) > 0:
+            log.info(f'{len(drop_idx)} object(s) dropped from {Path(img_path).name}')
+            df_img = df_img.drop(drop_idx).reset_index(drop=True)
 
-        # Update box and image metadata
-        df_img = set_bboxes(
-            df=df_img,
+    # Resize image while keeping aspect ratio
+    if enable_resizing:
+        img, bboxes, features = resize_image(
+            img=img,
             bboxes=bboxes,
-        )
-        df_img = set_features(
-            df=df_img,
             features=features,
+            output_size=output_size,
+            transform=resize_transform,
         )
-        df_img = update_bbox_metadata(
-            df=df_img,
+
+    # Pad image
+    if enable_padding:
+        img, bboxes, features = pad_image(
+            img=img,
+            bboxes=bboxes,
+            features=features,
+            output_size=output_size,
+            transform=pad_transform,
         )
-        df_img = update_image_metadata(
-            df=df_img,
-            img_size=img.shape[:2],
+
+    # Round box coordinates
+    bboxes = [[round(value) for value in tup] for tup in bboxes]
+
+    # Update box and image metadata
+    df_img = set_bboxes(
+        df=df_img,
+        bboxes=bboxes,
+    )
+    df_img = set_features(
+        df=df_img,
+        features=features,
+    )
+    df_img = update_bbox_metadata(
+        df=df_img,
+    )
+    df_img = update_image_metadata(
+        df=df_img,
+        img_size=img.shape[:2],
+    )
+
+    # Save image and return its metadata as plain records
+    img_name = Path(img_path).name
+    save_path = os.path.join(img_dir, img_name)
+    cv2.imwrite(save_path, img)
+
+    return df_img.to_dict('records')
+
+
+def process_image_chunk(
+    chunk: List[Tuple[str, pd.DataFrame]],
+    enable_cropping: bool,
+    enable_resizing: bool,
+    enable_padding: bool,
+    output_size: List[int],
+    img_dir: str,
+) -> List[List[dict]]:
+    # Transforms that do not depend on the image are built once per task
+    resize_transform = get_resize_transform(output_size)
+    pad_transform = get_pad_transform(output_size)
+
+    records = []
+    for img_path, df_img in chunk:
+        records.append(
+            process_image(
+                img_path=img_path,
+                df_img=df_img,
+                enable_cropping=enable_cropping,
+                enable_resizing=enable_resizing,
+                enable_padding=enable_padding,
+                output_size=output_size,
+                img_dir=img_dir,
+                resize_transform=resize_transform,
+                pad_transform=pad_transform,
+            ),
         )
 
-        # Save image and update corresponding dataframe
-        img_name = Path(img_path).name
-        save_path = os.path.join(img_dir, img_name)
-        cv2.imwrite(save_path, img)
-        df_out = pd.concat([df_out, df_img], axis=0)
+    return records
+
+
+def process_images(
+    df: pd.DataFrame,
+    enable_cropping: bool,
+    enable_resizing: bool,
+    enable_padding: bool,
+    output_size: List[int],
+    save_dir: str,
+    num_workers: int = -1,
+    chunk_size: int = 16,
+    manifest: Optional[StageManifest] = None,
+) -> pd.DataFrame:
+    img_dir = os.path.join(save_dir, 'img')
+    os.makedirs(img_dir, exist_ok=True)
+    if manifest is None:
+        manifest = StageManifest(
+            manifest_path=os.path.join(save_dir, MANIFEST_NAME),
+            config=None,
+            enabled=False,
+        )
 
-    # Update path column, sort, reset index
-    df_out['Image path'] = df_out.apply(
-        func=lambda row: os.path.join(img_dir, row['Image name']),
-        axis=1,
+    # Skip images whose source image and metadata rows are unchanged
+    groups = dict(list(df.groupby('Image path')))
+    manifest.remove_deleted_items(list(groups))
+    stale_keys = manifest.get_stale_items(
+        inputs={img_path: [img_path] for img_path in groups},
+        extra={img_path: df_img.to_dict('records') for img_path, df_img in groups.items()},
     )
+    log.info(f'{len(stale_keys)}/{len(groups)} images are new or changed')
+
+    # Process images independently in chunks
+    stale_groups = [(img_path, groups[img_path]) for img_path in stale_keys]
+    chunks = [
+        stale_groups[idx : idx + chunk_size] for idx in range(0, len(stale_groups), chunk_size)
+    ]
+    results = Parallel(n_jobs=num_workers)(
+        delayed(process_image_chunk)(
+            chunk=chunk,
+            enable_cropping=enable_cropping,
+            enable_resizing=enable_resizing,
+            enable_padding=enable_padding,
+            output_size=list(output_size),
+            img_dir=img_dir,
+        )
+        for chunk in tqdm(chunks, desc='Processing images', unit=' chunks')
+    )
+
+    for img_path, records in zip(stale_keys, [records for chunk in results for records in chunk]):
+        manifest.update(
+            key=img_path,
+            records=records,
+            outputs=[os.path.join(img_dir, Path(img_path).name)],
+        )
+    manifest.save()
+
+    # Merge records of all images, update path column, sort, reset index
+    df_out = apply_metadata_schema(pd.DataFrame(manifest.get_records(), columns=df.columns))
+    df_out['Image path'] = df_out['Image name'].map(lambda name: os.path.join(img_dir, name))
     df_out.sort_values(by=['Image path'], inplace=True)
     df_out.reset_index(drop=True, inplace=True)
 
@@ -130,25 +227,30 @@ def _merge_metadata(
     df2_path: str,
 ) -> pd.DataFrame:
     # Read the metadata
-    df1 = pd.read_excel(df1_path)
-    df2 = pd.read_excel(df2_path)
+    df1 = read_metadata(df1_path)
+    df2 = read_metadata(df2_path)
 
     # Merge the data frames
     df_merged = pd.concat([df1, df2], axis=0)
-    df_merged.drop(columns=['ID'], inplace=True)
     df_merged.reset_index(drop=True, inplace=True)
 
-    # Fill empty fields
-    df_out = pd.DataFrame(columns=df_merged.columns)
-    gb = df_merged.groupby(['Image name', 'Subject ID', 'Study ID'])
+    # Check that every image has exactly one value of each column to fill
+    group_columns = ['Image name', 'Subject ID', 'Study ID']
     columns_to_fill = ['Image path', 'Dataset', 'Class', 'Class ID']
-    for _, df_sample in gb:
-        for column in columns_to_fill:
-            unique_values = df_sample[column].dropna().unique()
-            assert len(unique_values) == 1, f'Column "{column}" has more than one unique value'
-            df_sample[column].fillna(unique_values[0], inplace=True)
-        df_out = pd.concat([df_out, df_sample], axis=0)
-    df_out.sort_values(by=['Image path'], inplace=True)
+    df_out = df_merged.dropna(subset=group_columns).copy()
+    gb = df_out.groupby(group_columns, sort=False)
+    num_unique = gb[columns_to_fill].nunique()
+    is_conflict = num_unique.ne(1)
+    if is_conflict.to_numpy().any():
+        df_conflicts = num_unique[is_conflict.any(axis=1)]
+        raise ValueError(
+            f'{len(df_conflicts)} image(s) have zero or several unique values:\n'
+            f'{df_conflicts.to_string()}',
+        )
+
+    # Fill empty fields with the only value of each image
+    df_out[columns_to_fill] = gb[columns_to_fill].transform('first')
+    df_out.sort_values(by=['Image path'], kind='mergesort', inplace=True)
     df_out.reset_index(drop=True, inplace=True)
 
     return df_out
@@ -167,8 +269,8 @@ def process_metadata(
         metadata: an updated metadata dataframe
     """
     df = _merge_metadata(
-        df1_path=os.path.join(dataset_dir, 'metadata.xlsx'),
-        df2_path=os.path.join(dataset_dir_fused, 'metadata.xlsx'),
+        df1_path=os.path.join(dataset_dir, METADATA_NAME),
+        df2_path=os.path.join(dataset_dir_fused, METADATA_NAME),
     )
     df = df[df['View'] == 'Frontal']
     df = df.dropna(subset=['Class ID'])
@@ -202,6 +304,7 @@ def main(cfg: DictConfig) -> None:
     log.info(f'Enable padding............: {cfg.enable_padding}')
     log.info(f'Output size...............: {cfg.output_size}')
     log.info(f'Box extension.............: {cfg.box_extension}')
+    log.info(f'Number of workers.........: {cfg.num_workers}')
     log.info(f'Output directory..........: {cfg.save_dir}')
 
     # Process source metadata
@@ -224,16 +327,26 @@ def main(cfg: DictConfig) -> None:
         enable_padding=cfg.enable_padding,
         output_size=cfg.output_size,
         save_dir=cfg.save_dir,
+        num_workers=cfg.num_workers,
+        chunk_size=cfg.chunk_size,
+        manifest=StageManifest(
+            manifest_path=os.path.join(cfg.save_dir, MANIFEST_NAME),
+            config={
+                'enable_cropping': cfg.enable_cropping,
+                'enable_resizing': cfg.enable_resizing,
+                'enable_padding': cfg.enable_padding,
+                'output_size': list(cfg.output_size),
+            },
+            sources=[__file__, utils_final, utils_metadata, utils_sly],
+            enabled=cfg.incremental,
+        ),
     )
 
     # Save updated metadata
-    save_path = os.path.join(cfg.save_dir, 'metadata.xlsx')
-    metadata.index += 1
-    metadata.to_excel(
-        save_path,
-        sheet_name='Metadata',
-        index=True,
-        index_label='ID',
+    write_metadata(
+        df=metadata,
+        path=os.path.join(cfg.save_dir, METADATA_NAME),
+        export_excel=cfg.export_excel,
     )
 
     log.info('Complete')
@@ -1,17 +1,23 @@
 import logging
 import os
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Tuple
 
 import cv2
 import hydra
 import pandas as pd
-import supervisely_lib as sly
 from joblib import Parallel, delayed
 from omegaconf import DictConfig, OmegaConf
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
+import src.data.utils as utils
+import src.data.utils_rle as utils_rle
+import src.data.utils_sly as utils_sly
+from src.data.utils import probe_image_size
+from src.data.utils_manifest import MANIFEST_NAME, StageManifest
+from src.data.utils_metadata import METADATA_NAME, apply_metadata_schema, write_metadata
 from src.data.utils_sly import (
     CLASS_MAP,
     FEATURE_MAP,
@@ -22,6 +28,7 @@ from src.data.utils_sly import (
     get_mask_points,
     get_object_box,
     get_tag_value,
+    load_json,
     read_sly_project,
 )
 
@@ -29,38 +36,36 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
-def process_image(
-    row: pd.Series,
+def _parse_image_name(
+    img_path: str,
+    save_dir: str,
+) -> Tuple[str, str, int, str]:
+    # Source images are named <subject>_<study>_<frontal width>_<lateral width>
+    subject_id, study_id, width_frontal, width_lateral = Path(img_path).stem.split('_')
+    save_path = os.path.join(save_dir, 'img', f'{subject_id}_{study_id}.png')
+    return subject_id, study_id, int(width_frontal), save_path
+
+
+def get_image_info(
+    img_path: str,
     save_dir: str,
 ) -> dict:
-    """Process a single image.
+    """Get information about the frontal part of an image without decoding it.
 
     Args:
-        row: series with information about one image
+        img_path: path to the source image
         save_dir: directory where the output frontal images and metadata will be stored
     Returns:
         dictionary with information about one image
     """
-    (img_path, ann_path), row = row
-    log.info(f'Cropping image {img_path}')
-
-    img_stem = Path(img_path).stem
-    subject_id, study_id, width_frontal, width_lateral = img_stem.split('_')
+    subject_id, study_id, img_width, save_path = _parse_image_name(img_path, save_dir)
     dataset = Path(img_path).parts[-3]
-    img = cv2.imread(img_path)
-    img_height = img.shape[0]
-    img_width = int(width_frontal)
-    img = img[0:img_height, 0:img_width]
+    img_height, _ = probe_image_size(img_path)
     img_ratio = img_height / img_width
 
-    save_dir_img = os.path.join(save_dir, 'img')
-    os.makedirs(save_dir_img, exist_ok=True)
-    img_path = os.path.join(save_dir_img, f'{subject_id}_{study_id}.png')
-    cv2.imwrite(img_path, img)
-
     return {
-        'Image path': img_path,
-        'Image name': Path(img_path).name,
+        'Image path': save_path,
+        'Image name': Path(save_path).name,
         'Subject ID': subject_id,
         'Study ID': study_id,
         'Dataset': dataset,
@@ -70,25 +75,42 @@ def process_image(
     }
 
 
+def crop_image(
+    img_path: str,
+    save_dir: str,
+) -> None:
+    """Crop the frontal part of an image and save it.
+
+    Args:
+        img_path: path to the source image
+        save_dir: directory where the output frontal images and metadata will be stored
+    Returns:
+        None
+    """
+    log.debug(f'Cropping image {img_path}')
+    _, _, img_width, save_path = _parse_image_name(img_path, save_dir)
+    img = cv2.imread(img_path)
+    img = img[:, 0:img_width]
+    os.makedirs(Path(save_path).parent, exist_ok=True)
+    cv2.imwrite(save_path, img)
+
+
 def process_annotation(
-    row: pd.Series,
+    ann_path: str,
     img_info: dict,
-) -> pd.DataFrame:
+) -> List[dict]:
     """Process a single annotation.
 
     Args:
-        row: series with information about one image
+        ann_path: path to the Supervisely annotation of an image
         img_info: dictionary with information about one image
     Returns:
-        meta: dataframe with metadata for one image
+        records: metadata records of the image objects
     """
-    log.info('Preparing metadata')
-    (img_path, ann_path), row = row
-    meta = pd.DataFrame(columns=METADATA_COLUMNS)
-
-    ann = sly.io.json.load_json_file(ann_path)
+    ann = load_json(ann_path)
     class_name = get_class_name(ann)
 
+    records = []
     for obj in ann['objects']:
         log.debug(f'Processing object {obj}')
 
@@ -117,27 +139,30 @@ def process_annotation(
         obj_info.update(xy)
         obj_info.update(box)
         obj_info.update(mask_points)
-        meta = meta.append(obj_info, ignore_index=True)
+        records.append(obj_info)
 
-    return meta
+    return records
 
 
 def process_sample(
-    row: pd.Series,
+    img_path: str,
+    ann_path: str,
     save_dir: str,
-) -> pd.DataFrame:
-    """Process a single sample.
+) -> Tuple[dict, List[dict]]:
+    """Parse the annotation of a single sample, the image itself is cropped separately.
 
     Args:
-        row: series with information about one image
+        img_path: path to the source image
+        ann_path: path to the Supervisely annotation of the image
         save_dir: directory where the output frontal images and metadata will be stored
     Returns:
-        ann_info: dataframe with metadata for one image
+        img_info: dictionary with information about one image
+        records: metadata records of the image objects
     """
-    img_info = process_image(row, save_dir)
-    ann_info = process_annotation(row, img_info)
+    img_info = get_image_info(img_path, save_dir)
+    records = process_annotation(ann_path, img_info)
 
-    return ann_info
+    return img_info, records
 
 
 def split_dataset(
@@ -176,7 +201,7 @@ def split_dataset(
     mask_empty = df_train['Class ID'] == 0
     df_empty = df_train[mask_empty]
     df_train = df_train.drop(df_train.index[mask_empty])
-    df_test = df_test.append(df_empty, ignore_index=True)
+    df_test = pd.concat([df_test, df_empty], ignore_index=True)
 
     # Add split column
     df_train['Split'] = 'train'
@@ -203,25 +228,24 @@ def split_dataset(
 def save_metadata(
     df: pd.DataFrame,
     save_dir: str,
+    export_excel: bool = False,
 ) -> None:
     """Save metadata for an intermediate dataset.
 
     Args:
         df: dataframe with metadata for all images
         save_dir: directory where the output files will be saved
+        export_excel: whether to save an Excel copy of the metadata
     Returns:
         None
     """
-    df_path = os.path.join(save_dir, 'metadata.xlsx')
+    df_path = os.path.join(save_dir, METADATA_NAME)
     logging.info(f'Saving metadata to {df_path}')
     df.sort_values(['Image path'], inplace=True)
-    df.reset_index(drop=True, inplace=True)
-    df.index += 1
-    df.to_excel(
-        df_path,
-        sheet_name='Metadata',
-        index=True,
-        index_label='ID',
+    write_metadata(
+        df=df,
+        path=df_path,
+        export_excel=export_excel,
     )
 
 
@@ -238,6 +262,8 @@ def main(cfg: DictConfig) -> None:
         dataset_dir: a path to Supervisely dataset directory
         include_dirs: a list of subsets to include in the dataset
         exclude_dirs: a list of subsets to exclude from the dataset
+        num_workers: number of processes used to parse annotations
+        num_threads: number of threads used to scan the project and crop images
         save_dir: directory where the output frontal images and metadata will be stored
     Returns:
         None
@@ -247,19 +273,46 @@ def main(cfg: DictConfig) -> None:
         dataset_dir=cfg.dataset_dir,
         include_dirs=cfg.include_dirs,
         exclude_dirs=cfg.exclude_dirs,
+        num_threads=cfg.num_threads,
     )
 
-    log.info('Processing annotations')
-    groups = df.groupby(['img_path', 'ann_path'])
-    processing_func = partial(
-        process_sample,
-        save_dir=cfg.save_dir,
+    # Process only new or changed samples
+    manifest = StageManifest(
+        manifest_path=os.path.join(cfg.save_dir, MANIFEST_NAME),
+        config={'save_dir': cfg.save_dir},
+        sources=[__file__, utils, utils_rle, utils_sly],
+        enabled=cfg.incremental,
     )
-    result = Parallel(n_jobs=-1)(
-        delayed(processing_func)(group)
-        for group in tqdm(groups, desc='Dataset conversion', unit=' image')
+    groups = {
+        img_path: (img_path, ann_path) for img_path, ann_path in zip(df.img_path, df.ann_path)
+    }
+    manifest.remove_deleted_items(list(groups))
+    stale_keys = manifest.get_stale_items(
+        inputs={img_path: list(paths) for img_path, paths in groups.items()},
     )
-    df = pd.concat(result)
+    log.info(f'Processing {len(stale_keys)}/{len(groups)} new or changed samples')
+
+    # Images are cropped in threads while their annotations are parsed in processes
+    samples = [groups[key] for key in stale_keys]
+    with ThreadPoolExecutor(max_workers=cfg.num_threads) as executor:
+        futures = [executor.submit(crop_image, img_path, cfg.save_dir) for img_path, _ in samples]
+        results = Parallel(n_jobs=cfg.num_workers)(
+            delayed(process_sample)(img_path=img_path, ann_path=ann_path, save_dir=cfg.save_dir)
+            for img_path, ann_path in tqdm(samples, desc='Annotation parsing', unit=' samples')
+        )
+        for future in tqdm(futures, desc='Image cropping', unit=' images'):
+            future.result()
+
+    for key, (img_info, records) in zip(stale_keys, results):
+        manifest.update(
+            key=key,
+            records=records,
+            outputs=[img_info['Image path']],
+        )
+    manifest.save()
+
+    # Rebuild the metadata of the whole dataset from cached records
+    df = apply_metadata_schema(pd.DataFrame(manifest.get_records(), columns=METADATA_COLUMNS))
 
     df = split_dataset(
         df=df,
@@ -270,6 +323,7 @@ def main(cfg: DictConfig) -> None:
     save_metadata(
         df=df,
         save_dir=cfg.save_dir,
+        export_excel=cfg.export_excel,
     )
 
     log.info('Complete')
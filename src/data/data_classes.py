@@ -1,14 +1,18 @@
 import os
-from typing import Dict, Tuple
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Tuple
 
-import albumentations as A
+import numpy as np
 import pandas as pd
-from albumentations.pytorch import ToTensorV2
+import torch
 from PIL import Image
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader, Dataset
 
 import src.data.data_classes_utils as data_classes_utils
+from src.data.utils_augmentation import BatchAugmentation
+from src.data.utils_cache import DatasetCache
+from src.data.utils_metadata import METADATA_NAME, read_metadata
 
 
 class EdemaDataset(Dataset):
@@ -17,14 +21,16 @@ class EdemaDataset(Dataset):
     def __init__(
         self,
         metadata_df: pd.DataFrame,
-        make_augmentation: bool = False,
         normalize_tensors: bool = False,
         resize: Tuple[int, int] = (500, 500),
+        cache_dir: Optional[str] = None,
     ) -> None:
         self.img_data = self.process_metadata_df(metadata_df)
-        self.make_augmentation = make_augmentation
         self.normalize_tensors = normalize_tensors
         self.resize = resize
+        # Masks precomputed by src/data/cache_dataset.py are used if a cache for resize exists
+        # and was built from the same metadata
+        self.cache = DatasetCache.from_dir(cache_dir, resize, metadata_df=metadata_df)
 
     @staticmethod
     def process_metadata_df(metadata_df: pd.DataFrame) -> Dict[int, Dict]:
@@ -55,48 +61,40 @@ class EdemaDataset(Dataset):
 
     def __getitem__(self, idx):
         img_path = self.img_data[idx]['path']
-        image = Image.open(img_path)
         annotations = self.img_data[idx]['annotations']
 
-        # resize image to target size and create list with masks, as well as labels array
-        image_arr, masks, findings = data_classes_utils.resize_and_create_masks(
-            image,
-            annotations,
-            self.resize,
-        )
-
-        if self.make_augmentation:
-            [
-                A.RandomBrightnessContrast(p=0.5),
-                A.RandomGamma(p=0.5),
-                A.GaussianBlur(p=0.2),
-            ]
+        # read resized image, masks and labels from the cache built by src/data/cache_dataset.py,
+        # otherwise resize image to target size and create masks
+        if self.cache is not None:
+            image_arr = self.cache.get_image(img_path)
+            masks, findings = self.cache.get_masks(img_path, packed=True)
         else:
-            [A.NoOp(p=1.0)]
+            image = Image.open(img_path).convert('RGB')
+            transform = data_classes_utils.get_resize_transform(image.size, self.resize)
+            image_arr = transform(image=np.array(image))['image']
+            masks, findings = data_classes_utils.create_resized_masks(
+                image.size,
+                annotations,
+                self.resize,
+            )
+            masks = data_classes_utils.pack_masks(masks)
 
-        if self.normalize_tensors:
-            # these are mean/std values for RGB channels in a set of 110 annotated images (DS1, DS2 folders)
-            normalization = A.Normalize(mean=[0.4675, 0.4675, 0.4675], std=[0.3039, 0.3039, 0.3039])
-            # This normalization is based on the MNIST dataset as recommended by PyTorch
-            # normalization = A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        else:
-            normalization = A.NoOp(p=1.0)
-
-        transform = A.Compose(
-            [
-                # *augmentation_functions,
-                normalization,
-                ToTensorV2(),
-            ],
-        )
+        # images stay uint8 and are converted to float per batch in collate_fn, masks stay
+        # bit-packed until they are unpacked on the model side with split_batch, augmentation
+        # is applied per batch by EdemaDataModule
+        image = torch.from_numpy(np.ascontiguousarray(image_arr.transpose(2, 0, 1)))
+        masks = torch.from_numpy(masks)
+        findings = torch.tensor(findings, dtype=data_classes_utils.FINDINGS_DTYPE)
 
-        transformed = transform(image=image_arr, masks=masks)
+        return image, masks, findings
 
-        tensor = data_classes_utils.combine_image_and_masks(
-            transformed['image'],
-            transformed['masks'],
+    @property
+    def collate_fn(self) -> Callable:
+        """Collate function converting images to float batches."""
+        return partial(
+            data_classes_utils.collate_batch,
+            normalize_tensors=self.normalize_tensors,
         )
-        return tensor, findings
 
 
 class EdemaDataModule(LightningDataModule):
@@ -110,6 +108,12 @@ class EdemaDataModule(LightningDataModule):
         make_augmentation: bool = False,
         normalize_tensors: bool = False,
         train_share: float = 0.8,
+        cache_dir: Optional[str] = None,
+        num_workers: int = 1,
+        pin_memory: bool = False,
+        persistent_workers: bool = False,
+        prefetch_factor: Optional[int] = None,
+        shuffle_train: bool = True,
     ) -> None:
         """Datamodule for preparing batches of processed images.
 
@@ -117,26 +121,62 @@ class EdemaDataModule(LightningDataModule):
             data_dir: directory where converted supervisely dataset reside
             batch_size: batch size
             resize: tuple with desired input size (width, height) of the processed images
-            make_augmentation: whether to apply a set of augmentation operations
+            make_augmentation: whether to augment train batches with BatchAugmentation on the
+                device they are transferred to
             normalize_tensors: whether to normalize output tensors
             train_share: share of the train part
+            cache_dir: directory with caches built by src/data/cache_dataset.py
+            num_workers: number of DataLoader worker processes, 0 loads data in the main process
+            pin_memory: whether to collate batches into page-locked memory for faster GPU copies
+            persistent_workers: whether to keep workers (and their transforms) between epochs
+            prefetch_factor: number of batches loaded in advance by each worker, None is default
+            shuffle_train: whether to reshuffle the train part every epoch, the prototype push
+                iterates over it in order with train_dataloader(shuffle=False)
         """
         super().__init__()
+        if make_augmentation and normalize_tensors:
+            raise ValueError('Batch augmentation expects unnormalized images in [0, 1]')
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.resize = resize
         self.make_augmentation = make_augmentation
         self.normalize_tensors = normalize_tensors
         self.train_share = train_share
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.shuffle_train = shuffle_train
+        self.augmentation = BatchAugmentation() if make_augmentation else None
+
+    def get_loader_kwargs(
+        self,
+        num_workers: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Get DataLoader arguments of the data module, num_workers overrides the configured one."""
+        num_workers = self.num_workers if num_workers is None else num_workers
+        loader_kwargs: Dict[str, Any] = {
+            'batch_size': self.batch_size,
+            'num_workers': num_workers,
+            'pin_memory': self.pin_memory,
+        }
+        # DataLoader rejects worker options without worker processes
+        if num_workers > 0:
+            loader_kwargs['persistent_workers'] = self.persistent_workers
+            if self.prefetch_factor is not None:
+                loader_kwargs['prefetch_factor'] = self.prefetch_factor
+
+        return loader_kwargs
 
     def setup(self, stage):
-        metadata_df = pd.read_excel(os.path.join(self.data_dir, 'metadata.xlsx'))
+        metadata_df = read_metadata(os.path.join(self.data_dir, METADATA_NAME))
         metadata_df_filtered = metadata_df[metadata_df['View'] == 'Frontal']
         edema_full = EdemaDataset(
             metadata_df_filtered,
-            make_augmentation=self.make_augmentation,
             normalize_tensors=self.normalize_tensors,
             resize=self.resize,
+            cache_dir=self.cache_dir,
         )
         if stage == 'fit':
             self.edema_train, self.edema_test = data_classes_utils.split_dataset(
@@ -146,22 +186,39 @@ class EdemaDataModule(LightningDataModule):
                 verbose=True,
             )
 
-    def train_dataloader(self, num_workers=1, **kwargs):
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Only train batches are augmented, after they are moved to the device of the model
+        if self.augmentation is None or self.trainer is None or not self.trainer.training:
+            return batch
+        images, masks, labels = data_classes_utils.split_batch(batch)
+        # masks are padded with 1 for images with edema findings, see make_masks
+        mask_fill = labels[:, 1:].any(dim=1)
+        images, masks = self.augmentation(images, masks, mask_fill=mask_fill)
+        return images, masks, labels
+
+    def train_dataloader(self, num_workers=None, **kwargs):
+        loader_kwargs = self.get_loader_kwargs(num_workers)
+        loader_kwargs['shuffle'] = self.shuffle_train
+        loader_kwargs.update(kwargs)
         return DataLoader(
             self.edema_train,
-            batch_size=self.batch_size,
-            num_workers=num_workers,
-            **kwargs,
+            collate_fn=self.edema_train.dataset.collate_fn,
+            **loader_kwargs,
         )
 
-    def test_dataloader(self, num_workers=1, **kwargs):
+    def test_dataloader(self, num_workers=None, **kwargs):
+        loader_kwargs = self.get_loader_kwargs(num_workers)
+        loader_kwargs.update(kwargs)
         return DataLoader(
             self.edema_test,
-            batch_size=self.batch_size,
-            num_workers=num_workers,
-            **kwargs,
+            collate_fn=self.edema_test.dataset.collate_fn,
+            **loader_kwargs,
         )
 
+    def val_dataloader(self, num_workers=None, **kwargs):
+        # the test part is used for validation during training
+        return self.test_dataloader(num_workers, **kwargs)
+
 
 if __name__ == '__main__':
     metadata_df = pd.read_excel(
@@ -171,8 +228,8 @@ if __name__ == '__main__':
         ),
     ).fillna({'Class ID': -1})
     dataset = EdemaDataset(metadata_df, normalize_tensors=False)
-    images, labels = dataset[1]
-    print(images.shape)
+    image, masks, labels = dataset[1]
+    print(image.shape, masks.shape)
 
     datamodule = EdemaDataModule(
         data_dir='C:/Users/makov/Desktop/edema-quantification/dataset/MIMIC-CXR-Edema-Intermediate',
@@ -182,12 +239,12 @@ if __name__ == '__main__':
     test_dataloader = datamodule.test_dataloader()
     print('train dataloader')
     for idx, batch in enumerate(train_dataloader):
-        images, labels = batch
+        images, masks, labels = data_classes_utils.split_batch(batch)
         print('batch_' + str(idx))
         print(labels)
     print('test dataloader')
     for idx, batch in enumerate(test_dataloader):
-        images, labels = batch
+        images, masks, labels = data_classes_utils.split_batch(batch)
         print('batch_' + str(idx))
         print(labels)
 
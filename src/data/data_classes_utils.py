@@ -1,6 +1,6 @@
 import re
 from collections import defaultdict
-from typing import Any, DefaultDict, Dict, List, Tuple, Union
+from typing import Any, DefaultDict, Dict, List, Optional, Sequence, Tuple, Union
 
 import albumentations as A
 import cv2
@@ -10,13 +10,15 @@ import torch
 from PIL import Image, ImageDraw, ImageOps
 from torch.utils.data import Dataset, Subset
 
-from src.data.utils_sly import FEATURE_MAP, convert_base64_to_mask
+from src.data.utils_sly import FEATURE_MAP, decode_mask
 
 __all__ = [
     'resize_and_create_masks',
     'split_dataset',
     'combine_image_and_masks',
     'parse_coord_string',
+    'collate_batch',
+    'split_batch',
 ]
 
 
@@ -24,12 +26,16 @@ FINDINGS_DTYPE = torch.float32
 IMAGE_DTYPE = torch.float32
 MASK_DTYPE = np.float32
 TENSOR_DTYPE = torch.float32
+# mean/std values for RGB channels in a set of 110 annotated images (DS1, DS2 folders)
+IMAGE_MEAN = (0.4675, 0.4675, 0.4675)
+IMAGE_STD = (0.3039, 0.3039, 0.3039)
 # all relevant edema findings for which masks will be prepared subsequently
 EDEMA_FINDINGS = [k for k in FEATURE_MAP if k not in ['Heart', 'Lungs']]
 
 
 def parse_coord_string(coord_string: str) -> np.ndarray:
-    coordinates = [int(d) for d in re.findall(r'\d+', coord_string)]
+    # Points of the legacy metadata, read_metadata already returns them as int32 arrays
+    coordinates = [int(d) for d in re.findall(r'-?\d+', coord_string)]
     return np.array(coordinates).reshape(-1, 2)
 
 
@@ -66,22 +72,27 @@ def extract_annotations(group_df: pd.DataFrame) -> Dict[str, Union[DefaultDict[A
         if pd.notna(data['Mask']):
             annotations[data['Feature']]['bitmaps'].append(data.loc['x1':'Mask'].to_dict())  # type: ignore
         else:
-            annotations[data['Feature']]['polygons'].append(parse_coord_string(data['Points']))
+            points = data['Points']
+            if isinstance(points, str):
+                points = parse_coord_string(points)
+            annotations[data['Feature']]['polygons'].append(points)
 
     return annotations
 
 
 def make_masks(
-    image: Image.Image,
+    image_size: Tuple[int, int],
     annotations: Dict,
     linelike_finding_width: int = 15,
+    dtype: type = MASK_DTYPE,
 ) -> Tuple[List[np.ndarray], List[int], int]:
     """Make masks.
 
     Args:
-        image: image
+        image_size: size of the image (width, height)
         annotations: dict with annotation data for a given image
         linelike_finding_width: line width in masks corresponding to findings annotated with lines
+        dtype: data type of the masks
 
     Returns:
         masks: list of masks represented as numpy arrays for each edema finding
@@ -91,7 +102,7 @@ def make_masks(
     """
     masks = []
     findings = []
-    width, height = image.size
+    width, height = image_size
     default_mask_value = 1 if any(f in EDEMA_FINDINGS for f in annotations.keys()) else 0
 
     # adding default 'No_findings' finding to the list and preparing masks for each of them
@@ -122,7 +133,7 @@ def make_masks(
             # draw finding mask represented by bitmaps
             elif annotations[finding]['bitmaps']:
                 for bitmap in annotations[finding]['bitmaps']:
-                    bitmap_array = convert_base64_to_mask(bitmap['Mask'])
+                    bitmap_array = decode_mask(bitmap['Mask'])
                     bitmap_mask = Image.fromarray(bitmap_array).convert('1')
                     inverted_bitmap_mask = ImageOps.invert(bitmap_mask)
 
@@ -131,17 +142,17 @@ def make_masks(
             else:
                 raise RuntimeError('neither polygon nor mask data is present in the metadata')
 
-            masks.append(np.array(finding_mask, dtype=MASK_DTYPE))
+            masks.append(np.array(finding_mask, dtype=dtype))
             findings.append(1)
 
         else:
             # Make masks == 1 for non 'No_findings' features
             if list(annotations.keys())[0] == 'No_findings':
                 finding_mask = Image.new(mode='1', size=(width, height), color=1)
-                masks.append(np.array(finding_mask, dtype=MASK_DTYPE))
+                masks.append(np.array(finding_mask, dtype=dtype))
                 findings.append(0)
             else:
-                masks.append(np.array(finding_mask, dtype=MASK_DTYPE))
+                masks.append(np.array(finding_mask, dtype=dtype))
                 findings.append(0)
 
     return masks, findings, default_mask_value
@@ -170,16 +181,76 @@ def resize_and_create_masks(
     # images have to be unnormalized in [0, 1] to perform drawing in the model class
     image_arr = np.array(image) / 255
     masks, findings, default_mask_value = make_masks(
-        image,
+        image.size,
         annotations,
         linelike_finding_width=linelike_finding_width,
     )
 
+    # image is padded with 0 and masks with default_mask_value (0 or 1)
+    transform = get_resize_transform(image.size, target_size, mask_value=default_mask_value)
+    transformed = transform(image=image_arr, masks=masks)
+    image_resized = transformed['image']
+    masks_resized = transformed['masks']
+
+    findings = torch.tensor(findings, dtype=FINDINGS_DTYPE)
+
+    return image_resized, masks_resized, findings
+
+
+def create_resized_masks(
+    image_size: Tuple[int, int],
+    annotations: Dict,
+    target_size: Tuple[int, int],
+    linelike_finding_width: int = 15,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Create masks resized to the target size without reading the image itself.
+
+    The masks are the same as those of resize_and_create_masks, but rasterized as uint8.
+
+    Args:
+        image_size: size of the image (width, height)
+        annotations: dict with image annotations
+        target_size: tuple with target image size (width, height)
+        linelike_finding_width: width in pixels for linelike annotations
+
+    Returns:
+        masks_resized: uint8 array of the resized masks (num_masks, height, width)
+        findings: uint8 array of 0/1 values showing the presence/absence of each finding
+    """
+    masks, findings, default_mask_value = make_masks(
+        image_size,
+        annotations,
+        linelike_finding_width=linelike_finding_width,
+        dtype=np.uint8,
+    )
+    transform = get_resize_transform(image_size, target_size, mask_value=default_mask_value)
+    width, height = image_size
+    transformed = transform(image=np.zeros((height, width), dtype=np.uint8), masks=masks)
+    masks_resized = np.stack(transformed['masks'])
+
+    return masks_resized, np.array(findings, dtype=np.uint8)
+
+
+def get_resize_transform(
+    image_size: Tuple[int, int],
+    target_size: Tuple[int, int],
+    mask_value: int = 0,
+) -> A.Compose:
+    """Get a transform resizing an image and its masks to the target size keeping aspect ratio.
+
+    Args:
+        image_size: size of the image (width, height)
+        target_size: tuple with target image size (width, height)
+        mask_value: value used to pad the masks
+
+    Returns:
+        transform: resize and pad transform, the image is padded with 0
+    """
     # further we resize image and masks by padding them while keeping initial aspect ratio
     # this sequence of transformations mimics PIL.ImageOps.pad function
     # therefore we define 'resize_transform' depending on several factors
     width_new, height_new = target_size
-    width_0, height_0 = image.size
+    width_0, height_0 = image_size
     aspect_0 = width_0 / height_0
     aspect_new = width_new / height_new
 
@@ -197,7 +268,6 @@ def resize_and_create_masks(
         resize_transform = A.augmentations.geometric.Resize(height_new, width_new)
 
     # make image and masks resize operations
-    # image is padded with 0 and masks with default_mask_value (0 or 1)
     transform = A.Compose(
         [
             resize_transform,
@@ -206,18 +276,12 @@ def resize_and_create_masks(
                 width_new,
                 border_mode=cv2.BORDER_CONSTANT,
                 value=0,
-                mask_value=default_mask_value,
+                mask_value=mask_value,
             ),
         ],
     )
 
-    transformed = transform(image=image_arr, masks=masks)
-    image_resized = transformed['image']
-    masks_resized = transformed['masks']
-
-    findings = torch.tensor(findings, dtype=FINDINGS_DTYPE)
-
-    return image_resized, masks_resized, findings
+    return transform
 
 
 def combine_image_and_masks(
@@ -232,6 +296,172 @@ def combine_image_and_masks(
     return tensor
 
 
+def pack_masks(
+    masks: np.ndarray,
+) -> np.ndarray:
+    """Pack binary masks (..., height, width) into bits (..., ceil(height * width / 8))."""
+    return np.packbits(masks.reshape(*masks.shape[:-2], -1), axis=-1)
+
+
+def unpack_masks(
+    packed_masks: np.ndarray,
+    mask_size: Tuple[int, int],
+) -> np.ndarray:
+    """Unpack bit-packed masks of mask_size (width, height) into uint8 (..., height, width)."""
+    width, height = mask_size
+    masks = np.unpackbits(packed_masks, axis=-1, count=height * width)
+    return masks.reshape(*packed_masks.shape[:-1], height, width)
+
+
+def unpack_mask_tensor(
+    packed_masks: torch.Tensor,
+    mask_size: Tuple[int, int],
+) -> torch.Tensor:
+    """Unpack bit-packed uint8 masks (..., num_bytes) into uint8 masks (..., height, width).
+
+    This is the torch counterpart of unpack_masks, so masks can be unpacked on the GPU.
+
+    Args:
+        packed_masks: bit-packed masks, bits are in big-endian order as in np.packbits
+        mask_size: tuple with mask size (width, height)
+
+    Returns:
+        masks: unpacked masks with 0/1 values
+    """
+    width, height = mask_size
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed_masks.device)
+    bits = (packed_masks.unsqueeze(-1) >> shifts) & 1
+    bits = bits.flatten(start_dim=-2)[..., : height * width]
+
+    return bits.reshape(*packed_masks.shape[:-1], height, width)
+
+
+def normalize_images(
+    images: torch.Tensor,
+    normalize_tensors: bool = False,
+    mean: Tuple[float, ...] = IMAGE_MEAN,
+    std: Tuple[float, ...] = IMAGE_STD,
+) -> torch.Tensor:
+    """Convert a batch of uint8 images (batch, 3, H, W) to float.
+
+    Args:
+        images: batch of uint8 images
+        normalize_tensors: whether to normalize images with mean and std
+        mean: mean values of RGB channels
+        std: std values of RGB channels
+
+    Returns:
+        images: batch of float images, unnormalized images are in [0, 1]
+    """
+    images = images.to(dtype=IMAGE_DTYPE) / 255
+    if normalize_tensors:
+        # the same as A.Normalize with max_pixel_value=255 used to be applied to [0, 1] images
+        mean_ = torch.tensor(mean, dtype=IMAGE_DTYPE).view(1, -1, 1, 1) * 255
+        std_ = torch.tensor(std, dtype=IMAGE_DTYPE).view(1, -1, 1, 1) * 255
+        images = (images - mean_) / std_
+
+    return images
+
+
+def collate_batch(
+    samples: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+    normalize_tensors: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Collate uint8 samples of EdemaDataset and convert images to float once per batch.
+
+    Masks stay bit-packed, they are unpacked with split_batch on the model side.
+
+    Args:
+        samples: list of uint8 images (3, H, W), packed masks (num_masks, num_bytes) and findings
+        normalize_tensors: whether to normalize images
+
+    Returns:
+        images: batch of float images (batch, 3, H, W)
+        masks: batch of bit-packed masks (batch, num_masks, num_bytes)
+        findings: batch of findings (batch, num_findings)
+    """
+    images, masks, findings = (torch.stack(tensors) for tensors in zip(*samples))
+    images = normalize_images(images, normalize_tensors)
+
+    return images, masks, findings
+
+
+def split_batch(
+    batch: Sequence[torch.Tensor],
+    device: Optional[Union[str, torch.device]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Split a batch into images, masks and labels.
+
+    Both compact batches of collate_batch (images, bit-packed masks, labels) and batches of
+    images combined with float masks (12-channel tensor, labels) are supported. Masks are moved
+    to the device before unpacking, so only the packed bits are transferred.
+
+    Args:
+        batch: batch of a data loader
+        device: device to move the tensors to, they are not moved if None
+
+    Returns:
+        images: batch of images (batch, 3, H, W)
+        masks: batch of masks (batch, num_masks, H, W), uint8 for compact batches
+        labels: batch of labels (batch, num_findings)
+    """
+    if len(batch) == 3:
+        images, masks, labels = batch
+    else:
+        images_and_masks, labels = batch
+        images, masks = images_and_masks[:, 0:3], images_and_masks[:, 3:]
+
+    if device is not None:
+        images, masks, labels = (tensor.to(device) for tensor in (images, masks, labels))
+
+    if masks.dtype == torch.uint8 and masks.dim() == 3:
+        masks = unpack_mask_tensor(masks, mask_size=(images.shape[3], images.shape[2]))
+
+    return images, masks, labels
+
+
+def _score_split_trials(
+    subject_orders: np.ndarray,
+    subject_images: np.ndarray,
+    subject_classes: np.ndarray,
+    train_share: float,
+    ensure_all_classes_in_splits: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Split subjects of all trials at once and score the class distributions of the splits.
+
+    Args:
+        subject_orders: subject codes of each trial in shuffled order (num_trials, num_subjects)
+        subject_images: number of images of each subject (num_subjects,)
+        subject_classes: number of objects of each class per subject (num_subjects, num_classes)
+        train_share: share of the train part
+        ensure_all_classes_in_splits: mark trials lacking a class in any split as invalid
+
+    Returns:
+        train_masks: whether a subject is in the train split (num_trials, num_subjects)
+        rmsd: squared differences between class shares of the splits, inf for invalid trials
+    """
+    shares = np.cumsum(subject_images[subject_orders], axis=1)
+    shares = shares / shares[:, -1:]
+    train_masks = np.zeros(subject_orders.shape, dtype=bool)
+    np.put_along_axis(train_masks, subject_orders, shares < train_share, axis=1)
+
+    train_counts = train_masks.astype(np.int64) @ subject_classes
+    test_counts = subject_classes.sum(axis=0) - train_counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        train_percentages = train_counts / train_counts.sum(axis=1, keepdims=True)
+        test_percentages = test_counts / test_counts.sum(axis=1, keepdims=True)
+
+    # a class missing in a split does not contribute to the RMSD, as with NaN-skipping sums
+    is_present = (train_counts > 0) & (test_counts > 0)
+    rmsd = np.where(is_present, (train_percentages - test_percentages) ** 2, 0).sum(axis=1)
+    is_valid = (train_counts.sum(axis=1) > 0) & (test_counts.sum(axis=1) > 0)
+    if ensure_all_classes_in_splits:
+        is_valid &= is_present.all(axis=1)
+    rmsd[~is_valid] = np.inf
+
+    return train_masks, rmsd
+
+
 def split_dataset(
     dataset: Dataset,
     train_share: float,
@@ -239,9 +469,14 @@ def split_dataset(
     n_split_trials: int = 500,
     ensure_all_classes_in_splits: bool = True,
     verbose: bool = False,
+    seed: int = 0,
+    trials_per_batch: int = 256,
 ) -> Tuple[Subset, Subset]:
     """Split dataset.
 
+    Every trial is a random order of subjects, trials are scored in batches from a subject x class
+    count matrix. The best split depends only on the seed and the number of trials.
+
     Args:
         dataset: complete Dataset
         train_share: share of the train part
@@ -249,54 +484,49 @@ def split_dataset(
         n_split_trials: number of dataset split trials, basically number of data shuffles
         ensure_all_classes_in_splits: check whether objects of all classes are present in both test and train part
         verbose: show info about the best obtained train/test split
+        seed: seed of the subject shuffles
+        trials_per_batch: number of split trials scored at once
 
     Returns:
         train_subset: train subset
         test_subset: test subset
 
     """
-    rmsd_min = np.inf
-    best_train_subjects_set = None
-    best_test_subjects_set = None
-    best_class_distribution = None
-
-    for i in range(n_split_trials):
-        # shuffle df and split into two subsets based on Subject IDs
-        # since we avoid putting images from the same patient both in train and test sets
-        grouped = (
-            metadata_df.sample(frac=1.0, random_state=i)
-            .reset_index(drop=True)
-            .groupby('Subject ID', sort=False)['Image path']
-            .nunique()
-            .cumsum()
-            .transform(lambda s: s / s.max())
-        )
-
-        train_subjects = grouped[grouped < train_share].index
-        test_subjects = grouped[grouped >= train_share].index
-
-        dfc = metadata_df.copy()
-        dfc.loc[dfc['Subject ID'].isin(train_subjects), 'train_test_set'] = 'train'
-        dfc.loc[dfc['Subject ID'].isin(test_subjects), 'train_test_set'] = 'test'
+    # we avoid putting images from the same patient both in train and test sets,
+    # so subjects are counted once and split as a whole
+    row_subjects, subjects = pd.factorize(metadata_df['Subject ID'])
+    row_classes, classes = pd.factorize(metadata_df['Class ID'], sort=True)
+    is_labeled = (row_subjects >= 0) & (row_classes >= 0)
+    subject_classes = np.zeros((subjects.size, classes.size), dtype=np.int64)
+    np.add.at(subject_classes, (row_subjects[is_labeled], row_classes[is_labeled]), 1)
+    subject_images = (
+        metadata_df.groupby(row_subjects)['Image path']
+        .nunique()
+        .reindex(range(subjects.size), fill_value=0)
+        .to_numpy()
+    )
 
-        dfc_percentages = (
-            dfc.groupby('train_test_set')['Class ID'].value_counts(normalize=True).unstack()
+    # the generator is consumed row by row, so the shuffles do not depend on trials_per_batch
+    rng = np.random.default_rng(seed)
+    rmsd_min = np.inf
+    best_train_mask = None
+    for first_trial in range(0, n_split_trials, trials_per_batch):
+        num_trials = min(trials_per_batch, n_split_trials - first_trial)
+        subject_orders = rng.permuted(np.tile(np.arange(subjects.size), (num_trials, 1)), axis=1)
+        train_masks, rmsd = _score_split_trials(
+            subject_orders=subject_orders,
+            subject_images=subject_images,
+            subject_classes=subject_classes,
+            train_share=train_share,
+            ensure_all_classes_in_splits=ensure_all_classes_in_splits,
         )
+        # the earliest trial wins a tie
+        best_idx = np.argmin(rmsd)
+        if rmsd[best_idx] < rmsd_min:
+            rmsd_min = rmsd[best_idx]
+            best_train_mask = train_masks[best_idx]
 
-        if ensure_all_classes_in_splits:
-            # if there is any NAN, it means that the two splits do not contain all classes
-            if dfc_percentages.isna().any().any():
-                continue
-
-        # RMSD between class shares in train/test splits
-        rmsd_classes = np.sum((dfc_percentages.loc['train'] - dfc_percentages.loc['test']) ** 2)
-
-        if rmsd_classes < rmsd_min:
-            rmsd_min = rmsd_classes
-            best_train_subjects_set, best_test_subjects_set = train_subjects, test_subjects
-            best_class_distribution = dfc_percentages
-
-    if best_class_distribution is None:
+    if best_train_mask is None:
         raise RuntimeError(
             (
                 f'{n_split_trials} split trials were not enough to split dataset. '
@@ -304,6 +534,8 @@ def split_dataset(
                 'or set ensure_all_classes_in_splits to False'
             ),
         )
+    best_train_subjects_set = subjects[best_train_mask]
+    best_test_subjects_set = subjects[~best_train_mask]
 
     # we need image indices but we have split the dataset using patients (through Subject IDs)
     # so here we obtain indices of images belonging to patients in train/test splits
@@ -324,7 +556,19 @@ def split_dataset(
         print('#' * 80)
         print('Best train/test split class distributions:')
         print('#' * 80)
-        print(best_class_distribution)
+        best_class_counts = np.stack(
+            [
+                subject_classes[~best_train_mask].sum(axis=0),
+                subject_classes[best_train_mask].sum(axis=0),
+            ],
+        )
+        print(
+            pd.DataFrame(
+                best_class_counts / best_class_counts.sum(axis=1, keepdims=True),
+                index=pd.Index(['test', 'train'], name='train_test_set'),
+                columns=pd.Index(classes, name='Class ID'),
+            ),
+        )
         print('#' * 80)
         print(
             (
@@ -1,6 +1,5 @@
 import logging
 import os
-import shutil
 from functools import partial
 from pathlib import Path
 from typing import Tuple
@@ -11,6 +10,8 @@ from joblib import Parallel, delayed
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
+from src.data.utils import materialize_files
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
@@ -39,42 +40,20 @@ def process_single_study(
         and ('LL' in study_views)
     )
 
-    # Save paired images of a study
+    # Skip unpaired studies, images of the others are materialized at once in main
+    if save_pairs_only and not (is_correct_view and len(df_study) == 2):
+        return pd.DataFrame([])
+
     study_dir = os.path.join(save_dir, 'files', f'{subject_id}', f'{study_id}')
-    if save_pairs_only:
-        if is_correct_view and len(df_study) == 2:
-            os.makedirs(study_dir, exist_ok=True)
-            for idx, _src_path in df_study['Image path'].iteritems():
-                src_path = os.path.join(dataset_dir, _src_path)
-                img_name = Path(src_path).name
-                dst_path = os.path.join(study_dir, img_name)
-                _dst_path = os.path.relpath(dst_path, start=save_dir)
-                df_study.at[idx, 'Image path'] = _dst_path
-                df_study.at[idx, 'Image name'] = img_name
-                try:
-                    shutil.copy(src_path, dst_path)
-                except Exception:
-                    log.info(f'Error occurred while copying {img_name}')
-            return df_study
-
-        else:
-            return pd.DataFrame([])
-
-    # Save all images of a study
-    else:
-        os.makedirs(study_dir, exist_ok=True)
-        for idx, _src_path in df_study['Image path'].iteritems():
-            src_path = os.path.join(dataset_dir, _src_path)
-            img_name = Path(src_path).name
-            dst_path = os.path.join(study_dir, img_name)
-            _dst_path = os.path.relpath(dst_path, start=save_dir)
-            df_study.at[idx, 'Image path'] = _dst_path
-            df_study.at[idx, 'Image name'] = img_name
-            try:
-                shutil.copy(src_path, dst_path)
-            except Exception:
-                log.info(f'Error occurred while copying {img_name}')
-        return df_study
+    for idx, _src_path in df_study['Image path'].items():
+        src_path = os.path.join(dataset_dir, _src_path)
+        img_name = Path(src_path).name
+        dst_path = os.path.join(study_dir, img_name)
+        _dst_path = os.path.relpath(dst_path, start=save_dir)
+        df_study.at[idx, 'Source path'] = src_path
+        df_study.at[idx, 'Image path'] = _dst_path
+        df_study.at[idx, 'Image name'] = img_name
+    return df_study
 
 
 @hydra.main(
@@ -90,6 +69,8 @@ def main(cfg: DictConfig) -> None:
         dataset_dir: a path to the MIMIC-CXR dataset
         finding: one of the findings to be extracted
         save_pairs_only: if True, save only the paired cases (frontal and lateral images)
+        materialize_mode: hardlink, symlink, reflink or copy, falls back to copy if not supported
+        num_workers: number of threads used to materialize images
         save_dir: directory where the output files will be saved
     Returns:
         None
@@ -97,6 +78,7 @@ def main(cfg: DictConfig) -> None:
     log.info(f'Dataset dir...............: {cfg.dataset_dir}')
     log.info(f'Finding...................: {cfg.finding}')
     log.info(f'Save pairs only...........: {cfg.save_pairs_only}')
+    log.info(f'Materialization mode......: {cfg.materialize_mode}')
     log.info(f'Save dir..................: {cfg.save_dir}')
 
     # Read the source data frame and filter it by the required disease
@@ -118,6 +100,15 @@ def main(cfg: DictConfig) -> None:
     )
     df_out = pd.concat(result)
     df_out.reset_index(drop=True, inplace=True)
+
+    # Link or copy images of the subset, unchanged ones are skipped
+    materialize_files(
+        src_paths=list(df_out['Source path']),
+        dst_paths=[os.path.join(cfg.save_dir, path) for path in df_out['Image path']],
+        mode=cfg.materialize_mode,
+        num_workers=cfg.num_workers,
+    )
+    df_out.drop(columns='Source path', inplace=True)
     df_out.sort_values(['Subject ID', 'ID'], inplace=True)
     save_path = os.path.join(cfg.save_dir, 'metadata.csv')
     df_out.to_csv(
@@ -1,14 +1,17 @@
 import logging
-import multiprocessing
 import os
 import shutil
+import struct
 import warnings
-from functools import partial
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
+from omegaconf import OmegaConf
 from tqdm import tqdm
 
 
@@ -42,32 +45,323 @@ def get_file_list(
     return all_files
 
 
-def copy_single_file(
-    file_path: str,
-    save_dir: str,
+# Materialization modes in the order of preference used when a mode is not supported
+MATERIALIZE_FALLBACKS = {
+    'hardlink': ['hardlink', 'reflink', 'copy'],
+    'symlink': ['symlink', 'copy'],
+    'reflink': ['reflink', 'copy'],
+    'copy': ['copy'],
+}
+_FICLONE = 0x40049409  # Linux ioctl cloning a file on copy-on-write filesystems (Btrfs, XFS)
+
+
+def _reflink(
+    src_path: str,
+    dst_path: str,
 ) -> None:
     try:
-        shutil.copy(file_path, save_dir)
-    except Exception as e:
-        logging.info(f'Exception: {e}\nCould not copy {file_path}')
+        import fcntl
+    except ImportError:
+        raise OSError('Reflinks are not supported on this platform')
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(dst_path)
+            raise
+    shutil.copystat(src_path, dst_path)
+
+
+def _is_materialized(
+    src_path: str,
+    dst_path: str,
+) -> bool:
+    # Links point to the source itself, copies keep its size and modification time
+    try:
+        if os.path.samefile(src_path, dst_path):
+            return True
+        src_stat, dst_stat = os.stat(src_path), os.stat(dst_path)
+    except OSError:
+        return False
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def materialize_file(
+    src_path: str,
+    dst_path: str,
+    mode: str = 'hardlink',
+) -> str:
+    """Make a file available at a new path without duplicating its bytes where possible.
+
+    If the filesystem does not support the requested mode (e.g. hardlinks across devices), the
+    next mode of MATERIALIZE_FALLBACKS is tried. A destination that already refers to the same
+    content is left untouched. Note that hardlinked and reflinked files must not be modified in
+    place, as this would also change the source file.
+
+    Args:
+        src_path: a path to the source file
+        dst_path: a path where the file is materialized
+        mode: one of hardlink, symlink, reflink or copy
+    Returns:
+        mode_used: the mode that has been used or 'skip' if the destination is up to date
+    """
+    if mode not in MATERIALIZE_FALLBACKS:
+        raise ValueError(f'Unknown materialization mode: {mode}')
+
+    if _is_materialized(src_path, dst_path):
+        return 'skip'
+
+    # Never write into an existing destination, it may be a link to another file
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+
+    error = None
+    for mode_ in MATERIALIZE_FALLBACKS[mode]:
+        try:
+            if mode_ == 'hardlink':
+                os.link(src_path, dst_path)
+            elif mode_ == 'symlink':
+                os.symlink(os.path.abspath(src_path), dst_path)
+            elif mode_ == 'reflink':
+                _reflink(src_path, dst_path)
+            else:
+                shutil.copy2(src_path, dst_path)
+            return mode_
+        except OSError as e:
+            error = e
+
+    raise error  # type: ignore
+
+
+def materialize_files(
+    src_paths: List[str],
+    dst_paths: List[str],
+    mode: str = 'hardlink',
+    num_workers: int = 8,
+) -> Dict[str, int]:
+    """Materialize files in a thread pool since the work is I/O-bound.
+
+    Args:
+        src_paths: paths to the source files
+        dst_paths: paths where the files are materialized
+        mode: one of hardlink, symlink, reflink or copy
+        num_workers: number of threads
+    Returns:
+        mode_counts: number of files per used mode, 'error' counts files that were not materialized
+    """
+
+    def _materialize(paths: Tuple[str, str]) -> str:
+        src_path, dst_path = paths
+        try:
+            os.makedirs(os.path.dirname(dst_path) or '.', exist_ok=True)
+            return materialize_file(src_path, dst_path, mode)
+        except Exception as e:
+            logging.info(f'Exception: {e}\nCould not materialize {src_path}')
+            return 'error'
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        modes_used = list(
+            tqdm(
+                executor.map(_materialize, zip(src_paths, dst_paths)),
+                total=len(src_paths),
+                desc='Materialize files',
+                unit=' files',
+            ),
+        )
+    mode_counts = dict(Counter(modes_used))
+    logging.info(f'Materialized files: {mode_counts}')
+
+    return mode_counts
 
 
 def copy_files(
     file_list: List[str],
     save_dir: str,
-) -> None:
+    mode: str = 'copy',
+    num_workers: int = 8,
+) -> Dict[str, int]:
     os.makedirs(save_dir) if not os.path.isdir(save_dir) else False
-    num_cores = multiprocessing.cpu_count()
-    pool = multiprocessing.Pool(num_cores)
-    copy_func = partial(
-        copy_single_file,
-        save_dir=save_dir,
+    mode_counts = materialize_files(
+        src_paths=file_list,
+        dst_paths=[os.path.join(save_dir, os.path.basename(path)) for path in file_list],
+        mode=mode,
+        num_workers=num_workers,
     )
-    pool.map(
-        copy_func,
-        tqdm(file_list, desc='Copy files', unit=' files'),
+
+    return mode_counts
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start-of-frame markers carrying the image size (DHT, JPG and DAC markers excluded)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_APP1_MARKER = 0xE1
+# EXIF orientations that rotate an image by 90 degrees and swap its height and width
+JPEG_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def probe_image_size(
+    img_path: str,
+) -> Tuple[int, int]:
+    """Get the height and width of an image without decoding its pixels.
+
+    PNG, JPEG and BMP headers are parsed directly, other formats are decoded with OpenCV. JPEG
+    images with an EXIF orientation that swaps the axes (5-8) are decoded as well, so the size is
+    the same as that of the image read by cv2.imread. Results are cached by path, modification
+    time and size, so a rewritten file is probed again.
+
+    Args:
+        img_path: a path to the image
+    Returns:
+        height and width of the image
+    """
+    stat = os.stat(img_path)
+    return _probe_image_size(img_path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=2**16)
+def _probe_image_size(
+    img_path: str,
+    mtime_ns: int,
+    file_size: int,
+) -> Tuple[int, int]:
+    with open(img_path, 'rb') as file:
+        header = file.read(26)
+        size = None
+        flags = cv2.IMREAD_UNCHANGED
+        if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', header[16:24])
+            size = height, width
+        elif header[:2] == b'BM' and len(header) == 26:
+            # BITMAPCOREHEADER (12 bytes) stores 16-bit sizes, later versions 32-bit signed ones
+            if struct.unpack('<I', header[14:18])[0] == 12:
+                width, height = struct.unpack('<HH', header[18:22])
+            else:
+                width, height = struct.unpack('<ii', header[18:26])
+            size = abs(height), width
+        elif header[:2] == b'\xff\xd8':
+            file.seek(2)
+            size, orientation = _read_jpeg_size(file)
+            if orientation in JPEG_TRANSPOSED_ORIENTATIONS:
+                # cv2.imread rotates such images, IMREAD_UNCHANGED would ignore the orientation
+                size = None
+                flags = cv2.IMREAD_COLOR
+
+    if size is None:
+        img = cv2.imread(img_path, flags)
+        if img is None:
+            raise ValueError(f'Could not read image size of {img_path}')
+        size = img.shape[:2]
+
+    return int(size[0]), int(size[1])
+
+
+def _read_jpeg_size(
+    file: BinaryIO,
+) -> Tuple[Optional[Tuple[int, int]], Optional[int]]:
+    # Walk over the segments until a start-of-frame one is found, EXIF precedes it
+    orientation = None
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None, orientation
+        if marker[1] == 0xFF:  # Fill byte
+            file.seek(-1, os.SEEK_CUR)
+            continue
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD9:  # Segments without a length
+            continue
+        segment = file.read(2)
+        if len(segment) < 2:
+            return None, orientation
+        segment_length = struct.unpack('>H', segment)[0]
+        if marker[1] in JPEG_SOF_MARKERS:
+            # Sample precision (1 byte), height (2) and width (2)
+            data = file.read(5)
+            if len(data) < 5:
+                return None, orientation
+            height, width = struct.unpack('>HH', data[1:5])
+            return (height, width), orientation
+        if marker[1] == JPEG_APP1_MARKER and orientation is None:
+            orientation = _read_exif_orientation(file.read(segment_length - 2))
+            continue
+        file.seek(segment_length - 2, os.SEEK_CUR)
+
+
+def _read_exif_orientation(
+    data: bytes,
+) -> Optional[int]:
+    # APP1 holds 'Exif\0\0' and a TIFF structure, the orientation is an entry of its first IFD
+    if data[:6] != b'Exif\x00\x00' or len(data) < 14:
+        return None
+    tiff = data[6:]
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None:
+        return None
+    ifd_offset = struct.unpack(byte_order + 'I', tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return None
+    num_entries = struct.unpack(byte_order + 'H', tiff[ifd_offset : ifd_offset + 2])[0]
+    for entry_idx in range(num_entries):
+        entry_offset = ifd_offset + 2 + 12 * entry_idx
+        entry = tiff[entry_offset : entry_offset + 12]
+        if len(entry) < 12:
+            return None
+        tag, _, _, value = struct.unpack(byte_order + 'HHIH', entry[:10])
+        if tag == EXIF_ORIENTATION_TAG:
+            return value
+    return None
+
+
+def load_conf_thresholds(
+    thresholds_path: str,
+    model_name: str,
+) -> Dict[str, float]:
+    """Load per-feature confidence thresholds of a detection model.
+
+    Args:
+        thresholds_path: a path to the YAML file with per-model thresholds
+        model_name: name of the detection model (e.g. SABL)
+    Returns:
+        conf_thresholds: a dictionary mapping feature names to confidence thresholds
+    """
+    thresholds = OmegaConf.load(thresholds_path)
+    if model_name not in thresholds:
+        raise ValueError(f'No confidence thresholds for {model_name} in {thresholds_path}')
+    conf_thresholds = {
+        feature: float(threshold) for feature, threshold in thresholds[model_name].items()
+    }
+    return conf_thresholds
+
+
+def save_conf_thresholds(
+    conf_thresholds: Dict[str, float],
+    thresholds_path: str,
+    model_name: str,
+) -> None:
+    """Save per-feature confidence thresholds of a detection model.
+
+    Thresholds of other models and features stored in the same file are preserved.
+
+    Args:
+        conf_thresholds: a dictionary mapping feature names to confidence thresholds
+        thresholds_path: a path to the YAML file with per-model thresholds
+        model_name: name of the detection model (e.g. SABL)
+    Returns:
+        None
+    """
+    if os.path.isfile(thresholds_path):
+        thresholds = OmegaConf.to_container(OmegaConf.load(thresholds_path))
+    else:
+        thresholds = {}
+    model_thresholds = thresholds.get(model_name, {})
+    model_thresholds.update(
+        {feature: float(threshold) for feature, threshold in conf_thresholds.items()},
     )
-    pool.close()
+    thresholds[model_name] = model_thresholds
+    save_dir = os.path.dirname(thresholds_path)
+    os.makedirs(save_dir, exist_ok=True) if save_dir else False
+    OmegaConf.save(config=OmegaConf.create(thresholds), f=thresholds_path)
 
 
 def convert_seconds_to_hms(
@@ -0,0 +1,190 @@
+import math
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugmentation(torch.nn.Module):
+    """Random photometric and geometric augmentation of whole batches of images and masks.
+
+    The transforms are sampled per image but applied to the batch at once on the device the batch
+    lives on. Photometric transforms (brightness/contrast, gamma, Gaussian blur) follow the
+    albumentations transforms of the same names and only change images. Geometric transforms
+    (rotation, scaling, shift) share one sampling grid for an image and its masks, images are
+    interpolated bilinearly and masks with the nearest neighbour. Areas outside of the image are
+    filled with zeros in images and with the per-image fill value in masks, the same as the
+    padding of EdemaDataset (default_mask_value of make_masks).
+    """
+
+    def __init__(
+        self,
+        brightness_limit: float = 0.2,
+        contrast_limit: float = 0.2,
+        brightness_contrast_p: float = 0.5,
+        gamma_limit: Tuple[float, float] = (80, 120),
+        gamma_p: float = 0.5,
+        blur_sigma_limit: Tuple[float, float] = (0.3, 1.4),
+        blur_kernel_size: int = 7,
+        blur_p: float = 0.2,
+        rotate_limit: float = 10.0,
+        scale_limit: float = 0.1,
+        shift_limit: float = 0.05,
+        affine_p: float = 0.5,
+    ) -> None:
+        """Batch augmentation.
+
+        Args:
+            brightness_limit: maximum brightness change, as a share of the [0, 1] intensity range
+            contrast_limit: maximum relative contrast change
+            brightness_contrast_p: probability of changing brightness and contrast
+            gamma_limit: range of gamma values multiplied by 100
+            gamma_p: probability of gamma correction
+            blur_sigma_limit: range of sigma values of the Gaussian blur in pixels
+            blur_kernel_size: odd size of the Gaussian kernel
+            blur_p: probability of blurring
+            rotate_limit: maximum rotation angle in degrees
+            scale_limit: maximum relative scale change
+            shift_limit: maximum shift as a share of the image size
+            affine_p: probability of the geometric transform
+        """
+        super().__init__()
+        assert blur_kernel_size % 2 == 1, 'blur_kernel_size must be odd'
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.brightness_contrast_p = brightness_contrast_p
+        self.gamma_limit = gamma_limit
+        self.gamma_p = gamma_p
+        self.blur_sigma_limit = blur_sigma_limit
+        self.blur_kernel_size = blur_kernel_size
+        self.blur_p = blur_p
+        self.rotate_limit = rotate_limit
+        self.scale_limit = scale_limit
+        self.shift_limit = shift_limit
+        self.affine_p = affine_p
+
+    def forward(
+        self,
+        images: torch.Tensor,
+        masks: torch.Tensor,
+        mask_fill: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Augment a batch.
+
+        Args:
+            images: float images (batch, C, H, W) with values in [0, 1]
+            masks: masks (batch, num_masks, H, W) of any dtype
+            mask_fill: values (batch) of masks outside of the image, 1 for images with edema
+                findings and 0 otherwise, zeros if not set
+
+        Returns:
+            images: augmented images
+            masks: masks transformed with the same geometry as the images, of the same dtype
+        """
+        images = self.adjust_brightness_contrast(images)
+        images = self.adjust_gamma(images)
+        images = self.blur(images)
+        images, masks = self.transform_geometry(images, masks, mask_fill)
+
+        return images, masks
+
+    def _sample(
+        self,
+        images: torch.Tensor,
+        limits: Tuple[float, float],
+        p: float,
+        identity: float,
+    ) -> torch.Tensor:
+        # uniform values of limits, identity for the images that are not transformed
+        low, high = limits
+        values = torch.empty(len(images), device=images.device).uniform_(low, high)
+        is_applied = torch.rand(len(images), device=images.device) < p
+        return torch.where(is_applied, values, torch.full_like(values, identity))
+
+    def adjust_brightness_contrast(
+        self,
+        images: torch.Tensor,
+    ) -> torch.Tensor:
+        p = self.brightness_contrast_p
+        alpha = self._sample(images, (-self.contrast_limit, self.contrast_limit), p, 0.0) + 1
+        beta = self._sample(images, (-self.brightness_limit, self.brightness_limit), p, 0.0)
+        images = images * alpha.view(-1, 1, 1, 1) + beta.view(-1, 1, 1, 1)
+        return images.clamp(0, 1)
+
+    def adjust_gamma(
+        self,
+        images: torch.Tensor,
+    ) -> torch.Tensor:
+        gamma_limit = (self.gamma_limit[0] / 100, self.gamma_limit[1] / 100)
+        gamma = self._sample(images, gamma_limit, self.gamma_p, 1.0)
+        return images.clamp(min=0) ** gamma.view(-1, 1, 1, 1)
+
+    def blur(
+        self,
+        images: torch.Tensor,
+    ) -> torch.Tensor:
+        sigma = self._sample(images, self.blur_sigma_limit, self.blur_p, 0.0)
+        if not torch.any(sigma > 0):
+            return images
+
+        # a separable kernel per image, a zero sigma gives the identity kernel
+        batch_size, num_channels, height, width = images.shape
+        radius = self.blur_kernel_size // 2
+        offsets = torch.arange(-radius, radius + 1, device=images.device, dtype=images.dtype)
+        exponent = -(offsets**2) / (2 * sigma.to(images.dtype).clamp(min=1e-6).view(-1, 1) ** 2)
+        kernels = torch.exp(exponent)
+        kernels = kernels / kernels.sum(dim=1, keepdim=True)
+        kernels = kernels.repeat_interleave(num_channels, dim=0)
+
+        # every channel of every image is convolved with its own kernel in one grouped conv
+        images = images.reshape(1, batch_size * num_channels, height, width)
+        groups = batch_size * num_channels
+        images = F.pad(images, (radius, radius, radius, radius), mode='reflect')
+        images = F.conv2d(images, kernels.view(groups, 1, 1, -1), groups=groups)
+        images = F.conv2d(images, kernels.view(groups, 1, -1, 1), groups=groups)
+
+        return images.reshape(batch_size, num_channels, height, width)
+
+    def transform_geometry(
+        self,
+        images: torch.Tensor,
+        masks: torch.Tensor,
+        mask_fill: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        p = self.affine_p
+        angle = self._sample(images, (-self.rotate_limit, self.rotate_limit), p, 0.0)
+        scale = self._sample(images, (1 - self.scale_limit, 1 + self.scale_limit), p, 1.0)
+        shift_x = self._sample(images, (-self.shift_limit, self.shift_limit), p, 0.0)
+        shift_y = self._sample(images, (-self.shift_limit, self.shift_limit), p, 0.0)
+        if not torch.any((angle != 0) | (scale != 1) | (shift_x != 0) | (shift_y != 0)):
+            return images, masks
+
+        # theta maps output to input coordinates normalized to [-1, 1], the aspect ratio keeps
+        # rotations of non-square images free of shear
+        height, width = images.shape[2:]
+        radians = angle * math.pi / 180
+        cos, sin = torch.cos(radians) / scale, torch.sin(radians) / scale
+        theta = torch.stack(
+            [
+                torch.stack([cos, -sin * height / width, 2 * shift_x], dim=1),
+                torch.stack([sin * width / height, cos, 2 * shift_y], dim=1),
+            ],
+            dim=1,
+        )
+        grid = F.affine_grid(theta.to(images.dtype), list(images.shape), align_corners=False)
+        images = F.grid_sample(images, grid, mode='bilinear', align_corners=False)
+
+        # grid_sample pads with zeros, the fill is subtracted before sampling and added back, so
+        # the pixels outside of the image get the fill value of their image
+        if mask_fill is None:
+            mask_fill = torch.zeros(len(masks), device=masks.device)
+        mask_fill = mask_fill.to(grid.dtype).view(-1, 1, 1, 1)
+        masks_transformed = F.grid_sample(
+            masks.to(grid.dtype) - mask_fill,
+            grid,
+            mode='nearest',
+            align_corners=False,
+        )
+        masks_transformed = masks_transformed + mask_fill
+
+        return images, masks_transformed.to(masks.dtype)
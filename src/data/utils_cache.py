@@ -0,0 +1,313 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+import src.data.data_classes_utils as data_classes_utils
+import src.data.utils_rle as utils_rle
+import src.data.utils_sly as utils_sly
+from src.data.data_classes_utils import (
+    EDEMA_FINDINGS,
+    create_resized_masks,
+    extract_annotations,
+    get_resize_transform,
+    pack_masks,
+    unpack_masks,
+)
+from src.data.utils import probe_image_size
+from src.data.utils_manifest import MANIFEST_VERSION, hash_sources
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+INDEX_NAME = 'index.parquet'
+INFO_NAME = 'cache_info.json'
+IMAGES_NAME = 'images.npy'
+MASKS_NAME = 'masks.npy'
+FINDINGS_NAME = 'findings.npy'
+NUM_MASKS = len(EDEMA_FINDINGS) + 1  # 'No_findings' and edema findings
+# Metadata columns the cached images, masks and findings are made from
+CACHED_COLUMNS = ['Image path', 'Class', 'Class ID', 'Feature', 'x1', 'y1', 'Mask', 'Points']
+
+
+def get_cache_dir(
+    cache_root: str,
+    target_size: Tuple[int, int],
+) -> str:
+    """Get the directory of a cache built for the target size (width, height)."""
+    width, height = target_size
+    return os.path.join(cache_root, f'{width}x{height}')
+
+
+def hash_metadata(
+    metadata_df: pd.DataFrame,
+) -> str:
+    """Compute the SHA-256 hash of the metadata columns the cache is made from."""
+    columns = [column for column in CACHED_COLUMNS if column in metadata_df.columns]
+    scalar_columns = [column for column in columns if column != 'Points']
+    hasher = hashlib.sha256()
+    row_hashes = pd.util.hash_pandas_object(metadata_df[scalar_columns], index=False)
+    hasher.update(row_hashes.to_numpy().tobytes())
+    # Points are int32 arrays, their repr would be truncated, so their bytes are hashed
+    for points in metadata_df.get('Points', []):
+        points = points if isinstance(points, np.ndarray) else np.zeros((0, 2), dtype=np.int32)
+        hasher.update(np.int64(points.size).tobytes())
+        hasher.update(np.ascontiguousarray(points).tobytes())
+    return hasher.hexdigest()
+
+
+def get_cache_info(
+    metadata_df: pd.DataFrame,
+    target_size: Tuple[int, int],
+    linelike_finding_width: int = 15,
+) -> Dict[str, Any]:
+    """Describe the data and the settings a cache is built from.
+
+    A cache is only used if its description matches that of the dataset, see DatasetCache.
+
+    Args:
+        metadata_df: metadata of the images
+        target_size: tuple with target image size (width, height)
+        linelike_finding_width: width in pixels for linelike annotations
+    Returns:
+        info: hashes of the metadata and of the code making masks, and the build settings
+    """
+    return {
+        'version': MANIFEST_VERSION,
+        'metadata_hash': hash_metadata(metadata_df),
+        'sources_hash': hash_sources([__file__, data_classes_utils, utils_rle, utils_sly]),
+        'target_size': list(target_size),
+        'linelike_finding_width': linelike_finding_width,
+    }
+
+
+def read_resized_image(
+    img_path: str,
+    target_size: Tuple[int, int],
+) -> np.ndarray:
+    """Read an RGB image and resize it to the target size (width, height) keeping aspect ratio.
+
+    Returns:
+        image: uint8 array (height, width, 3) padded with 0, aligned with create_resized_masks
+    """
+    image = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+    img_height, img_width = image.shape[:2]
+    transform = get_resize_transform((img_width, img_height), target_size)
+    return transform(image=image)['image']
+
+
+def _cache_chunk(
+    chunk: List[Tuple[int, str, pd.DataFrame]],
+    cache_dir: str,
+    target_size: Tuple[int, int],
+    linelike_finding_width: int,
+) -> None:
+    # Workers write their rows directly into the memory-mapped arrays
+    images_cache = np.load(os.path.join(cache_dir, IMAGES_NAME), mmap_mode='r+')
+    masks_cache = np.load(os.path.join(cache_dir, MASKS_NAME), mmap_mode='r+')
+    findings_cache = np.load(os.path.join(cache_dir, FINDINGS_NAME), mmap_mode='r+')
+    for img_idx, img_path, img_objects in chunk:
+        image = read_resized_image(img_path, target_size)
+        img_height, img_width = probe_image_size(img_path)
+        masks, findings = create_resized_masks(
+            image_size=(img_width, img_height),
+            annotations=extract_annotations(img_objects),
+            target_size=target_size,
+            linelike_finding_width=linelike_finding_width,
+        )
+        images_cache[img_idx] = image
+        masks_cache[img_idx] = pack_masks(masks)
+        findings_cache[img_idx] = findings
+    images_cache.flush()
+    masks_cache.flush()
+    findings_cache.flush()
+
+
+def build_dataset_cache(
+    metadata_df: pd.DataFrame,
+    cache_dir: str,
+    target_size: Tuple[int, int],
+    linelike_finding_width: int = 15,
+    num_workers: int = -1,
+    chunk_size: int = 16,
+) -> None:
+    """Resize the images and rasterize their finding masks once and store them in memory maps.
+
+    Images are indexed in the order EdemaDataset enumerates them. An image is stored as a uint8
+    row of shape (height, width, 3), its masks are stored bit-packed as a row of shape
+    (NUM_MASKS, ceil(height * width / 8)).
+
+    Args:
+        metadata_df: metadata of the images
+        cache_dir: directory where the cache is saved
+        target_size: tuple with target image size (width, height)
+        linelike_finding_width: width in pixels for linelike annotations
+        num_workers: number of processes, -1 uses all cores
+        chunk_size: number of images processed by a worker per task
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # A previous cache is invalidated before its arrays are overwritten, the index and the info
+    # are written again when the build completes
+    for name in [INDEX_NAME, INFO_NAME]:
+        if os.path.isfile(os.path.join(cache_dir, name)):
+            os.remove(os.path.join(cache_dir, name))
+    groups = [
+        (img_idx, img_path, img_objects)
+        for img_idx, (img_path, img_objects) in enumerate(
+            metadata_df.groupby('Image path', sort=False),
+        )
+    ]
+    width, height = target_size
+    num_bytes = (height * width + 7) // 8
+    np.lib.format.open_memmap(
+        os.path.join(cache_dir, IMAGES_NAME),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(len(groups), height, width, 3),
+    ).flush()
+    np.lib.format.open_memmap(
+        os.path.join(cache_dir, MASKS_NAME),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(len(groups), NUM_MASKS, num_bytes),
+    ).flush()
+    np.lib.format.open_memmap(
+        os.path.join(cache_dir, FINDINGS_NAME),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(len(groups), NUM_MASKS),
+    ).flush()
+
+    chunks = [groups[idx : idx + chunk_size] for idx in range(0, len(groups), chunk_size)]
+    Parallel(n_jobs=num_workers)(
+        delayed(_cache_chunk)(
+            chunk=chunk,
+            cache_dir=cache_dir,
+            target_size=tuple(target_size),
+            linelike_finding_width=linelike_finding_width,
+        )
+        for chunk in tqdm(chunks, desc='Caching dataset', unit=' chunks')
+    )
+
+    # The index is written last, so an interrupted build is not picked up by the dataset
+    info = get_cache_info(metadata_df, target_size, linelike_finding_width)
+    with open(os.path.join(cache_dir, INFO_NAME), 'w') as file:
+        json.dump(info, file, indent=2)
+    df_index = pd.DataFrame({'Image path': [img_path for _, img_path, _ in groups]})
+    df_index.to_parquet(os.path.join(cache_dir, INDEX_NAME))
+
+
+class DatasetCache:
+    """Read-only access to the arrays cached for a dataset.
+
+    The arrays are memory-mapped on first access, so a cache can be passed to DataLoader workers
+    and every worker maps the files itself.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        target_size: Tuple[int, int],
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.target_size = target_size
+        df_index = pd.read_parquet(os.path.join(cache_dir, INDEX_NAME))
+        self.index: Dict[str, int] = {
+            img_path: img_idx for img_idx, img_path in enumerate(df_index['Image path'])
+        }
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_dir(
+        cls,
+        cache_root: Optional[str],
+        target_size: Tuple[int, int],
+        metadata_df: Optional[pd.DataFrame] = None,
+        linelike_finding_width: int = 15,
+    ) -> Optional['DatasetCache']:
+        """Open a cache built for the target size if it exists and is up to date.
+
+        Args:
+            cache_root: directory with caches built by src/data/cache_dataset.py
+            target_size: tuple with target image size (width, height)
+            metadata_df: metadata of the dataset, if set the cache is ignored when it was built
+                from other metadata, settings or code
+            linelike_finding_width: width in pixels for linelike annotations used by the dataset
+        Returns:
+            cache: the cache or None if there is no usable cache
+        """
+        if cache_root is None:
+            return None
+        cache_dir = get_cache_dir(cache_root, target_size)
+        if not os.path.isfile(os.path.join(cache_dir, INDEX_NAME)):
+            return None
+
+        if metadata_df is not None:
+            info_path = os.path.join(cache_dir, INFO_NAME)
+            info = {}
+            if os.path.isfile(info_path):
+                with open(info_path) as file:
+                    info = json.load(file)
+            expected_info = get_cache_info(metadata_df, target_size, linelike_finding_width)
+            mismatched_keys = [key for key in expected_info if info.get(key) != expected_info[key]]
+            if mismatched_keys:
+                log.warning(
+                    f'Cache {cache_dir} is ignored as out of date: {", ".join(mismatched_keys)}. '
+                    'Rebuild it with src/data/cache_dataset.py',
+                )
+                return None
+
+        return cls(cache_dir, target_size)
+
+    def __getstate__(self) -> dict:
+        # Memory maps are not sent to workers
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _get_array(
+        self,
+        name: str,
+    ) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.cache_dir, name), mmap_mode='r')
+        return self._arrays[name]
+
+    def _get_index(
+        self,
+        img_path: str,
+    ) -> int:
+        try:
+            return self.index[img_path]
+        except KeyError:
+            raise KeyError(f'{img_path} is not cached in {self.cache_dir}, rebuild the cache')
+
+    def get_image(
+        self,
+        img_path: str,
+    ) -> np.ndarray:
+        """Get a uint8 RGB image (height, width, 3) resized to the target size."""
+        return np.array(self._get_array(IMAGES_NAME)[self._get_index(img_path)])
+
+    def get_masks(
+        self,
+        img_path: str,
+        packed: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Get uint8 masks (NUM_MASKS, height, width) and findings of an image.
+
+        If packed is set, the masks are returned bit-packed (NUM_MASKS, ceil(height * width / 8)).
+        """
+        img_idx = self._get_index(img_path)
+        masks = np.array(self._get_array(MASKS_NAME)[img_idx])
+        if not packed:
+            masks = unpack_masks(masks, self.target_size)
+        findings = np.array(self._get_array(FINDINGS_NAME)[img_idx])
+        return masks, findings
@@ -1,16 +1,17 @@
 import os
 from typing import Any, Dict, List, Tuple, Union
 
-import cv2
 import pandas as pd
 
+from src.data.utils import probe_image_size
+
 
 def get_img_info(
     img_path: str,
     img_id: int,
 ) -> Dict[str, Any]:
     img_data: Dict[str, Union[int, str]] = {}
-    height, width = cv2.imread(img_path).shape[:2]
+    height, width = probe_image_size(img_path)
     img_data['id'] = img_id  # Unique image ID
     img_data['width'] = width
     img_data['height'] = height
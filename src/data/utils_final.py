@@ -1,14 +1,13 @@
 import hashlib
 import logging
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import albumentations as A
 import cv2
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from src.data.utils_sly import FEATURE_MAP_REVERSED, get_box_sizes
+from src.data.utils_sly import FEATURE_MAP, FEATURE_MAP_REVERSED, compute_box_sizes
 
 
 def get_bboxes(
@@ -65,17 +64,14 @@ def update_image_metadata(
 def update_bbox_metadata(
     df: pd.DataFrame,
 ) -> pd.DataFrame:
-    for idx in df.index:
-        box_sizes = get_box_sizes(
-            x1=df.at[idx, 'x1'],
-            y1=df.at[idx, 'y1'],
-            x2=df.at[idx, 'x2'],
-            y2=df.at[idx, 'y2'],
-        )
-        df.at[
-            idx,
-            ['xc', 'yc', 'Box width', 'Box height', 'Box ratio', 'Box area', 'Box label'],
-        ] = box_sizes
+    box_sizes = compute_box_sizes(
+        x1=pd.to_numeric(df['x1']).to_numpy(),
+        y1=pd.to_numeric(df['y1']).to_numpy(),
+        x2=pd.to_numeric(df['x2']).to_numpy(),
+        y2=pd.to_numeric(df['y2']).to_numpy(),
+    )
+    for column, values in box_sizes.items():
+        df[column] = values
     return df
 
 
@@ -83,70 +79,38 @@ def modify_box_geometry(
     df: pd.DataFrame,
     box_extension: dict,
 ) -> pd.DataFrame:
-    for idx in tqdm(df.index, desc='Modify box geometry', unit=' boxes'):
-        box_extension_feature = box_extension[FEATURE_MAP_REVERSED[df.at[idx, 'Feature ID']]]
-
-        image_width = df.at[idx, 'Image width']
-        image_height = df.at[idx, 'Image height']
-
-        x1 = df.at[idx, 'x1'] - box_extension_feature[0]
-        y1 = df.at[idx, 'y1'] - box_extension_feature[1]
-        x2 = df.at[idx, 'x2'] + box_extension_feature[2]
-        y2 = df.at[idx, 'y2'] + box_extension_feature[3]
-
-        # Check if the box coordinates exceed image dimensions
-        if x1 < 0:
-            logging.warning(
-                f'x1 = {x1} exceeds the left edge of the image = {0}. '
-                f'Image: {df.at[idx, "Image name"]}. '
-                f'Feature: {df.at[idx, "Feature"]}',
-            )
-        if y1 < 0:
-            logging.warning(
-                f'y1 = {y1} exceeds the top edge of the image = {0}. '
-                f'Image: {df.at[idx, "Image name"]}. '
-                f'Feature: {df.at[idx, "Feature"]}',
-            )
-        if x2 > image_width:
-            logging.warning(
-                f'x2 = {x2} exceeds the right edge of the image = {image_width}. '
-                f'Image: {df.at[idx, "Image name"]}. '
-                f'Feature: {df.at[idx, "Feature"]}',
-            )
-        if y2 > image_height:
-            logging.warning(
-                f'y2 = {y2} exceeds the bottom edge of the image = {image_height}. '
-                f'Image: {df.at[idx, "Image name"]}. '
-                f'Feature: {df.at[idx, "Feature"]}',
-            )
-
-        # Check if x2 is greater than x1 and y2 is greater than y1
-        if x2 <= x1:
-            logging.warning(
-                f'x2 = {x2} is not greater than x1 = {x1}. '
-                f'Image: {df.at[idx, "Image name"]}. '
-                f'Feature: {df.at[idx, "Feature"]}',
-            )
-        if y2 <= y1:
-            logging.warning(
-                f'y2 = {y2} is not greater than y1 = {y1}. '
-                f'Image: {df.at[idx, "Image name"]}. '
-                f'Feature: {df.at[idx, "Feature"]}',
-            )
-
-        # Clip coordinates to image dimensions if necessary
-        x1 = max(0, x1)
-        y1 = max(0, y1)
-        x2 = min(image_width, x2)
-        y2 = min(image_height, y2)
-
-        # Update object coordinates and relative metadata
-        df.at[idx, 'x1'] = x1
-        df.at[idx, 'y1'] = y1
-        df.at[idx, 'x2'] = x2
-        df.at[idx, 'y2'] = y2
-
-    logging.warning('All coordinates that exceed image dimensions are clipped')
+    # Map each box to the extension of its feature with a single lookup
+    missing_features = set(df['Feature ID'].map(FEATURE_MAP_REVERSED)) - set(box_extension)
+    if missing_features:
+        raise KeyError(f'No box extension for features: {sorted(missing_features)}')
+    extension_table = np.zeros((max(FEATURE_MAP.values()) + 1, 4), dtype=int)
+    for feature, extension in box_extension.items():
+        extension_table[FEATURE_MAP[feature]] = extension
+    extension = extension_table[df['Feature ID'].to_numpy(dtype=int)]
+
+    image_width = df['Image width'].to_numpy(dtype=float)
+    image_height = df['Image height'].to_numpy(dtype=float)
+    x1 = df['x1'].to_numpy() - extension[:, 0]
+    y1 = df['y1'].to_numpy() - extension[:, 1]
+    x2 = df['x2'].to_numpy() + extension[:, 2]
+    y2 = df['y2'].to_numpy() + extension[:, 3]
+
+    # Count boxes that exceed image dimensions or are degenerate
+    is_clipped = (x1 < 0) | (y1 < 0) | (x2 > image_width) | (y2 > image_height)
+    is_degenerate = (x2 <= x1) | (y2 <= y1)
+    if is_clipped.any() or is_degenerate.any():
+        num_clipped = df.loc[is_clipped, 'Feature'].value_counts().to_dict()
+        num_degenerate = df.loc[is_degenerate, 'Feature'].value_counts().to_dict()
+        logging.warning(
+            f'Boxes clipped to image dimensions: {num_clipped}. '
+            f'Boxes with x2 <= x1 or y2 <= y1: {num_degenerate}',
+        )
+
+    # Clip coordinates to image dimensions if necessary
+    df['x1'] = np.clip(x1, 0, None)
+    df['y1'] = np.clip(y1, 0, None)
+    df['x2'] = np.minimum(x2, image_width)
+    df['y2'] = np.minimum(y2, image_height)
 
     return df
 
@@ -233,13 +197,10 @@ def crop_image(
     return img_trans, bboxes_trans, features_trans, drop_idx
 
 
-def resize_image(
-    img: np.ndarray,
-    bboxes: List[List[Union[int, float]]],
-    features: List[str],
+def get_resize_transform(
     output_size: List[int],
-) -> Tuple[np.ndarray, List[List[Union[int, float]]], List[str]]:
-    transform = A.Compose(
+) -> A.Compose:
+    return A.Compose(
         [
             A.LongestMaxSize(
                 max_size=max(output_size),
@@ -255,25 +216,11 @@ def resize_image(
         ),
     )
 
-    trans = transform(
-        image=img,
-        bboxes=bboxes,
-        class_labels=features,
-    )
-    img_trans = trans['image']
-    bboxes_trans = trans['bboxes']
-    features_trans = trans['class_labels']
-
-    return img_trans, bboxes_trans, features_trans
-
 
-def pad_image(
-    img: np.ndarray,
-    bboxes: List[List[Union[int, float]]],
-    features: List[str],
+def get_pad_transform(
     output_size: List[int],
-) -> Tuple[np.ndarray, List[List[Union[int, float]]], List[str]]:
-    transform = A.Compose(
+) -> A.Compose:
+    return A.Compose(
         [
             A.PadIfNeeded(
                 min_width=output_size[0],
@@ -292,6 +239,39 @@ def pad_image(
         ),
     )
 
+
+def resize_image(
+    img: np.ndarray,
+    bboxes: List[List[Union[int, float]]],
+    features: List[str],
+    output_size: List[int],
+    transform: Optional[A.Compose] = None,
+) -> Tuple[np.ndarray, List[List[Union[int, float]]], List[str]]:
+    if transform is None:
+        transform = get_resize_transform(output_size)
+
+    trans = transform(
+        image=img,
+        bboxes=bboxes,
+        class_labels=features,
+    )
+    img_trans = trans['image']
+    bboxes_trans = trans['bboxes']
+    features_trans = trans['class_labels']
+
+    return img_trans, bboxes_trans, features_trans
+
+
+def pad_image(
+    img: np.ndarray,
+    bboxes: List[List[Union[int, float]]],
+    features: List[str],
+    output_size: List[int],
+    transform: Optional[A.Compose] = None,
+) -> Tuple[np.ndarray, List[List[Union[int, float]]], List[str]]:
+    if transform is None:
+        transform = get_pad_transform(output_size)
+
     trans = transform(
         image=img,
         bboxes=bboxes,
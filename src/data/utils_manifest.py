@@ -0,0 +1,211 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+MANIFEST_NAME = 'manifest.json'
+# Bumped when the layout of the manifest or of the cached records changes
+MANIFEST_VERSION = 1
+
+
+def hash_file(
+    file_path: str,
+    chunk_size: int = 2**20,
+) -> str:
+    """Compute the SHA-256 hash of a file's content."""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_object(
+    obj: Any,
+) -> str:
+    """Compute the SHA-256 hash of a JSON-serializable object (e.g. a config)."""
+    data = json.dumps(obj, sort_keys=True, default=_to_builtin)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def hash_sources(
+    sources: Sequence[Any],
+) -> str:
+    """Compute the SHA-256 hash of the source files of a stage.
+
+    Args:
+        sources: paths to source files or modules, classes and functions defined in them
+    Returns:
+        hash: hash of the content of the files
+    """
+    file_paths = [
+        source if isinstance(source, str) else inspect.getsourcefile(source) for source in sources
+    ]
+    return hash_object(
+        [hash_file(file_path) for file_path in sorted(set(map(os.path.abspath, file_paths)))],
+    )
+
+
+def _to_builtin(
+    obj: Any,
+) -> Any:
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if obj is pd.NA:
+        return None
+    return str(obj)
+
+
+class StageManifest:
+    """StageManifest keeps track of the items processed by a pipeline stage.
+
+    Each item (e.g. an image) is identified by a key and fingerprinted by the content of its input
+    files and optional extra data (e.g. its metadata rows). The manifest stores the fingerprint,
+    the output files and the metadata records of each item, so that a stage only processes new or
+    changed items, removes the outputs of deleted items and rebuilds its aggregate metadata from
+    the cached records. Changing the stage config, the source code of the stage or
+    MANIFEST_VERSION invalidates all items and removes their outputs.
+
+    File sizes and modification times are stored as well, so unchanged files are not rehashed.
+    """
+
+    def __init__(
+        self,
+        manifest_path: str,
+        config: Any,
+        sources: Optional[Sequence[Any]] = None,
+        enabled: bool = True,
+    ) -> None:
+        """Stage manifest.
+
+        Args:
+            manifest_path: path to the manifest file in the stage output directory
+            config: stage settings the outputs depend on
+            sources: source files, modules, classes or functions producing the outputs and records
+            enabled: if False, all items are processed and nothing is loaded
+        """
+        self.manifest_path = manifest_path
+        self.config_hash = hash_object(
+            {
+                'version': MANIFEST_VERSION,
+                'config': config,
+                'sources': hash_sources(sources) if sources else None,
+            },
+        )
+        self.enabled = enabled
+        self.items: Dict[str, dict] = {}
+        self._pending: Dict[str, dict] = {}
+
+        if enabled and os.path.isfile(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            if manifest.get('config_hash') == self.config_hash:
+                self.items = manifest['items']
+            else:
+                # Outputs of the previous config are not reused, so they do not outlive it
+                log.info('Stage config or code has changed, all items will be processed')
+                _remove_outputs(manifest.get('items', {}).values())
+
+    def get_stale_items(
+        self,
+        inputs: Dict[str, List[str]],
+        extra: Optional[Dict[str, Any]] = None,
+    ) -> List[str]:
+        """Find the items that have to be (re)processed.
+
+        Args:
+            inputs: a dictionary mapping item keys to their input files
+            extra: a dictionary mapping item keys to additional data the outputs depend on
+        Returns:
+            keys: keys of the new or changed items
+        """
+        stale_keys = []
+        for key, file_paths in inputs.items():
+            item = self.items.get(key, {})
+            stats = [_get_file_stat(file_path) for file_path in file_paths]
+            extra_hash = hash_object(extra[key]) if extra is not None else ''
+
+            # Rehash the content only if the files were touched
+            if item.get('stats') == stats and item.get('extra_hash') == extra_hash:
+                content_hash = item['hash']
+            else:
+                content_hash = hash_object(
+                    [hash_file(file_path) for file_path in file_paths] + [extra_hash],
+                )
+
+            self._pending[key] = {
+                'hash': content_hash,
+                'stats': stats,
+                'extra_hash': extra_hash,
+            }
+            is_missing = any(not os.path.exists(path) for path in item.get('outputs', []))
+            if not self.enabled or item.get('hash') != content_hash or is_missing:
+                stale_keys.append(key)
+            else:
+                item.update(self._pending.pop(key))
+
+        return stale_keys
+
+    def remove_deleted_items(
+        self,
+        keys: List[str],
+    ) -> List[str]:
+        """Remove items that are missing from the stage input together with their outputs.
+
+        Args:
+            keys: keys of all current items
+        Returns:
+            deleted_keys: keys of the removed items
+        """
+        deleted_keys = sorted(set(self.items) - set(keys))
+        _remove_outputs([self.items.pop(key) for key in deleted_keys])
+        if deleted_keys:
+            log.info(f'{len(deleted_keys)} deleted item(s) removed from the stage outputs')
+        return deleted_keys
+
+    def update(
+        self,
+        key: str,
+        records: List[dict],
+        outputs: List[str],
+    ) -> None:
+        """Store the records and outputs of a processed item."""
+        item = self._pending.pop(key, {})
+        item['records'] = json.loads(json.dumps(records, default=_to_builtin))
+        item['outputs'] = list(outputs)
+        self.items[key] = item
+
+    def get_records(self) -> List[dict]:
+        """Return the records of all items in the order of their keys."""
+        return [record for key in sorted(self.items) for record in self.items[key]['records']]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        with open(self.manifest_path, 'w') as file:
+            json.dump({'config_hash': self.config_hash, 'items': self.items}, file)
+
+
+def _remove_outputs(
+    items: Iterable[dict],
+) -> None:
+    for item in items:
+        for output_path in item.get('outputs', []):
+            if os.path.isfile(output_path) or os.path.islink(output_path):
+                os.remove(output_path)
+
+
+def _get_file_stat(
+    file_path: str,
+) -> List[int]:
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
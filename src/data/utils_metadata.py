@@ -0,0 +1,299 @@
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data.utils_sly import METADATA_COLUMNS
+
+METADATA_NAME = 'metadata.parquet'
+POINTS_DTYPE = np.int32
+
+# Declared types of the metadata columns, integers are nullable since objects may miss values
+METADATA_SCHEMA: Dict[str, str] = {
+    'Image path': 'str',
+    'Image name': 'str',
+    'Subject ID': 'Int64',
+    'Study ID': 'Int64',
+    'Dataset': 'str',
+    'Image width': 'Int64',
+    'Image height': 'Int64',
+    'Image ratio': 'float64',
+    'Feature ID': 'Int64',
+    'Feature': 'str',
+    'Source type': 'str',
+    'Reference type': 'str',
+    'Match': 'Int64',
+    'x1': 'float64',
+    'y1': 'float64',
+    'x2': 'float64',
+    'y2': 'float64',
+    'xc': 'float64',
+    'yc': 'float64',
+    'Box width': 'float64',
+    'Box height': 'float64',
+    'Box ratio': 'float64',
+    'Box area': 'float64',
+    'Box label': 'str',
+    'RP': 'str',
+    'Mask': 'str',
+    'Points': 'points',
+    'View': 'str',
+    'Class ID': 'Int64',
+    'Class': 'str',
+    # Columns added by the later stages
+    'Split': 'str',
+    'Confidence': 'float64',
+}
+assert set(METADATA_COLUMNS) <= set(METADATA_SCHEMA), 'Every metadata column should have a type'
+
+
+def to_points(
+    value: Union[np.ndarray, list, str, float, None],
+) -> Union[np.ndarray, float]:
+    """Convert the points of an object to an int32 array (N, 2) of (x, y) coordinates.
+
+    Arrays and lists are reshaped without parsing, an int32 array is returned as a view. Strings
+    are the legacy representation of lists and are parsed. Missing points are returned as NaN.
+    """
+    if isinstance(value, str):
+        value = [int(d) for d in re.findall(r'-?\d+', value)]
+    elif not isinstance(value, (list, tuple, np.ndarray)):
+        return np.nan
+    return np.asarray(value, dtype=POINTS_DTYPE).reshape(-1, 2)
+
+
+class PointStore:
+    """Points of metadata objects stored as flattened int32 coordinates with offsets per object.
+
+    The points of the object idx are coords[offsets[idx]:offsets[idx + 1]], an (N, 2) view of
+    the shared buffer. In Parquet the points are a list<int32> column holding the same buffers.
+    """
+
+    def __init__(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        is_valid: np.ndarray,
+    ) -> None:
+        """Point store.
+
+        Args:
+            coords: int32 array (M, 2) of the points of all objects
+            offsets: array (num_objects + 1) of the first point of each object and the end
+            is_valid: bool array (num_objects), False for objects without points
+        """
+        self.coords = coords
+        self.offsets = offsets
+        self.is_valid = is_valid
+
+    @classmethod
+    def from_series(
+        cls,
+        points: pd.Series,
+    ) -> 'PointStore':
+        """Pack the points of a metadata column, see to_points for the supported values."""
+        arrays = [to_points(value) for value in points]
+        is_valid = np.array([isinstance(array, np.ndarray) for array in arrays], dtype=bool)
+        arrays = [array for array in arrays if isinstance(array, np.ndarray)]
+        lengths = np.zeros(len(is_valid), dtype=np.int64)
+        lengths[is_valid] = [len(array) for array in arrays]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        if arrays:
+            coords = np.concatenate(arrays)
+        else:
+            coords = np.zeros((0, 2), dtype=POINTS_DTYPE)
+        return cls(coords, offsets, is_valid)
+
+    @classmethod
+    def from_arrow(
+        cls,
+        array: Union[pa.Array, pa.ChunkedArray],
+    ) -> 'PointStore':
+        """Wrap the buffers of a list<int32> column, other column types are converted."""
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        if not pa.types.is_list(array.type):
+            # string points of the legacy metadata or a column without any points
+            return cls.from_series(array.to_pandas())
+
+        values = array.values.to_numpy(zero_copy_only=False).astype(POINTS_DTYPE, copy=False)
+        offsets = array.offsets.to_numpy() // 2
+        is_valid = array.is_valid().to_numpy(zero_copy_only=False)
+        return cls(values.reshape(-1, 2), offsets, is_valid)
+
+    @classmethod
+    def from_parquet(
+        cls,
+        path: str,
+        column: str = 'Points',
+    ) -> 'PointStore':
+        """Read the points column of a metadata file without reading the other columns."""
+        return cls.from_arrow(pq.read_table(path, columns=[column]).column(column))
+
+    def __len__(self) -> int:
+        return len(self.is_valid)
+
+    def __getitem__(
+        self,
+        idx: int,
+    ) -> Optional[np.ndarray]:
+        """Get an (N, 2) view of the points of an object or None if it has no points."""
+        if not self.is_valid[idx]:
+            return None
+        return self.coords[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def to_series(
+        self,
+        index: Optional[pd.Index] = None,
+    ) -> pd.Series:
+        """Get a metadata column of views of the points, objects without points are NaN."""
+        values = np.full(len(self), np.nan, dtype=object)
+        for idx in np.flatnonzero(self.is_valid):
+            values[idx] = self[idx]
+        return pd.Series(values, index=index, name='Points')
+
+    def to_arrow(self) -> pa.ListArray:
+        """Get a list<int32> array of the flattened points sharing the coordinate buffer."""
+        return pa.ListArray.from_arrays(
+            pa.array(self.offsets * 2, type=pa.int32()),
+            pa.array(self.coords.ravel()),
+            mask=pa.array(~self.is_valid),
+        )
+
+
+def apply_metadata_schema(
+    df: pd.DataFrame,
+) -> pd.DataFrame:
+    """Cast the known metadata columns to their declared types.
+
+    String columns keep missing values as NaN, lists are stored as their string representation.
+    Points are stored as int32 arrays (N, 2), see to_points. Columns that are not in the schema
+    are left untouched.
+
+    Args:
+        df: metadata dataframe
+    Returns:
+        df: a copy of the dataframe with typed columns
+    """
+    df = df.copy()
+    for column, dtype in METADATA_SCHEMA.items():
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if dtype == 'str':
+            df[column] = values.astype(str).where(values.notna(), np.nan).astype(object)
+        elif dtype == 'points':
+            df[column] = pd.Series(
+                [to_points(value) for value in values],
+                index=df.index,
+                dtype=object,
+            )
+        elif dtype == 'Int64':
+            df[column] = pd.to_numeric(values).round().astype('Int64')
+        else:
+            df[column] = pd.to_numeric(values).astype(dtype)
+
+    return df
+
+
+def read_metadata(
+    path: str,
+) -> pd.DataFrame:
+    """Read metadata saved by write_metadata.
+
+    Args:
+        path: path to a Parquet (.parquet) or Excel (.xlsx) file
+    Returns:
+        df: typed metadata without the ID column
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == '.parquet':
+        # Points are taken from the list<int32> buffers as views, other columns are read by pandas
+        columns = pq.read_schema(path).names
+        df = pd.read_parquet(path, columns=[column for column in columns if column != 'Points'])
+        if 'Points' in columns:
+            df['Points'] = PointStore.from_parquet(path).to_series(df.index)
+            df = df[[column for column in columns if column in df.columns]]
+    elif suffix in ['.xlsx', '.xls']:
+        # Excel does not store types, so text columns are read as is instead of being inferred
+        str_columns = {
+            column: str for column, dtype in METADATA_SCHEMA.items() if dtype in ['str', 'points']
+        }
+        df = pd.read_excel(path, dtype=str_columns)
+    else:
+        raise ValueError(f'Unsupported metadata format: {suffix}')
+
+    df = df.drop(columns=['ID'], errors='ignore').reset_index(drop=True)
+
+    return apply_metadata_schema(df)
+
+
+def write_metadata(
+    df: pd.DataFrame,
+    path: str,
+    export_excel: bool = False,
+) -> None:
+    """Save typed metadata with a 1-based ID column.
+
+    Args:
+        df: metadata dataframe
+        path: path to a Parquet (.parquet) or Excel (.xlsx) file
+        export_excel: if True, an Excel copy is saved next to the Parquet file
+    """
+    suffix = Path(path).suffix.lower()
+    df = apply_metadata_schema(df)
+    df.reset_index(drop=True, inplace=True)
+    df.index += 1
+    df.index.name = 'ID'
+
+    os.makedirs(Path(path).parent, exist_ok=True)
+    if suffix == '.parquet':
+        _write_parquet(df, path)
+        if export_excel:
+            _write_excel(df, str(Path(path).with_suffix('.xlsx')))
+    elif suffix == '.xlsx':
+        _write_excel(df, path)
+    else:
+        raise ValueError(f'Unsupported metadata format: {suffix}')
+    logging.info(f'Metadata saved to {path}')
+
+
+def _write_parquet(
+    df: pd.DataFrame,
+    path: str,
+) -> None:
+    if 'Points' not in df.columns:
+        df.to_parquet(path, index=True)
+        return
+
+    # Points are written as a typed list<int32> column instead of Python objects
+    points = PointStore.from_series(df['Points'])
+    table = pa.Table.from_pandas(df.assign(Points=None), preserve_index=True)
+    column_idx = table.schema.get_field_index('Points')
+    table = table.set_column(column_idx, 'Points', points.to_arrow())
+    pq.write_table(table, path)
+
+
+def _write_excel(
+    df: pd.DataFrame,
+    path: str,
+) -> None:
+    if 'Points' in df.columns:
+        df = df.assign(
+            Points=[
+                str(points.tolist()) if isinstance(points, np.ndarray) else points
+                for points in df['Points']
+            ],
+        )
+    df.to_excel(
+        path,
+        sheet_name='Metadata',
+        index=True,
+        index_label='ID',
+    )
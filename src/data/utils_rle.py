@@ -0,0 +1,175 @@
+from typing import Dict, List, Union
+
+import numpy as np
+
+# Masks are stored in metadata as '<height>,<width>,<counts>', the separator is not used by the
+# COCO counts alphabet (chr(48)..chr(111)) nor by base64, so legacy masks can be told apart
+RLE_SEPARATOR = ','
+# Values of the COCO counts string are written in 5-bit chunks, values fit in 7 chunks
+RLE_MAX_CHUNKS = 7
+
+Rle = Dict[str, Union[List[int], np.ndarray, str]]
+
+
+def encode_rle(
+    mask: np.ndarray,
+) -> Rle:
+    """Encode a binary mask with the COCO run-length encoding.
+
+    Runs are counted in column-major order starting with a run of zeros, as in pycocotools.
+
+    Args:
+        mask: mask (height, width), non-zero values are foreground
+    Returns:
+        rle: dictionary with the mask size [height, width] and the run lengths
+    """
+    height, width = mask.shape[:2]
+    pixels = np.asarray(mask).ravel(order='F') != 0
+    if pixels.size == 0:
+        return {'size': [height, width], 'counts': np.zeros(0, dtype=np.int64)}
+
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    boundaries = np.concatenate([[0], changes, [pixels.size]])
+    counts = np.diff(boundaries)
+    if pixels[0]:
+        counts = np.concatenate([[0], counts])
+
+    return {'size': [height, width], 'counts': counts.astype(np.int64)}
+
+
+def get_rle_counts(
+    rle: Rle,
+) -> np.ndarray:
+    """Get the run lengths of an RLE with counts stored as a list, an array or a COCO string."""
+    counts = rle['counts']
+    if isinstance(counts, (str, bytes)):
+        return decompress_counts(counts)
+    return np.asarray(counts, dtype=np.int64)
+
+
+def decode_rle(
+    rle: Rle,
+) -> np.ndarray:
+    """Decode an RLE into a uint8 mask (height, width) with 0/1 values."""
+    height, width = rle['size']
+    counts = get_rle_counts(rle)
+    values = (np.arange(counts.size) % 2).astype(np.uint8)
+    pixels = np.repeat(values, counts)
+    assert pixels.size == height * width, 'Run lengths do not match the mask size'
+
+    return pixels.reshape((height, width), order='F')
+
+
+def get_rle_area(
+    rle: Rle,
+) -> int:
+    """Get the number of foreground pixels of an RLE without decoding it."""
+    return int(get_rle_counts(rle)[1::2].sum())
+
+
+def get_rle_bbox(
+    rle: Rle,
+) -> List[int]:
+    """Get the COCO box [x, y, width, height] of the foreground of an RLE without decoding it."""
+    height, _ = rle['size']
+    counts = get_rle_counts(rle)
+    starts = np.cumsum(counts) - counts
+    run_starts = starts[1::2]
+    run_lengths = counts[1::2]
+    is_foreground = run_lengths > 0
+    if not np.any(is_foreground):
+        return [0, 0, 0, 0]
+    run_starts = run_starts[is_foreground]
+    run_ends = run_starts + run_lengths[is_foreground] - 1
+
+    # column-major order, a run spanning several columns covers the whole height
+    x_starts, y_starts = np.divmod(run_starts, height)
+    x_ends, y_ends = np.divmod(run_ends, height)
+    is_single_column = x_starts == x_ends
+    x1, x2 = x_starts.min(), x_ends.max()
+    y1 = np.where(is_single_column, y_starts, 0).min()
+    y2 = np.where(is_single_column, y_ends, height - 1).max()
+
+    return [int(x1), int(y1), int(x2 - x1 + 1), int(y2 - y1 + 1)]
+
+
+def compress_counts(
+    counts: np.ndarray,
+) -> str:
+    """Write run lengths as a COCO counts string, the same as pycocotools rleToString.
+
+    Every value except the first three is stored as a difference with the value two positions
+    before it, values are written in 5-bit chunks with a continuation bit.
+    """
+    values = np.asarray(counts, dtype=np.int64).copy()
+    values[3:] -= np.asarray(counts, dtype=np.int64)[1:-2]
+
+    chunks = np.zeros((values.size, RLE_MAX_CHUNKS), dtype=np.int64)
+    is_written = np.zeros((values.size, RLE_MAX_CHUNKS), dtype=bool)
+    more = np.ones(values.size, dtype=bool)
+    for chunk_idx in range(RLE_MAX_CHUNKS):
+        chunk = values & 0x1F
+        values = values >> 5
+        is_written[:, chunk_idx] = more
+        # the sign bit of the last chunk tells whether the rest of the value is 0 or -1
+        next_more = np.where(chunk & 0x10, values != -1, values != 0) & more
+        chunks[:, chunk_idx] = chunk | np.where(next_more, 0x20, 0)
+        more = next_more
+    assert not np.any(more), 'Run length is too large'
+
+    return (chunks[is_written] + 48).astype(np.uint8).tobytes().decode('ascii')
+
+
+def decompress_counts(
+    counts_string: Union[str, bytes],
+) -> np.ndarray:
+    """Read run lengths from a COCO counts string, the same as pycocotools rleFrString."""
+    if isinstance(counts_string, str):
+        counts_string = counts_string.encode('ascii')
+    chunks = np.frombuffer(counts_string, dtype=np.uint8).astype(np.int64) - 48
+    if chunks.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # a value ends at the first chunk without the continuation bit
+    is_last = (chunks & 0x20) == 0
+    value_ends = np.flatnonzero(is_last)
+    value_starts = np.concatenate([[0], value_ends[:-1] + 1])
+    num_chunks = value_ends - value_starts + 1
+    chunk_positions = np.arange(chunks.size) - np.repeat(value_starts, num_chunks)
+    values = np.add.reduceat((chunks & 0x1F) << (5 * chunk_positions), value_starts)
+    is_negative = (chunks[value_ends] & 0x10) != 0
+    values = np.where(is_negative, values - (1 << (5 * num_chunks)), values)
+
+    # undo the differences with the values two positions before
+    counts = values.copy()
+    counts[1::2] = np.cumsum(values[1::2])
+    counts[2::2] = np.cumsum(values[2::2])
+
+    return counts
+
+
+def rle_to_string(
+    rle: Rle,
+) -> str:
+    """Convert an RLE to the '<height>,<width>,<counts>' string stored in metadata."""
+    height, width = rle['size']
+    counts = rle['counts']
+    if not isinstance(counts, str):
+        counts = compress_counts(counts)
+
+    return RLE_SEPARATOR.join([str(height), str(width), counts])
+
+
+def rle_from_string(
+    rle_string: str,
+) -> Rle:
+    """Convert a metadata string created by rle_to_string to a COCO RLE with a counts string."""
+    height, width, counts = rle_string.split(RLE_SEPARATOR, 2)
+    return {'size': [int(height), int(width)], 'counts': counts}
+
+
+def is_rle_string(
+    mask_string: str,
+) -> bool:
+    """Check whether a metadata mask is an RLE string rather than a legacy base64 PNG."""
+    return RLE_SEPARATOR in mask_string
@@ -1,16 +1,30 @@
 import base64
 import io
+import json
 import logging
 import os
+import struct
 import zlib
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
 import pandas as pd
-import supervisely_lib as sly
 from PIL import Image
 
+from src.data.utils import PNG_SIGNATURE
+from src.data.utils_rle import decode_rle, encode_rle, is_rle_string, rle_from_string, rle_to_string
+
+try:
+    import orjson
+except ImportError:  # the standard json module is used instead
+    orjson = None
+
+SLY_META_NAME = 'meta.json'
+SLY_IMG_DIR = 'img'
+SLY_ANN_DIR = 'ann'
+
 CLASS_MAP = {
     '': None,
     'No edema': 0,
@@ -81,10 +95,90 @@ METADATA_COLUMNS = [
 ]
 
 
+def load_json(
+    path: str,
+) -> dict:
+    """Load a JSON file with orjson if it is installed."""
+    if orjson is None:
+        with open(path) as file:
+            return json.load(file)
+    with open(path, 'rb') as file:
+        return orjson.loads(file.read())
+
+
+def _scan_sly_dataset(
+    dataset_path: str,
+) -> List[Tuple[str, str, str]]:
+    # Items of a dataset are the annotations in ann/ with an image of the same name in img/
+    subset = os.path.basename(dataset_path)
+    img_dir = os.path.join(dataset_path, SLY_IMG_DIR)
+    ann_dir = os.path.join(dataset_path, SLY_ANN_DIR)
+    with os.scandir(img_dir) as entries:
+        img_names = {entry.name for entry in entries if entry.is_file()}
+
+    records = []
+    with os.scandir(ann_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith('.json'):
+                continue
+            item_name = entry.name[: -len('.json')]
+            if item_name not in img_names:
+                logging.warning(f'No image for annotation {entry.path}')
+                continue
+            records.append((os.path.join(img_dir, item_name), entry.path, subset))
+
+    return sorted(records)
+
+
+def scan_sly_project(
+    dataset_dir: str,
+    include_dirs: Optional[List[str]] = None,
+    exclude_dirs: Optional[List[str]] = None,
+    num_threads: int = 8,
+) -> List[Tuple[str, str, str]]:
+    """List the items of a Supervisely project without loading the project.
+
+    The project layout (meta.json and <dataset>/img, <dataset>/ann directories) is walked with
+    os.scandir, datasets are scanned in threads since listing directories waits on the file
+    system, and their items are returned in order of dataset names.
+
+    Args:
+        dataset_dir: a path to Supervisely dataset directory
+        include_dirs: a list of subsets to include in the dataset
+        exclude_dirs: a list of subsets to exclude from the dataset
+        num_threads: number of threads scanning datasets
+    Returns:
+        records: image path, annotation path and subset of every item
+    """
+    assert os.path.isfile(
+        os.path.join(dataset_dir, SLY_META_NAME),
+    ), 'Wrong project dir: {}'.format(dataset_dir)
+
+    dataset_paths = []
+    with os.scandir(dataset_dir) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if not os.path.isdir(os.path.join(entry.path, SLY_ANN_DIR)):
+                continue
+            subset = entry.name
+            if include_dirs and subset not in include_dirs:
+                logging.info(f'Excluded dir.........: {subset}')
+                continue
+            if exclude_dirs and subset in exclude_dirs:
+                logging.info(f'Excluded dir.........: {subset}')
+                continue
+            logging.info(f'Included dir.........: {subset}')
+            dataset_paths.append(entry.path)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = executor.map(_scan_sly_dataset, dataset_paths)
+        return [record for records in results for record in records]
+
+
 def read_sly_project(
     dataset_dir: str,
     include_dirs: Optional[List[str]] = None,
     exclude_dirs: Optional[List[str]] = None,
+    num_threads: int = 8,
 ) -> pd.DataFrame:
     """Read the Supervisely project as a dataframe.
 
@@ -92,47 +186,18 @@ def read_sly_project(
         dataset_dir: a path to Supervisely dataset directory
         include_dirs: a list of subsets to include in the dataset
         exclude_dirs: a list of subsets to exclude from the dataset
+        num_threads: number of threads scanning datasets
     Returns:
         df: dataframe representing the dataset
     """
     logging.info(f'Dataset dir..........: {dataset_dir}')
-    assert os.path.exists(dataset_dir) and os.path.isdir(
-        dataset_dir,
-    ), 'Wrong project dir: {}'.format(dataset_dir)
-    project = sly.Project(
-        directory=dataset_dir,
-        mode=sly.OpenMode.READ,
-    )
-
-    img_paths: List[str] = []
-    ann_paths: List[str] = []
-    subset_list: List[str] = []
-
-    for dataset in project:
-        subset = dataset.name
-
-        if include_dirs and subset not in include_dirs:
-            logging.info(f'Excluded dir.........: {subset}')
-            continue
-
-        if exclude_dirs and subset in exclude_dirs:
-            logging.info(f'Excluded dir.........: {subset}')
-            continue
-
-        logging.info(f'Included dir.........: {subset}')
-        for item_name in dataset:
-            img_path, ann_path = dataset.get_item_paths(item_name)
-            img_paths.append(img_path)
-            ann_paths.append(ann_path)
-            subset_list.append(subset)
-
-    df = pd.DataFrame.from_dict(
-        {
-            'img_path': img_paths,
-            'ann_path': ann_paths,
-            'subset': subset_list,
-        },
+    records = scan_sly_project(
+        dataset_dir=dataset_dir,
+        include_dirs=include_dirs,
+        exclude_dirs=exclude_dirs,
+        num_threads=num_threads,
     )
+    df = pd.DataFrame.from_records(records, columns=['img_path', 'ann_path', 'subset'])
     df.sort_values(['subset'], inplace=True)
     df.reset_index(drop=True, inplace=True)
 
@@ -172,6 +237,26 @@ def convert_mask_to_base64(
     return encoded_mask
 
 
+def convert_base64_to_rle(
+    encoded_mask: str,
+) -> str:
+    """Convert a Supervisely base64 encoded mask to the RLE string stored in metadata."""
+    return rle_to_string(encode_rle(convert_base64_to_mask(encoded_mask)))
+
+
+def decode_mask(
+    mask_string: str,
+) -> np.ndarray:
+    """Decode a metadata mask stored as an RLE string or a legacy base64 encoded PNG.
+
+    Returns:
+        mask: uint8 mask with 0/255 values, the same as convert_base64_to_mask
+    """
+    if is_rle_string(mask_string):
+        return decode_rle(rle_from_string(mask_string)) * np.uint8(255)
+    return convert_base64_to_mask(mask_string)
+
+
 def get_class_name(
     ann: dict,
 ) -> str:
@@ -223,11 +308,12 @@ def get_mask_points(
     Args:
         obj: dictionary with information about one object from Supervisely annotations
     Returns:
-
+        dictionary with the mask converted to an RLE string and the bitmap origin for bitmaps, or
+        the exterior points for other geometries
     """
     if obj['geometryType'] == 'bitmap':
         return {
-            'Mask': obj['bitmap']['data'],
+            'Mask': convert_base64_to_rle(obj['bitmap']['data']),
             'Points': [int(np.round(s)) for s in obj['bitmap']['origin']],
         }
     else:
@@ -237,6 +323,30 @@ def get_mask_points(
         }
 
 
+def get_bitmap_size(
+    encoded_mask: str,
+) -> Tuple[int, int]:
+    """Get the height and width of a base64 encoded mask without decoding its pixels.
+
+    Only the first bytes of the compressed PNG are inflated to read the IHDR chunk. If the data is
+    not a PNG with a leading IHDR chunk, the mask is fully decoded instead.
+
+    Args:
+        encoded_mask: base64 encoded and zlib compressed PNG mask
+    Returns:
+        height and width of the mask
+    """
+    decoded_bytes = base64.b64decode(encoded_mask)
+    # Signature (8 bytes), chunk length (4), chunk type (4), width (4) and height (4)
+    header = zlib.decompressobj().decompress(decoded_bytes, 24)
+    if len(header) == 24 and header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', header[16:24])
+        return height, width
+
+    mask = convert_base64_to_mask(encoded_mask)
+    return mask.shape[0], mask.shape[1]
+
+
 def get_object_box(
     obj: dict,
 ) -> dict:
@@ -248,10 +358,10 @@ def get_object_box(
         dictionary which contains coordinates for a rectangle (left, top, right, bottom)
     """
     if obj['geometryType'] == 'bitmap':
-        bitmap = convert_base64_to_mask(obj['bitmap']['data'])
+        bitmap_height, bitmap_width = get_bitmap_size(obj['bitmap']['data'])
         x1, y1 = obj['bitmap']['origin'][0], obj['bitmap']['origin'][1]
-        x2 = x1 + bitmap.shape[1]
-        y2 = y1 + bitmap.shape[0]
+        x2 = x1 + bitmap_width
+        y2 = y1 + bitmap_height
     else:
         xs = [x[0] for x in obj['points']['exterior']]
         ys = [x[1] for x in obj['points']['exterior']]
@@ -281,18 +391,44 @@ def get_box_sizes(
     Returns:
         dictionary which contains coordinates for rectangle (a center point and a width/height)
     """
-    box_width = abs(x2 - x1 + 1)
-    box_height = abs(y2 - y1 + 1)
+    box_sizes = compute_box_sizes(
+        x1=np.asarray(x1),
+        y1=np.asarray(y1),
+        x2=np.asarray(x2),
+        y2=np.asarray(y2),
+    )
+
+    return {key: value.item() for key, value in box_sizes.items()}
+
+
+def compute_box_sizes(
+    x1: np.ndarray,
+    y1: np.ndarray,
+    x2: np.ndarray,
+    y2: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """Extract sizes of many boxes at once, the vectorized counterpart of get_box_sizes.
+
+    Args:
+        x1: left x of the boxes
+        y1: top y of the boxes
+        x2: right x of the boxes
+        y2: bottom y of the boxes
+    Returns:
+        dictionary which contains arrays of box centers, sizes, areas and size labels
+    """
+    box_width = np.abs(x2 - x1 + 1)
+    box_height = np.abs(y2 - y1 + 1)
     xc = x1 + box_width // 2
     yc = y1 + box_height // 2
     box_area = box_height * box_width
-    box_ratio = box_height / box_width
-    if box_area < 32 * 32:
-        box_label = 'Small'
-    elif 32 * 32 <= box_area <= 96 * 96:
-        box_label = 'Medium'
-    else:
-        box_label = 'Large'
+    with np.errstate(divide='ignore', invalid='ignore'):
+        box_ratio = np.true_divide(box_height, box_width)
+    box_label = np.select(
+        [box_area < 32 * 32, box_area <= 96 * 96],
+        ['Small', 'Medium'],
+        default='Large',
+    )
 
     return {
         'xc': xc,
@@ -9,6 +9,7 @@ from omegaconf import DictConfig
 from tqdm import tqdm
 
 from src import BBFormat, BBType, BoundingBox, BoundingBoxes, CoordinatesType, Evaluator
+from src.data.utils_metadata import read_metadata
 
 
 def _get_confidence_array(
@@ -35,9 +36,10 @@ def _add_gt_bboxes(
     df_gt: pd.DataFrame,
     bounding_boxes: BoundingBoxes,
 ) -> BoundingBoxes:
-    for row in df_gt.itertuples():
+    # Columns with spaces get positional names in itertuples, so they are renamed
+    for row in df_gt.rename(columns={'Image name': 'image_name'}).itertuples():
         bb_gt = BoundingBox(
-            imageName=row._3,
+            imageName=row.image_name,
             classId=row.Feature,
             x=row.x1,
             y=row.y1,
@@ -55,9 +57,10 @@ def _add_pred_bboxes(
     df_pred: pd.DataFrame,
     bounding_boxes: BoundingBoxes,
 ) -> BoundingBoxes:
-    for row in df_pred.itertuples():
+    # Columns with spaces get positional names in itertuples, so they are renamed
+    for row in df_pred.rename(columns={'Image name': 'image_name'}).itertuples():
         bb_pred = BoundingBox(
-            imageName=row._3,
+            imageName=row.image_name,
             classId=row.Feature,
             classConfidence=row.Confidence,
             x=row.x1,
@@ -192,8 +195,8 @@ def main(cfg: DictConfig) -> None:
     )
 
     # Read DataFrames and exclude features.
-    df_gt = pd.read_excel(cfg.gt_path)
-    df_pred = pd.read_excel(cfg.pred_path)
+    df_gt = read_metadata(cfg.gt_path)
+    df_pred = read_metadata(cfg.pred_path)
     df_gt_filtered, df_pred_filterd = _exclude_features((df_gt, df_pred), cfg.exclude_features)
 
     # Compute metrics for all confidence thresholds class-wise
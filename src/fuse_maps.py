@@ -1,7 +1,7 @@
 import logging
 import os
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import cv2
 import hydra
@@ -11,14 +11,15 @@ from joblib import Parallel, delayed
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
+import src.data.utils_rle as utils_rle
+import src.data.utils_sly as utils_sly
+import src.models.map_fuser as map_fuser
+import src.models.mask_processor as mask_processor
 from src.data.utils import get_file_list
-from src.data.utils_sly import (
-    FEATURE_MAP,
-    FEATURE_TYPE,
-    METADATA_COLUMNS,
-    convert_mask_to_base64,
-    get_box_sizes,
-)
+from src.data.utils_manifest import MANIFEST_NAME, StageManifest
+from src.data.utils_metadata import METADATA_NAME, write_metadata
+from src.data.utils_rle import encode_rle, rle_to_string
+from src.data.utils_sly import FEATURE_MAP, FEATURE_TYPE, METADATA_COLUMNS, get_box_sizes
 from src.models.map_fuser import MapFuser
 from src.models.mask_processor import MaskProcessor
 
@@ -42,7 +43,7 @@ def extract_lungs_metadata(
     x2, y2 = max(x2_values), max(y2_values)
 
     mask_crop = mask[y1:y2, x1:x2]
-    mask_encoded = convert_mask_to_base64(mask_crop)
+    mask_encoded = rle_to_string(encode_rle(mask_crop))
 
     feature_name = 'Lungs'
     lungs_info = {
@@ -64,35 +65,76 @@ def extract_lungs_metadata(
 
 
 def process_prob_maps(
-    img_paths: List[str],
+    img_path_sets: List[List[str]],
     save_dir: str,
+) -> List[dict]:
+    """Fuse and process the probability maps of a chunk of images.
+
+    Args:
+        img_path_sets: list of per-image sets of map paths, one path per model
+        save_dir: directory where the fused maps and masks are saved
+    Returns:
+        lungs_info: metadata rows of the lungs
+    """
+    # A chunk is processed by a single worker, so the fuser and processor are reused across it
+    map_fuser = MapFuser()
+    mask_processor = MaskProcessor()
+
+    lungs_info = []
+    for img_paths in img_path_sets:
+        prob_maps = [cv2.imread(img_path, cv2.IMREAD_GRAYSCALE) for img_path in img_paths]
+        lungs_info.append(
+            fuse_prob_maps(
+                prob_maps=prob_maps,
+                img_name=Path(img_paths[0]).name,
+                save_dir=save_dir,
+                map_fuser=map_fuser,
+                mask_processor=mask_processor,
+            ),
+        )
+
+    return lungs_info
+
+
+def fuse_prob_maps(
+    prob_maps: List[np.ndarray],
+    img_name: str,
+    save_dir: str,
+    map_fuser: Optional[MapFuser] = None,
+    mask_processor: Optional[MaskProcessor] = None,
 ) -> dict:
+    """Fuse probability maps of an image, clean its lung mask and extract the lungs metadata.
+
+    Args:
+        prob_maps: probability maps of the same image predicted by different models
+        img_name: name of the image used for the fused map and mask
+        save_dir: directory where the fused map and mask are saved
+        map_fuser: fuser reused between images, a new one is created if not provided
+        mask_processor: processor reused between images, a new one is created if not provided
+    Returns:
+        lungs_info: a metadata row of the lungs
+    """
     # Fuse segmentation probability maps
-    fuser = MapFuser()
-    for img_path in img_paths:
-        prob_map = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+    fuser = map_fuser if map_fuser is not None else MapFuser()
+    for prob_map in prob_maps:
         fuser.add_prob_map(prob_map)
     fused_map = fuser.conditional_probability_fusion(scale_output=True)
 
     # Process obtained fused map
-    processor = MaskProcessor()
+    processor = mask_processor if mask_processor is not None else MaskProcessor()
     mask_bin = processor.binarize_image(image=fused_map)
     mask_smooth = processor.smooth_mask(mask=mask_bin)
     mask_clean = processor.remove_artifacts(mask=mask_smooth)
 
     # Save the fused map and its mask
-    img_name = Path(img_paths[0]).name
-    map_dir = os.path.join(save_dir, 'map')
-    mask_dir = os.path.join(save_dir, 'mask')
-    os.makedirs(map_dir, exist_ok=True)
-    os.makedirs(mask_dir, exist_ok=True)
-    map_path = os.path.join(map_dir, f'{img_name}')
-    mask_path = os.path.join(mask_dir, f'{img_name}')
+    map_path, mask_path = get_output_paths(img_name=img_name, save_dir=save_dir)
+    os.makedirs(os.path.dirname(map_path), exist_ok=True)
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
     cv2.imwrite(map_path, fused_map)
     cv2.imwrite(mask_path, mask_clean)
 
     # Extract lungs metadata
-    img_stem = Path(img_path).stem
+    img_stem = Path(img_name).stem
     subject_id, study_id = img_stem.split('_')
     map_height, map_width = fused_map.shape[:2]
     map_ratio = map_height / map_width
@@ -111,6 +153,17 @@ def process_prob_maps(
     return lungs_info
 
 
+def get_output_paths(
+    img_name: str,
+    save_dir: str,
+) -> List[str]:
+    """Return paths of the fused map and mask of an image."""
+    return [
+        os.path.join(save_dir, 'map', img_name),
+        os.path.join(save_dir, 'mask', img_name),
+    ]
+
+
 def reorder_image_paths(
     input_lists: List[List[str]],
 ) -> List[List[str]]:
@@ -133,6 +186,21 @@ def reorder_image_paths(
     return output_list
 
 
+def save_metadata(
+    metadata: pd.DataFrame,
+    save_dir: str,
+    export_excel: bool = False,
+) -> None:
+    metadata_path = os.path.join(save_dir, METADATA_NAME)
+    log.info(f'Saving metadata to {metadata_path}')
+    metadata.sort_values(['Image name'], inplace=True)
+    write_metadata(
+        df=metadata,
+        path=metadata_path,
+        export_excel=export_excel,
+    )
+
+
 @hydra.main(
     config_path=os.path.join(os.getcwd(), 'configs'),
     config_name='fuse_maps',
@@ -163,28 +231,41 @@ def main(cfg: DictConfig) -> None:
     # Reorder image paths for multiprocessing
     img_path_sets = reorder_image_paths(img_path_sets)
 
-    # Process segmentation probability maps
-    lung_info = Parallel(n_jobs=1)(
-        delayed(process_prob_maps)(img_path_set, cfg.save_dir)
-        for img_path_set in tqdm(img_path_sets, desc='Processing')
+    # Process only images whose probability maps are new or changed
+    manifest = StageManifest(
+        manifest_path=os.path.join(cfg.save_dir, MANIFEST_NAME),
+        config={'model_names': list(cfg.model_names)},
+        sources=[__file__, map_fuser, mask_processor, utils_rle, utils_sly],
+        enabled=cfg.incremental,
     )
+    img_path_sets_ = {Path(img_paths[0]).name: img_paths for img_paths in img_path_sets}
+    manifest.remove_deleted_items(list(img_path_sets_))
+    stale_keys = manifest.get_stale_items(inputs=img_path_sets_)
+    log.info(f'{len(stale_keys)}/{len(img_path_sets_)} images are new or changed')
+
+    # Process segmentation probability maps in chunks to amortize the scheduling overhead
+    chunks = [
+        [img_path_sets_[key] for key in stale_keys[idx : idx + cfg.chunk_size]]
+        for idx in range(0, len(stale_keys), cfg.chunk_size)
+    ]
+    results = Parallel(n_jobs=cfg.num_workers)(
+        delayed(process_prob_maps)(chunk, cfg.save_dir)
+        for chunk in tqdm(chunks, desc='Processing', unit='chunks')
+    )
+    lung_info = [row for rows in results for row in rows]
+    for key, row in zip(stale_keys, lung_info):
+        manifest.update(
+            key=key,
+            records=[row],
+            outputs=get_output_paths(img_name=key, save_dir=cfg.save_dir),
+        )
+    manifest.save()
 
-    # Create metadata
-    metadata = pd.DataFrame(columns=METADATA_COLUMNS)
-    metadata = metadata.append(lung_info, ignore_index=True)
+    # Create metadata of all images from cached records
+    metadata = pd.DataFrame(manifest.get_records(), columns=METADATA_COLUMNS)
 
     # Save metadata
-    metadata_path = os.path.join(cfg.save_dir, 'metadata.xlsx')
-    log.info(f'Saving metadata to {metadata_path}')
-    metadata.sort_values(['Image name'], inplace=True)
-    metadata.reset_index(drop=True, inplace=True)
-    metadata.index += 1
-    metadata.to_excel(
-        metadata_path,
-        sheet_name='Metadata',
-        index=True,
-        index_label='ID',
-    )
+    save_metadata(metadata=metadata, save_dir=cfg.save_dir, export_excel=cfg.export_excel)
 
     log.info('Complete')
 
@@ -1,5 +1,4 @@
 import os
-from pathlib import Path
 from typing import Tuple
 
 import numpy as np
@@ -51,10 +50,7 @@ def _preprocess_df_pred(
 ) -> pd.DataFrame:
     # Filter the prediction DataFrame and change names in the 'Image name' column.
     df_pred.drop_duplicates(subset=['Image path'], keep='first', inplace=True)
-    df_pred['Image name'] = df_pred.apply(
-        func=lambda row: f'{Path(str(row["Image path"])).parts[-2]}.png',
-        axis=1,
-    )
+    df_pred['Image name'] = df_pred['Image path'].astype(str).str.split(r'[\\/]').str[-2] + '.png'
     return df_pred
 
 
@@ -123,6 +119,8 @@ def _save_df_report(
 
 
 if __name__ == '__main__':
-    df_gt = pd.read_excel('data/interim/metadata.xlsx')
-    df_pred = pd.read_excel('data/interim_predict/SABL/metadata.xlsx')
+    from src.data.utils_metadata import read_metadata
+
+    df_gt = read_metadata('data/interim/metadata.parquet')
+    df_pred = read_metadata('data/interim_predict/SABL/metadata.parquet')
     evaluate_classification(df_gt, df_pred, mode='train')
@@ -1,7 +1,22 @@
+from typing import Tuple
+
+import numpy as np
 import pandas as pd
 
 from src.data.utils_sly import CLASS_MAP
 
+# Edema class implied by each feature, an image is assigned the most severe class of its features
+FEATURE_SEVERITY = {
+    'Cephalization': CLASS_MAP['Vascular congestion'],
+    'Kerley': CLASS_MAP['Interstitial edema'],
+    'Effusion': CLASS_MAP['Interstitial edema'],
+    'Cuffing': CLASS_MAP['Interstitial edema'],
+    'Bat': CLASS_MAP['Alveolar edema'],
+    'Infiltrate': CLASS_MAP['Alveolar edema'],
+}
+
+CLASS_MAP_REVERSED = dict((v, k) for k, v in CLASS_MAP.items() if v is not None)
+
 
 class EdemaClassifier:
     """A classifier that assigns an edema class to an X-ray image."""
@@ -16,34 +31,28 @@ class EdemaClassifier:
         """The main classification function.
 
         Args:
-            df: initial dataframe containing image and feature metadata
+            df: initial dataframe containing image and feature metadata of one or more images
         Returns:
-            df_out: a dataframe with identified edema severity class
+            df_out: a dataframe with identified edema severity class of each image
         """
         if df.empty:
             raise Exception('DataFrame is empty!')
 
-        img_groups = df.groupby('Image name')
-        for _, df_img in img_groups:
-            edema_severity = EdemaClassifier._get_edema_severity(df_img)
-            df_img['Class ID'] = CLASS_MAP[edema_severity]
-            df_img['Class'] = edema_severity
-        return df_img
+        img_codes, class_ids = self._compute_class_ids(df)
+        df_out = df.copy()
+        df_out['Class ID'] = class_ids[img_codes]
+        df_out['Class'] = df_out['Class ID'].map(CLASS_MAP_REVERSED)
 
-    @staticmethod
-    def _get_edema_severity(df: pd.DataFrame) -> str:
-        features = list(df['Feature'].unique())
-        if 'Bat' in features or 'Infiltrate' in features:
-            return 'Alveolar edema'
+        return df_out
 
-        elif 'Effusion' in features or 'Kerley' in features or 'Cuffing' in features:
-            return 'Interstitial edema'
-
-        elif 'Cephalization' in features:
-            return 'Vascular congestion'
-
-        else:
-            return 'No edema'
+    @staticmethod
+    def _compute_class_ids(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        # Rows without detected features (e.g. NaN) do not affect the class of an image
+        severity = df['Feature'].map(FEATURE_SEVERITY).fillna(CLASS_MAP['No edema'])
+        img_codes, img_names = pd.factorize(df['Image name'])
+        class_ids = np.full(len(img_names), CLASS_MAP['No edema'], dtype=int)
+        np.maximum.at(class_ids, img_codes, severity.to_numpy(dtype=int))
+        return img_codes, class_ids
 
 
 if __name__ == '__main__':
@@ -1,14 +1,14 @@
 import logging
 import os
-import shutil
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import albumentations as A
 import cv2
 import numpy as np
 import pandas as pd
 
+from src.data.utils import materialize_file
 from src.data.utils_sly import FEATURE_MAP, get_box_sizes
 from src.models.box_fuser import BoxFuser
 from src.models.edema_classifier import EdemaClassifier
@@ -17,6 +17,7 @@ from src.models.lung_segmenter import LungSegmenter
 from src.models.map_fuser import MapFuser
 from src.models.mask_processor import MaskProcessor
 from src.models.non_max_suppressor import NonMaxSuppressor
+from src.models.stage_timer import NULL_TIMER, StageTimer
 
 
 class EdemaNet:
@@ -27,7 +28,7 @@ class EdemaNet:
     MASK_CROP_NAME = 'mask_crop.png'
     MAP_NAME = 'map.png'
     MAP_PREFIX = 'map'
-    METADATA_NAME = 'metadata.xlsx'
+    METADATA_NAME = 'metadata.parquet'
 
     def __init__(
         self,
@@ -40,6 +41,7 @@ class EdemaNet:
         edema_classifier: EdemaClassifier,
         img_size: Tuple[int, int] = (1536, 1536),
         lung_extension: Tuple[int, int, int, int] = (50, 50, 50, 150),
+        materialize_mode: str = 'copy',
     ) -> None:
         self.lung_segmenters = lung_segmenters
         self.feature_detectors = feature_detectors
@@ -50,54 +52,91 @@ class EdemaNet:
         self.edema_classifier = edema_classifier
         self.img_size = img_size
         self.lung_extension = lung_extension  # Tuple[left, top, right, bottom]
+        self.materialize_mode = materialize_mode  # How a source image is put into save_dir
 
     def predict(
         self,
         img_path: str,
         save_dir: str,
+        classify: bool = True,
+        timer: Optional[StageTimer] = None,
     ) -> pd.DataFrame:
-        # Create a directory and copy an image into it
+        timer = timer if timer is not None else NULL_TIMER
+        with timer.span('total'):
+            df = self._predict(
+                img_path=img_path,
+                save_dir=save_dir,
+                classify=classify,
+                timer=timer,
+            )
+
+        # Attach per-stage timings of the image to its metadata
+        if timer.enabled:
+            df = df.assign(**timer.get_metadata())
+
+        return df
+
+    def _predict(
+        self,
+        img_path: str,
+        save_dir: str,
+        classify: bool,
+        timer: StageTimer,
+    ) -> pd.DataFrame:
+        # Create a directory and link or copy an image into it
         img_stem = Path(img_path).stem
         img_dir = os.path.join(save_dir, img_stem)
         os.makedirs(img_dir, exist_ok=True)
         dst_path = os.path.join(img_dir, f'{img_stem}_{self.SRC_SUFFIX}.png')
-        shutil.copy(img_path, dst_path)
+        with timer.span('write'):
+            materialize_file(img_path, dst_path, mode=self.materialize_mode)
         img_path = dst_path
-        img = cv2.imread(img_path)
+        with timer.span('decode'):
+            img = cv2.imread(img_path)
         img_height, img_width = img.shape[:2]
 
         # Segment lungs and output the probability segmentation maps
         for idx, lung_segmenter in enumerate(self.lung_segmenters):
-            prob_map_ = lung_segmenter.predict(
-                img=img,
-                scale_output=True,
-            )
-            prob_map = cv2.resize(
-                prob_map_,
-                (img_width, img_height),
-                interpolation=cv2.INTER_LANCZOS4,
-            )
-            self.map_fuser.add_prob_map(prob_map)
+            with timer.span(f'segmentation/{lung_segmenter.model_name}'):
+                prob_map_ = lung_segmenter.predict(
+                    img=img,
+                    scale_output=True,
+                    timer=timer,
+                )
+            with timer.span('resize'):
+                prob_map = cv2.resize(
+                    prob_map_,
+                    (img_width, img_height),
+                    interpolation=cv2.INTER_LANCZOS4,
+                )
+            with timer.span('fusion'):
+                self.map_fuser.add_prob_map(prob_map)
             map_path = os.path.join(
                 img_dir,
                 f'{self.MAP_PREFIX}_{lung_segmenter.model_name}.png',
             )
-            cv2.imwrite(map_path, prob_map)
+            with timer.span('write'):
+                cv2.imwrite(map_path, prob_map)
 
         # Merge probability segmentation maps into a single map
-        fused_map = self.map_fuser.conditional_probability_fusion(scale_output=True)
+        with timer.span('fusion'):
+            fused_map = self.map_fuser.conditional_probability_fusion(scale_output=True)
         fused_map_path = os.path.join(img_dir, self.MAP_NAME)
-        cv2.imwrite(fused_map_path, fused_map)
+        with timer.span('write'):
+            cv2.imwrite(fused_map_path, fused_map)
 
         # Process the fused map and get the final segmentation mask
-        mask_bin = self.mask_processor.binarize_image(image=fused_map)
-        mask_smooth = self.mask_processor.smooth_mask(mask=mask_bin)
-        mask_clean = self.mask_processor.remove_artifacts(mask=mask_smooth)
+        with timer.span('mask processing'):
+            mask_bin = self.mask_processor.binarize_image(image=fused_map)
+            mask_smooth = self.mask_processor.smooth_mask(mask=mask_bin)
+            mask_clean = self.mask_processor.remove_artifacts(mask=mask_smooth)
         mask_path = os.path.join(img_dir, self.MASK_NAME)
-        cv2.imwrite(mask_path, mask_clean)
+        with timer.span('write'):
+            cv2.imwrite(mask_path, mask_clean)
 
         # Extract the coordinates of the lungs and expand them if necessary
-        lungs_metadata = compute_lungs_metadata(mask=mask_clean)
+        with timer.span('mask processing'):
+            lungs_metadata = compute_lungs_metadata(mask=mask_clean)
         lung_coords_ = (
             lungs_metadata['x1'],
             lungs_metadata['y1'],
@@ -112,41 +151,51 @@ class EdemaNet:
         )
 
         # Process image and mask which are used by an object detector
-        img_crop = process_image(
-            img=img,
-            x1=lungs_coords[0],
-            y1=lungs_coords[1],
-            x2=lungs_coords[2],
-            y2=lungs_coords[3],
-            output_size=self.img_size,
-        )
+        with timer.span('crop'):
+            img_crop = process_image(
+                img=img,
+                x1=lungs_coords[0],
+                y1=lungs_coords[1],
+                x2=lungs_coords[2],
+                y2=lungs_coords[3],
+                output_size=self.img_size,
+            )
         img_crop_path = os.path.join(img_dir, f'{img_stem}.png')
-        cv2.imwrite(img_crop_path, img_crop)
-        mask_crop = process_image(
-            img=mask_clean,
-            x1=lungs_coords[0],
-            y1=lungs_coords[1],
-            x2=lungs_coords[2],
-            y2=lungs_coords[3],
-            output_size=self.img_size,
-        )
+        with timer.span('write'):
+            cv2.imwrite(img_crop_path, img_crop)
+        with timer.span('crop'):
+            mask_crop = process_image(
+                img=mask_clean,
+                x1=lungs_coords[0],
+                y1=lungs_coords[1],
+                x2=lungs_coords[2],
+                y2=lungs_coords[3],
+                output_size=self.img_size,
+            )
         mask_crop_path = os.path.join(img_dir, self.MASK_CROP_NAME)
-        cv2.imwrite(mask_crop_path, mask_crop)
+        with timer.span('write'):
+            cv2.imwrite(mask_crop_path, mask_crop)
 
         # Recognize features and perform NMS
         df_dets_list = []
         for idx, feature_detector in enumerate(self.feature_detectors):
-            dets = feature_detector.predict(img=img_crop)
-            df_dets = feature_detector.process_detections(
-                img_path=img_crop_path,
-                detections=dets,
-            )
-            df_nms = self.non_max_suppressor.suppress_detections(df=df_dets)
+            with timer.span(f'detection/{feature_detector.model_name}'):
+                dets = feature_detector.predict(img=img_crop, timer=timer)
+                df_dets = feature_detector.process_detections(
+                    img_path=img_crop_path,
+                    detections=dets,
+                )
+            with timer.span('nms'):
+                df_nms = self.non_max_suppressor.suppress_detections(df=df_dets)
             df_dets_list.append(df_nms)
-        df = pd.concat(df_dets_list)
-
-        # Assign an edema class to an image
-        df_out = self.edema_classifier.classify(df=df)
+        with timer.span('merge'):
+            df = pd.concat(df_dets_list)
+
+        # Assign an edema class to an image (skipped if a batch of images is classified later)
+        if not classify:
+            return df
+        with timer.span('classification'):
+            df_out = self.edema_classifier.classify(df=df)
 
         return df_out
 
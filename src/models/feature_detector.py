@@ -1,6 +1,6 @@
 import logging
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import cv2
 import numpy as np
@@ -8,8 +8,9 @@ import pandas as pd
 import torch
 from mmdet.apis import inference_detector, init_detector
 
-from src.data.utils import get_file_list
+from src.data.utils import get_file_list, probe_image_size
 from src.data.utils_sly import FEATURE_MAP
+from src.models.stage_timer import NULL_TIMER, StageTimer
 
 
 class FeatureDetector:
@@ -22,6 +23,9 @@ class FeatureDetector:
         iou_threshold: float = 0.5,
         device: str = 'auto',
     ):
+        # Name the model after its network and feature (e.g. SABL/bat)
+        self.model_name = '/'.join(Path(model_dir).parts[-2:])
+
         # Get config path
         config_list = get_file_list(
             src_dirs=model_dir,
@@ -79,8 +83,11 @@ class FeatureDetector:
     def predict(
         self,
         img: np.ndarray,
+        timer: Optional[StageTimer] = None,
     ) -> List[np.ndarray]:
-        detections = inference_detector(model=self.model, imgs=img)
+        timer = timer if timer is not None else NULL_TIMER
+        with timer.span(f'detection/{self.model_name}/inference'):
+            detections = inference_detector(model=self.model, imgs=img)
 
         return detections
 
@@ -107,7 +114,7 @@ class FeatureDetector:
         ]
 
         df = pd.DataFrame(columns=columns)
-        img_height, img_width = cv2.imread(img_path).shape[:2]
+        img_height, img_width = probe_image_size(img_path)
 
         # Return a 1-row dataframe if there are no detections
         if all(len(arr) == 0 for arr in detections):
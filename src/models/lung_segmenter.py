@@ -1,7 +1,7 @@
 import json
 import logging
 import os
-from typing import Any
+from typing import Any, List, Optional
 
 import cv2
 import numpy as np
@@ -9,6 +9,7 @@ import torch
 import torchvision.transforms as transforms
 
 from src.models import smp
+from src.models.stage_timer import NULL_TIMER, StageTimer
 
 
 class LungSegmenter:
@@ -162,13 +163,44 @@ class LungSegmenter:
         self,
         img: np.ndarray,
         scale_output: bool = True,
+        timer: Optional[StageTimer] = None,
     ) -> np.ndarray:
-        img_tensor = torch.unsqueeze(self.preprocess_image(img), dim=0).to(self.device)
-        prob_map = self.model(img_tensor)[0, 0, :, :].cpu().detach().numpy()
+        timer = timer if timer is not None else NULL_TIMER
+        prefix = f'segmentation/{self.model_name}'
+        with timer.span(f'{prefix}/preprocessing'):
+            img_tensor = torch.unsqueeze(self.preprocess_image(img), dim=0).to(self.device)
+        with timer.span(f'{prefix}/inference'):
+            prob_map = self.model(img_tensor)[0, 0, :, :].cpu().detach().numpy()
         if scale_output:
             prob_map = (prob_map * 255).astype(np.uint8)
         return prob_map
 
+    def predict_batch(
+        self,
+        imgs: List[np.ndarray],
+        scale_output: bool = True,
+        timer: Optional[StageTimer] = None,
+    ) -> List[np.ndarray]:
+        """Predict probability maps of several images in a single forward pass.
+
+        Args:
+            imgs: list of images of any size, each is resized to the input size of the model
+            scale_output: if True, maps are scaled to uint8 [0, 255]
+            timer: optional timer of the preprocessing and inference stages
+        Returns:
+            prob_maps: list of probability maps of the input size
+        """
+        timer = timer if timer is not None else NULL_TIMER
+        prefix = f'segmentation/{self.model_name}'
+        with timer.span(f'{prefix}/preprocessing'):
+            img_tensor = torch.stack([self.preprocess_image(img) for img in imgs]).to(self.device)
+        with timer.span(f'{prefix}/inference'):
+            with torch.no_grad():
+                prob_maps = self.model(img_tensor)[:, 0, :, :].cpu().numpy()
+        if scale_output:
+            prob_maps = (prob_maps * 255).astype(np.uint8)
+        return list(prob_maps)
+
 
 if __name__ == '__main__':
     model_name = 'DeepLabV3+'
@@ -33,17 +33,17 @@ class MapFuser:
         assert len(self.prob_maps) > 0, 'No prob_maps have been added'
 
         if len(self.prob_maps) == 1:
-            return self.prob_maps[0]
-
-        # Calculate the conditional probability fusion
-        img_height, img_width = self.prob_maps[0].shape[:2]
-        prob_product = np.prod(self.prob_maps, axis=0)
-        fused_map = np.array(
-            [
-                [self.calculate_probability(prob_product[y, x]) for x in range(img_width)]
-                for y in range(img_height)
-            ],
-        )
+            fused_map = self.prob_maps[0]
+        else:
+            # Calculate the conditional probability fusion
+            img_height, img_width = self.prob_maps[0].shape[:2]
+            prob_product = np.prod(self.prob_maps, axis=0)
+            fused_map = np.array(
+                [
+                    [self.calculate_probability(prob_product[y, x]) for x in range(img_width)]
+                    for y in range(img_height)
+                ],
+            )
 
         if scale_output:
             fused_map = (fused_map * 255.0).astype(np.uint8)
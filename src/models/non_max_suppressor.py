@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 from ensemble_boxes import nms, soft_nms
 
+from src.data.utils import load_conf_thresholds
 from src.data.utils_sly import FEATURE_MAP_REVERSED
 
 
@@ -26,6 +27,28 @@ class NonMaxSuppressor:
         self.conf_thresholds = conf_thresholds
         self.sigma = sigma
 
+    @classmethod
+    def from_file(
+        cls,
+        thresholds_path: str,
+        model_name: str,
+        **kwargs,
+    ) -> 'NonMaxSuppressor':
+        """Create a suppressor with the confidence thresholds stored for a detection model.
+
+        Args:
+            thresholds_path: a path to the YAML file with per-model thresholds
+            model_name: name of the detection model (e.g. SABL)
+            **kwargs: other arguments of NonMaxSuppressor
+        Returns:
+            an instance of NonMaxSuppressor
+        """
+        conf_thresholds = load_conf_thresholds(
+            thresholds_path=thresholds_path,
+            model_name=model_name,
+        )
+        return cls(conf_thresholds=conf_thresholds, **kwargs)
+
     def suppress_detections(
         self,
         df: pd.DataFrame,
@@ -18,6 +18,8 @@ from torch import nn
 from torchmetrics.functional.classification import multilabel_f1_score
 from transient_layers import ITransientLayers
 
+from src.data.data_classes_utils import split_batch
+
 
 class EdemaPrototypeNet(pl.LightningModule):
     """Prototype edema model class.
@@ -165,13 +167,21 @@ class EdemaPrototypeNet(pl.LightningModule):
             _print_status_bar(self.trainer, self.blocks, status='JOINT')
             self._real_epoch += 1
 
+    def _get_push_dataloader(self):
+        # The push records prototype images by their position in the loader, so it iterates over
+        # the train subset in order even if the train loader shuffles it
+        datamodule = getattr(self.trainer, 'datamodule', None)
+        if datamodule is None:
+            return self.trainer.train_dataloader.loaders
+        return datamodule.train_dataloader(shuffle=False, persistent_workers=False)
+
     def on_train_epoch_end(self):
         # Here we update prototypes and check the performance of the model.
         if self._real_epoch >= self.push_start and self._real_epoch in self.push_epochs:
             if self._last_step == self._num_last_epochs:
                 self.prototype_layer.update(
                     self,
-                    self.trainer.train_dataloader.loaders,
+                    self._get_push_dataloader(),
                     self._prototype_logger,
                 )
                 self._training_status = 'last'
@@ -302,18 +312,13 @@ class EdemaPrototypeNet(pl.LightningModule):
     #     return d
 
     def train_val_test(self, batch):
-        images, labels = batch
-        images = images.cuda()
-        labels = labels.cuda()
-        # labels - (batch, 7), dtype: float32
-        # images - (batch, 10, H, W)
-        # images have to have the shape (batch, 10, H, W). 7 extra channel implies fine annotations,
-        # in case of 7 classes
-        if images.shape[1] != 12:
-            raise Exception('The channel dimension of the input-image batch has to be 10')
-
-        fine_annotations = images[:, 3:12, :, :]  # 9 classes of fine annotations
-        images = images[:, 0:3, :, :]  # (no view, create slice)
+        # labels - (batch, 9), dtype: float32
+        # images - (batch, 3, H, W)
+        # fine_annotations - (batch, 9, H, W), 9 classes of fine annotations unpacked on the GPU
+        # from bit-packed masks, dtype: uint8
+        images, fine_annotations, labels = split_batch(batch, device='cuda')
+        if images.shape[1] + fine_annotations.shape[1] != 12:
+            raise Exception('The channel dimension of the input-image batch has to be 12')
 
         # images = images.cuda()
         # labels = labels.cuda()
@@ -517,7 +522,7 @@ class EdemaPrototypeNet(pl.LightningModule):
         """Returns fine cost.
 
         Args:
-            fine_annotations (torch.Tensor): (batch, num_classes, H, W)
+            fine_annotations (torch.Tensor): (batch, num_classes, H, W), float or uint8
             upsampled_activations (torch.Tensor): (batch, num_prototypes, H, W)
             num_prototypes_per_class (int): number of prototypes per class
 
@@ -525,8 +530,17 @@ class EdemaPrototypeNet(pl.LightningModule):
             torch.Tensor: fine cost of size (1,) forces activating the prototypes in the
                           mask-allowed regions (fine annotations)
         """
-        fine_annotations = torch.repeat_interleave(fine_annotations, num_prototypes_per_class, 1)
-        fine_cost = torch.norm(upsampled_activations * fine_annotations)
+        # Broadcast the class masks over the prototypes of each class instead of repeating them
+        batch, num_prototypes, height, width = upsampled_activations.shape
+        upsampled_activations = upsampled_activations.reshape(
+            batch,
+            num_prototypes // num_prototypes_per_class,
+            num_prototypes_per_class,
+            height,
+            width,
+        )
+        # uint8 masks are promoted to the dtype of the activations by the multiplication
+        fine_cost = torch.norm(upsampled_activations * fine_annotations.unsqueeze(2))
 
         return fine_cost
 
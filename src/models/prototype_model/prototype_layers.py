@@ -11,6 +11,8 @@ from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 from utils import copy_tensor_to_nparray
 
+from src.data.data_classes_utils import split_batch
+
 T = TypeVar('T')
 
 
@@ -144,7 +146,7 @@ class PrototypeLayer(nn.Parameter, IPrototypeLayer):
         batch_index: int,
         logger: Optional[IPrototypeLogger] = None,
     ):
-        images, masks, labels = _split_batch(batch)
+        images, masks, labels = split_batch(batch)
         proto_layer_input, proto_distances = self._get_input_output_of_proto_layer(model, images)
         class_to_img_index_dict = _form_class_to_img_index_dict(self.num_classes, labels)
 
@@ -441,14 +443,6 @@ class PrototypeLayer(nn.Parameter, IPrototypeLayer):
         self.requires_grad_(False)
 
 
-def _split_batch(batch: torch.Tensor) -> torch.Tensor:
-    images_and_masks = batch[0]
-    images = images_and_masks[:, 0:3, :, :]
-    masks = images_and_masks[:, 3:, :, :]
-    labels = batch[1]
-    return images, masks, labels
-
-
 def _get_batch_index(iter: int, batch_size: int) -> int:
     return iter * batch_size
 
@@ -482,7 +476,7 @@ def _get_img(batch_imgs: torch.Tensor, num_img: int) -> np.ndarray:
 def _get_masks(batch_masks: torch.Tensor, num_masks: int) -> np.ndarray:
     # Returns masks for the image with the shoretest prototype distance in numpy array format
     masks = batch_masks[num_masks]
-    masks_np = masks.numpy()
+    masks_np = masks.to(torch.float32).numpy()
     return masks_np
 
 
@@ -64,10 +64,9 @@ def main(cfg: DictConfig):
         batch_size=cfg.model.batch_size,
         resize=(cfg.model.img_size, cfg.model.img_size),
         normalize_tensors=False,  # normalization leads to the malfanctioning of saving_graphics
+        cache_dir='data/interim_cache',  # built by src/data/cache_dataset.py, optional
+        **cfg.loader,
     )
-    datamaodlule.setup('fit')
-    train_dataloader = datamaodlule.train_dataloader(num_workers=cfg.model.num_cpu)
-    test_dataloader = datamaodlule.test_dataloader(num_workers=cfg.model.num_cpu)
 
     # create model checkpoint and trainer and start training
     checkpoint = ModelCheckpoint(
@@ -86,7 +85,8 @@ def main(cfg: DictConfig):
         callbacks=[PNetProgressBar(), checkpoint],
         deterministic=False,
     )
-    trainer.fit(edema_net, train_dataloaders=train_dataloader, val_dataloaders=test_dataloader)
+    # the data module is attached to the trainer, so that it augments train batches on the GPU
+    trainer.fit(edema_net, datamodule=datamaodlule)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class StageTimer:
+    """StageTimer is a class for measuring the duration of named pipeline stages.
+
+    Durations of a stage entered several times (e.g. image writes) are accumulated. Every span is
+    also recorded as an event so that the timeline can be exported as a Chrome trace. If
+    track_memory is set, the growth of the peak resident set size during each stage is recorded.
+    A disabled timer returns no-op spans, so the instrumented code has almost no overhead.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        track_memory: bool = False,
+    ) -> None:
+        if track_memory and resource is None:
+            logging.warning('Peak RSS is not available on this platform, memory is not tracked')
+            track_memory = False
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.durations: Dict[str, float] = {}
+        self.rss_deltas: Dict[str, float] = {}
+        self.events: List[dict] = []
+        self.origin = time.perf_counter()
+
+    def span(
+        self,
+        name: str,
+    ) -> ContextManager:
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(timer=self, name=name)
+
+    def add(
+        self,
+        name: str,
+        duration: float,
+        rss_delta: Optional[float] = None,
+    ) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + duration
+        if rss_delta is not None:
+            self.rss_deltas[name] = self.rss_deltas.get(name, 0.0) + rss_delta
+
+    def record(
+        self,
+        name: str,
+        start: float,
+        duration: float,
+        rss_delta: Optional[float] = None,
+    ) -> None:
+        self.add(name=name, duration=duration, rss_delta=rss_delta)
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': duration * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        if rss_delta is not None:
+            event['args'] = {'Peak RSS delta, MB': rss_delta}
+        self.events.append(event)
+
+    def get_metadata(self) -> Dict[str, float]:
+        """Return the stage durations (and peak RSS deltas) as metadata columns."""
+        metadata = {
+            f'Time {name}, ms': round(duration * 1000, 3)
+            for name, duration in self.durations.items()
+        }
+        metadata.update(
+            {
+                f'Peak RSS delta {name}, MB': round(delta, 3)
+                for name, delta in self.rss_deltas.items()
+            },
+        )
+        return metadata
+
+    def export_chrome_trace(
+        self,
+        save_path: str,
+    ) -> None:
+        """Save the recorded spans in the Chrome trace format (chrome://tracing or Perfetto)."""
+        os.makedirs(Path(save_path).parent, exist_ok=True)
+        with open(save_path, 'w') as file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
+
+    def reset(self) -> None:
+        self.durations = {}
+        self.rss_deltas = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+
+# nullcontext is reusable, so disabled timers share a single no-op span
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    def __init__(
+        self,
+        timer: StageTimer,
+        name: str,
+    ) -> None:
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+        self.peak_rss = 0.0
+
+    def __enter__(self) -> '_Span':
+        if self.timer.track_memory:
+            self.peak_rss = get_peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        duration = time.perf_counter() - self.start
+        rss_delta = get_peak_rss() - self.peak_rss if self.timer.track_memory else None
+        self.timer.record(
+            name=self.name,
+            start=self.start,
+            duration=duration,
+            rss_delta=rss_delta,
+        )
+
+
+def get_peak_rss() -> float:
+    """Return the peak resident set size of the current process in megabytes."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak_rss / 2**20 if sys.platform == 'darwin' else peak_rss / 2**10
+
+
+@contextmanager
+def torch_profiler(
+    save_path: Optional[str] = None,
+    enabled: bool = True,
+) -> Iterator[None]:
+    """Capture CPU and CUDA activity with torch.profiler and save it as a Chrome trace.
+
+    Args:
+        save_path: path to the trace file
+        enabled: if False, nothing is captured
+    """
+    if not enabled:
+        yield
+        return
+
+    import torch
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+        yield
+    if save_path is not None:
+        os.makedirs(Path(save_path).parent, exist_ok=True)
+        profiler.export_chrome_trace(save_path)
+
+
+# A shared disabled timer used when no timer is passed to the pipeline
+NULL_TIMER = StageTimer(enabled=False)
@@ -0,0 +1,388 @@
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from src.data.utils import load_conf_thresholds, save_conf_thresholds
+from src.data.utils_metadata import read_metadata
+from src.models.edema_classifier import FEATURE_SEVERITY
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+METRICS = [
+    'Accuracy',
+    'Macro precision',
+    'Macro recall',
+    'Macro F1',
+    'Weighted F1',
+]
+
+
+def get_max_scores(
+    df_pred: pd.DataFrame,
+    img_names: List[str],
+    features: List[str],
+) -> np.ndarray:
+    """Compute the maximum detection score of each feature on each image.
+
+    An image is assigned a feature for a given threshold vector if and only if its maximum score of
+    this feature reaches the threshold, so this matrix is all that is needed to classify the images.
+
+    Args:
+        df_pred: predicted metadata
+        img_names: names of images to classify
+        features: list of features
+    Returns:
+        max_scores: an array of shape (num_images, num_features), -1 if a feature is not detected
+    """
+    df_max = df_pred.pivot_table(
+        index='Image name',
+        columns='Feature',
+        values='Confidence',
+        aggfunc='max',
+    )
+    df_max = df_max.reindex(index=img_names, columns=features)
+    max_scores = df_max.fillna(-1).to_numpy(dtype=float)
+    return max_scores
+
+
+def assign_classes(
+    max_scores: np.ndarray,
+    thresholds: np.ndarray,
+    severities: np.ndarray,
+) -> np.ndarray:
+    """Assign edema classes to images for a batch of threshold vectors.
+
+    This is the vectorized form of EdemaClassifier rules applied to thresholded detections.
+
+    Args:
+        max_scores: an array of shape (num_images, num_features)
+        thresholds: an array of shape (num_candidates, num_features)
+        severities: an array of shape (num_features,) with the class implied by each feature
+    Returns:
+        class_ids: an array of shape (num_candidates, num_images)
+    """
+    is_present = max_scores[np.newaxis, :, :] >= thresholds[:, np.newaxis, :]
+    class_ids = (is_present * severities).max(axis=2)
+    return class_ids
+
+
+def compute_metrics(
+    gt_labels: np.ndarray,
+    pred_labels: np.ndarray,
+    labels: List[int],
+) -> pd.DataFrame:
+    """Compute classification metrics for a batch of predictions.
+
+    The metrics follow sklearn.metrics.classification_report used in classification_evaluator with
+    zero_division=0. Averaging is done over the classes in labels.
+
+    Args:
+        gt_labels: an array of shape (num_images,) with ground truth class IDs
+        pred_labels: an array of shape (num_candidates, num_images) with predicted class IDs
+        labels: class IDs used for averaging
+    Returns:
+        df: one row of metrics per candidate
+    """
+    num_labels = max(max(labels), int(pred_labels.max()), int(gt_labels.max())) + 1
+    num_candidates = pred_labels.shape[0]
+
+    # Confusion matrices of all candidates at once: (num_candidates, num_labels, num_labels)
+    offsets = np.arange(num_candidates)[:, np.newaxis] * num_labels**2
+    flat_idx = offsets + gt_labels[np.newaxis, :] * num_labels + pred_labels
+    confusion = np.bincount(flat_idx.ravel(), minlength=num_candidates * num_labels**2)
+    confusion = confusion.reshape(num_candidates, num_labels, num_labels)
+
+    tp = confusion[:, labels, labels]
+    support = confusion.sum(axis=2)[:, labels]
+    predicted = confusion.sum(axis=1)[:, labels]
+    precision = np.divide(tp, predicted, out=np.zeros(tp.shape), where=predicted > 0)
+    recall = np.divide(tp, support, out=np.zeros(tp.shape), where=support > 0)
+    f1 = np.divide(
+        2 * precision * recall,
+        precision + recall,
+        out=np.zeros(tp.shape),
+        where=(precision + recall) > 0,
+    )
+    weights = support / np.maximum(support.sum(axis=1, keepdims=True), 1)
+
+    df = pd.DataFrame(
+        {
+            'Accuracy': (gt_labels[np.newaxis, :] == pred_labels).mean(axis=1),
+            'Macro precision': precision.mean(axis=1),
+            'Macro recall': recall.mean(axis=1),
+            'Macro F1': f1.mean(axis=1),
+            'Weighted F1': (f1 * weights).sum(axis=1),
+        },
+    )
+
+    return df
+
+
+def evaluate_candidates(
+    max_scores: np.ndarray,
+    gt_labels: np.ndarray,
+    thresholds: np.ndarray,
+    severities: np.ndarray,
+    labels: List[int],
+    chunk_size: int = 1000,
+) -> pd.DataFrame:
+    # Process candidates in chunks to bound the memory used by the presence tensor
+    df_list = []
+    for start in range(0, len(thresholds), chunk_size):
+        thresholds_chunk = thresholds[start : start + chunk_size]
+        pred_labels = assign_classes(max_scores, thresholds_chunk, severities)
+        df_list.append(compute_metrics(gt_labels, pred_labels, labels))
+    df = pd.concat(df_list, ignore_index=True)
+    return df
+
+
+def get_candidate_values(
+    max_scores: np.ndarray,
+) -> List[np.ndarray]:
+    # Thresholds only matter at the observed scores, plus the highest possible threshold
+    candidate_values = []
+    for feature_scores in max_scores.T:
+        values = np.unique(feature_scores[feature_scores >= 0])
+        candidate_values.append(np.union1d(values, [1.0]))
+    return candidate_values
+
+
+def random_search(
+    candidate_values: List[np.ndarray],
+    num_candidates: int,
+    seed: int = 11,
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    thresholds = np.stack(
+        [rng.choice(values, size=num_candidates) for values in candidate_values],
+        axis=1,
+    )
+    return thresholds
+
+
+def coordinate_descent(
+    max_scores: np.ndarray,
+    gt_labels: np.ndarray,
+    severities: np.ndarray,
+    labels: List[int],
+    candidate_values: List[np.ndarray],
+    init_thresholds: np.ndarray,
+    target_metric: str,
+    max_iterations: int = 10,
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Maximize the target metric by optimizing one feature threshold at a time.
+
+    Args:
+        max_scores: an array of shape (num_images, num_features)
+        gt_labels: an array of shape (num_images,) with ground truth class IDs
+        severities: an array of shape (num_features,) with the class implied by each feature
+        labels: class IDs used for averaging
+        candidate_values: candidate thresholds of each feature
+        init_thresholds: an array of shape (num_features,) to start from
+        target_metric: one of METRICS
+        max_iterations: maximum number of sweeps over all features
+    Returns:
+        thresholds: all evaluated threshold vectors
+        df: metrics of the evaluated threshold vectors
+    """
+    best = init_thresholds.astype(float).copy()
+    best_score = -np.inf
+    thresholds_list = []
+    df_list = []
+    for _ in range(max_iterations):
+        improved = False
+        for feature_idx, values in enumerate(candidate_values):
+            thresholds = np.repeat(best[np.newaxis, :], len(values), axis=0)
+            thresholds[:, feature_idx] = values
+            df = evaluate_candidates(max_scores, gt_labels, thresholds, severities, labels)
+            thresholds_list.append(thresholds)
+            df_list.append(df)
+
+            idx = int(df[target_metric].to_numpy().argmax())
+            if df[target_metric].iloc[idx] > best_score:
+                best_score = df[target_metric].iloc[idx]
+                best = thresholds[idx].copy()
+                improved = True
+        if not improved:
+            break
+
+    return np.concatenate(thresholds_list), pd.concat(df_list, ignore_index=True)
+
+
+def get_pareto_mask(
+    values: np.ndarray,
+) -> np.ndarray:
+    """Find points that are not dominated by any other point (all objectives are maximized).
+
+    Args:
+        values: an array of shape (num_points, num_objectives)
+    Returns:
+        is_optimal: boolean mask of Pareto-optimal points
+    """
+    is_optimal = np.ones(len(values), dtype=bool)
+    for idx, point in enumerate(values):
+        if not is_optimal[idx]:
+            continue
+        is_dominated = np.all(values <= point, axis=1) & np.any(values < point, axis=1)
+        is_optimal[is_dominated] = False
+    return is_optimal
+
+
+def search_thresholds(
+    df_gt: pd.DataFrame,
+    df_pred: pd.DataFrame,
+    features: List[str],
+    init_thresholds: Dict[str, float],
+    num_candidates: int = 5000,
+    target_metric: str = 'Accuracy',
+    pareto_metrics: List[str] = None,
+    seed: int = 11,
+) -> pd.DataFrame:
+    """Search feature thresholds that maximize image-level classification metrics.
+
+    Args:
+        df_gt: ground truth metadata with the class of each image
+        df_pred: predicted metadata with the detections of each image
+        features: list of features whose thresholds are optimized
+        init_thresholds: current thresholds, used as a starting point and as a reference
+        num_candidates: number of random threshold vectors
+        target_metric: metric maximized by coordinate descent
+        pareto_metrics: metrics used to select Pareto-optimal settings
+        seed: random seed
+    Returns:
+        df: Pareto-optimal settings sorted by the target metric
+    """
+    pareto_metrics = pareto_metrics if pareto_metrics else METRICS
+    assert target_metric in METRICS, f'Unknown metric: {target_metric}'
+    assert all(
+        metric in METRICS for metric in pareto_metrics
+    ), f'Unknown metric in {pareto_metrics}'
+
+    df_gt = df_gt.drop_duplicates(subset=['Image name']).sort_values('Image name')
+    img_names = df_gt['Image name'].tolist()
+    gt_labels = df_gt['Class ID'].to_numpy(dtype=int)
+    labels = sorted(set(gt_labels.tolist()))
+    severities = np.array([FEATURE_SEVERITY[feature] for feature in features])
+
+    max_scores = get_max_scores(df_pred, img_names, features)
+    candidate_values = get_candidate_values(max_scores)
+    init = np.array([init_thresholds.get(feature, 1.0) for feature in features], dtype=float)
+
+    # Evaluate the reference, random candidates and the coordinate descent path
+    thresholds_random = np.concatenate(
+        [init[np.newaxis, :], random_search(candidate_values, num_candidates, seed)],
+    )
+    df_random = evaluate_candidates(max_scores, gt_labels, thresholds_random, severities, labels)
+    df_random['Search'] = ['reference'] + ['random'] * num_candidates
+
+    thresholds_descent, df_descent = coordinate_descent(
+        max_scores=max_scores,
+        gt_labels=gt_labels,
+        severities=severities,
+        labels=labels,
+        candidate_values=candidate_values,
+        init_thresholds=init,
+        target_metric=target_metric,
+    )
+    df_descent['Search'] = 'coordinate descent'
+
+    thresholds = np.concatenate([thresholds_random, thresholds_descent])
+    df = pd.concat([df_random, df_descent], ignore_index=True)
+    df[features] = thresholds
+    log.info(f'Evaluated threshold vectors: {len(df)}')
+    log.info(f'Reference {target_metric.lower()}: {df_random.at[0, target_metric]:.3f}')
+
+    # Keep unique Pareto-optimal settings
+    df = df.drop_duplicates(subset=pareto_metrics)
+    df = df[get_pareto_mask(df[pareto_metrics].to_numpy())]
+    df = df.sort_values(target_metric, ascending=False)
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
+def _read_metadata(
+    gt_path: str,
+    pred_path: str,
+    split: str = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    df_gt = read_metadata(gt_path)
+    df_pred = read_metadata(pred_path)
+    df_gt = df_gt.dropna(subset=['Class ID'])
+    if split:
+        df_gt = df_gt[df_gt['Split'] == split]
+
+    # Images without detections are kept in df_gt and classified as 'No edema'
+    df_gt = df_gt[df_gt['Image name'].isin(df_pred['Image name'])]
+    df_pred = df_pred.dropna(subset=['Feature', 'Confidence'])
+
+    return df_gt, df_pred
+
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='optimize_classification',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+
+    model_name = cfg.model_name if cfg.model_name else Path(cfg.pred_path).parent.name
+    df_gt, df_pred = _read_metadata(
+        gt_path=cfg.gt_path,
+        pred_path=cfg.pred_path,
+        split=cfg.split,
+    )
+    log.info(f'Model.....................: {model_name}')
+    log.info(f'Number of images..........: {df_gt["Image name"].nunique()}')
+
+    init_thresholds = load_conf_thresholds(
+        thresholds_path=cfg.conf_thresholds_path,
+        model_name=model_name,
+    )
+    df = search_thresholds(
+        df_gt=df_gt,
+        df_pred=df_pred,
+        features=cfg.features,
+        init_thresholds=init_thresholds,
+        num_candidates=cfg.num_candidates,
+        target_metric=cfg.target_metric,
+        pareto_metrics=cfg.pareto_metrics,
+        seed=cfg.seed,
+    )
+    log.info(f'Pareto-optimal settings:\n\n{df.to_string()}\n')
+
+    # Save Pareto-optimal settings
+    save_dir = os.path.join(cfg.save_dir, model_name)
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, 'classification_thresholds.xlsx')
+    df.index += 1
+    df.to_excel(
+        save_path,
+        sheet_name='Thresholds',
+        index=True,
+        index_label='ID',
+    )
+
+    # Optionally store the best thresholds to be used by the pipeline
+    if cfg.save_thresholds:
+        best_thresholds = {feature: df.at[1, feature] for feature in cfg.features}
+        save_conf_thresholds(
+            conf_thresholds=best_thresholds,
+            thresholds_path=cfg.conf_thresholds_path,
+            model_name=model_name,
+        )
+        log.info(f'Thresholds saved to.......: {cfg.conf_thresholds_path}')
+
+    log.info('Complete')
+
+
+if __name__ == '__main__':
+    main()
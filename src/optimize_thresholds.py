@@ -0,0 +1,303 @@
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from src.data.utils import save_conf_thresholds
+from src.data.utils_metadata import read_metadata
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+OBJECTIVES = ['f1', 'f2', 'recall_at_precision']
+
+
+def compute_iou_matrix(
+    boxes_a: np.ndarray,
+    boxes_b: np.ndarray,
+) -> np.ndarray:
+    """Compute pairwise IoU between two sets of boxes.
+
+    The inclusive pixel convention of object_detection_metrics (area = (x2 - x1 + 1) * (y2 - y1 + 1))
+    is used so that the thresholds agree with the ones derived from detection_metrics.xlsx.
+
+    Args:
+        boxes_a: an array of shape (N, 4) with boxes in (x1, y1, x2, y2) format
+        boxes_b: an array of shape (M, 4) with boxes in (x1, y1, x2, y2) format
+    Returns:
+        iou: an array of shape (N, M) with IoU values
+    """
+    boxes_a = boxes_a[:, np.newaxis, :]
+    boxes_b = boxes_b[np.newaxis, :, :]
+    inter_w = (
+        np.minimum(boxes_a[..., 2], boxes_b[..., 2])
+        - np.maximum(boxes_a[..., 0], boxes_b[..., 0])
+        + 1
+    )
+    inter_h = (
+        np.minimum(boxes_a[..., 3], boxes_b[..., 3])
+        - np.maximum(boxes_a[..., 1], boxes_b[..., 1])
+        + 1
+    )
+    inter_area = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0] + 1) * (boxes_a[..., 3] - boxes_a[..., 1] + 1)
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0] + 1) * (boxes_b[..., 3] - boxes_b[..., 1] + 1)
+    iou = inter_area / (area_a + area_b - inter_area)
+    return iou
+
+
+def match_detections(
+    df_gt: pd.DataFrame,
+    df_pred: pd.DataFrame,
+    iou_threshold: float = 0.5,
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Label the detections of a single feature as true or false positives.
+
+    Detections are matched greedily in order of decreasing confidence as in the Pascal VOC
+    evaluation. Since a detection can only be claimed by a ground truth box after all higher-scoring
+    detections have been processed, the TP/FP status of each detection does not depend on the
+    confidence threshold, so the matching is done only once.
+
+    Args:
+        df_gt: ground truth boxes of one feature
+        df_pred: predicted boxes of the same feature
+        iou_threshold: IoU threshold indicating which detections are considered TP or FP
+    Returns:
+        scores: confidence scores sorted in decreasing order
+        is_tp: 1/0 flags of the sorted detections
+        num_positives: total number of ground truth boxes
+    """
+    box_columns = ['x1', 'y1', 'x2', 'y2']
+    gt_groups = {
+        img_name: df_img[box_columns].to_numpy(dtype=float)
+        for img_name, df_img in df_gt.groupby('Image name')
+    }
+
+    scores_list: List[np.ndarray] = []
+    tp_list: List[np.ndarray] = []
+    for img_name, df_img in df_pred.groupby('Image name'):
+        df_img = df_img.sort_values('Confidence', ascending=False, kind='mergesort')
+        scores = df_img['Confidence'].to_numpy(dtype=float)
+        is_tp = np.zeros(len(df_img), dtype=np.int8)
+
+        gt_boxes = gt_groups.get(img_name)
+        if gt_boxes is not None:
+            iou = compute_iou_matrix(df_img[box_columns].to_numpy(dtype=float), gt_boxes)
+            best_gt = iou.argmax(axis=1)
+            best_iou = iou[np.arange(len(best_gt)), best_gt]
+            is_matched = np.zeros(len(gt_boxes), dtype=bool)
+            for det_idx in np.flatnonzero(best_iou >= iou_threshold):
+                gt_idx = best_gt[det_idx]
+                if not is_matched[gt_idx]:
+                    is_matched[gt_idx] = True
+                    is_tp[det_idx] = 1
+
+        scores_list.append(scores)
+        tp_list.append(is_tp)
+
+    num_positives = len(df_gt)
+    if not scores_list:
+        return np.empty(0), np.empty(0, dtype=np.int8), num_positives
+
+    scores = np.concatenate(scores_list)
+    is_tp = np.concatenate(tp_list)
+    order = np.argsort(-scores, kind='mergesort')
+
+    return scores[order], is_tp[order], num_positives
+
+
+def compute_threshold_curve(
+    scores: np.ndarray,
+    is_tp: np.ndarray,
+    num_positives: int,
+) -> pd.DataFrame:
+    """Compute detection metrics at every distinct confidence score.
+
+    Args:
+        scores: confidence scores sorted in decreasing order
+        is_tp: 1/0 flags of the sorted detections
+        num_positives: total number of ground truth boxes
+    Returns:
+        df: one row per candidate threshold (keep detections with confidence >= threshold)
+    """
+    acc_tp = np.cumsum(is_tp)
+    acc_fp = np.cumsum(1 - is_tp)
+
+    # A threshold equal to a score keeps every detection with the same score
+    is_last = np.append(scores[1:] != scores[:-1], True)
+    tp = acc_tp[is_last]
+    fp = acc_fp[is_last]
+    precision = tp / (tp + fp)
+    recall = tp / num_positives if num_positives > 0 else np.zeros_like(precision, dtype=float)
+
+    df = pd.DataFrame(
+        {
+            'Confidence': scores[is_last],
+            'Total TP': tp,
+            'Total FP': fp,
+            'Total FN': num_positives - tp,
+            'Precision': precision,
+            'Recall': recall,
+            'F1': calculate_f_beta(precision, recall, beta=1),
+            'F2': calculate_f_beta(precision, recall, beta=2),
+        },
+    )
+
+    return df
+
+
+def calculate_f_beta(
+    precision: np.ndarray,
+    recall: np.ndarray,
+    beta: float = 1,
+) -> np.ndarray:
+    numerator = (1 + beta**2) * precision * recall
+    denominator = beta**2 * precision + recall
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros_like(numerator, dtype=float),
+        where=denominator > 0,
+    )
+
+
+def find_optimal_threshold(
+    df_curve: pd.DataFrame,
+    objective: str = 'f1',
+    min_precision: float = 0.5,
+) -> pd.Series:
+    """Select the threshold maximizing the objective.
+
+    Args:
+        df_curve: metrics at every candidate threshold obtained with compute_threshold_curve
+        objective: 'f1', 'f2' or 'recall_at_precision'
+        min_precision: the lowest acceptable precision for the 'recall_at_precision' objective
+    Returns:
+        row: metrics of the selected threshold
+    """
+    assert objective in OBJECTIVES, f'Unknown objective: {objective}'
+
+    if objective == 'recall_at_precision':
+        df_valid = df_curve[df_curve['Precision'] >= min_precision]
+        if df_valid.empty:
+            log.warning(f'Precision of {min_precision} is not reachable, F1 is used instead')
+            df_valid = df_curve
+            column = 'F1'
+        else:
+            column = 'Recall'
+    else:
+        df_valid = df_curve
+        column = objective.upper()
+
+    # On ties prefer the highest threshold, i.e. the fewest detections
+    row = df_valid.loc[df_valid[column].idxmax()]
+
+    return row
+
+
+def optimize_thresholds(
+    df_gt: pd.DataFrame,
+    df_pred: pd.DataFrame,
+    features: List[str],
+    objective: str = 'f1',
+    min_precision: float = 0.5,
+    iou_threshold: float = 0.5,
+) -> Tuple[Dict[str, float], pd.DataFrame]:
+    """Find per-feature confidence thresholds.
+
+    Args:
+        df_gt: ground truth metadata
+        df_pred: predicted metadata
+        features: list of features to optimize
+        objective: 'f1', 'f2' or 'recall_at_precision'
+        min_precision: the lowest acceptable precision for the 'recall_at_precision' objective
+        iou_threshold: IoU threshold indicating which detections are considered TP or FP
+    Returns:
+        conf_thresholds: a dictionary mapping feature names to confidence thresholds
+        df_report: metrics of the selected thresholds
+    """
+    conf_thresholds: Dict[str, float] = {}
+    rows = []
+    for feature in features:
+        scores, is_tp, num_positives = match_detections(
+            df_gt=df_gt[df_gt['Feature'] == feature],
+            df_pred=df_pred[df_pred['Feature'] == feature],
+            iou_threshold=iou_threshold,
+        )
+        if len(scores) == 0:
+            log.warning(f'No detections of {feature}, threshold is not updated')
+            continue
+
+        df_curve = compute_threshold_curve(scores, is_tp, num_positives)
+        row = find_optimal_threshold(df_curve, objective, min_precision)
+        conf_thresholds[feature] = float(row['Confidence'])
+        rows.append({'Feature': feature, 'Total positives': num_positives, **row.to_dict()})
+
+    df_report = pd.DataFrame(rows)
+
+    return conf_thresholds, df_report
+
+
+def _read_metadata(
+    gt_path: str,
+    pred_path: str,
+    split: str = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    df_gt = read_metadata(gt_path)
+    df_pred = read_metadata(pred_path)
+    df_pred = df_pred.dropna(subset=['Feature', 'Confidence'])
+
+    # Evaluate only images that are present in both sets
+    if split:
+        df_gt = df_gt[df_gt['Split'] == split]
+    df_pred = df_pred[df_pred['Image name'].isin(df_gt['Image name'])]
+    df_gt = df_gt[df_gt['Image name'].isin(df_pred['Image name'])]
+
+    return df_gt, df_pred
+
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='optimize_thresholds',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+
+    model_name = cfg.model_name if cfg.model_name else Path(cfg.pred_path).parent.name
+    log.info(f'Model.....................: {model_name}')
+    log.info(f'Objective.................: {cfg.objective}')
+
+    df_gt, df_pred = _read_metadata(
+        gt_path=cfg.gt_path,
+        pred_path=cfg.pred_path,
+        split=cfg.split,
+    )
+
+    conf_thresholds, df_report = optimize_thresholds(
+        df_gt=df_gt,
+        df_pred=df_pred,
+        features=cfg.features,
+        objective=cfg.objective,
+        min_precision=cfg.min_precision,
+        iou_threshold=cfg.iou_threshold,
+    )
+    log.info(f'Thresholds:\n\n{df_report.to_string(index=False)}\n')
+
+    save_conf_thresholds(
+        conf_thresholds=conf_thresholds,
+        thresholds_path=cfg.save_path,
+        model_name=model_name,
+    )
+    log.info(f'Thresholds saved to.......: {cfg.save_path}')
+
+    log.info('Complete')
+
+
+if __name__ == '__main__':
+    main()
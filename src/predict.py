@@ -8,6 +8,7 @@ from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
 from src.data.utils import get_file_list
+from src.data.utils_metadata import METADATA_NAME, write_metadata
 from src.models.box_fuser import BoxFuser
 from src.models.edema_classifier import EdemaClassifier
 from src.models.edema_net import EdemaNet
@@ -16,31 +17,20 @@ from src.models.lung_segmenter import LungSegmenter
 from src.models.map_fuser import MapFuser
 from src.models.mask_processor import MaskProcessor
 from src.models.non_max_suppressor import NonMaxSuppressor
+from src.models.stage_timer import StageTimer, torch_profiler
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
-@hydra.main(
-    config_path=os.path.join(os.getcwd(), 'configs'),
-    config_name='predict',
-    version_base=None,
-)
-def main(cfg: DictConfig) -> None:
-    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
-
-    # Get list of images to predict
-    img_paths = get_file_list(
-        src_dirs=cfg.data_dir,
-        ext_list=[
-            '.png',
-            '.jpg',
-            '.jpeg',
-            '.bmp',
-        ],
-    )
-    log.info(f'Number of images..........: {len(img_paths)}')
+def build_edema_net(cfg: DictConfig) -> EdemaNet:
+    """Initialize EdemaNet and its components from the prediction config.
 
+    Args:
+        cfg: config containing model directories and pipeline settings (see configs/predict.yaml)
+    Returns:
+        edema_net: an initialized network
+    """
     # Initialize lung segmentation models
     lung_segmenters = []
     for model_dir in cfg.seg_model_dirs:
@@ -71,13 +61,18 @@ def main(cfg: DictConfig) -> None:
         kernel_size=(7, 7),
     )
 
-    # Initialize non-maximum suppressor
-    non_max_suppressor = NonMaxSuppressor(
+    # Initialize non-maximum suppressor with the thresholds of the detection model
+    det_model_names = {Path(model_dir).parent.name for model_dir in cfg.det_model_dirs}
+    assert len(det_model_names) == 1, 'All detection models should belong to the same network'
+    det_model_name = det_model_names.pop()
+    non_max_suppressor = NonMaxSuppressor.from_file(
+        thresholds_path=cfg.conf_thresholds_path,
+        model_name=det_model_name,
         method=cfg.nms_method,
         sigma=0.1,
         iou_threshold=cfg.iou_threshold,
-        conf_thresholds=cfg.conf_thresholds,
     )
+    log.info(f'Confidence thresholds.....: {non_max_suppressor.conf_thresholds}')
 
     # Initialize box fuser
     box_fuser = BoxFuser(
@@ -87,7 +82,7 @@ def main(cfg: DictConfig) -> None:
     # Initialize edema classifier
     edema_classifier = EdemaClassifier()
 
-    edema_net = EdemaNet(
+    return EdemaNet(
         lung_segmenters=lung_segmenters,
         feature_detectors=feature_detectors,
         map_fuser=map_fuser,
@@ -97,26 +92,61 @@ def main(cfg: DictConfig) -> None:
         edema_classifier=edema_classifier,
         img_size=cfg.img_size,
         lung_extension=cfg.lung_extension,
+        materialize_mode=cfg.materialize_mode,
     )
 
-    df = pd.DataFrame()
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='predict',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+
+    # Get list of images to predict
+    img_paths = get_file_list(
+        src_dirs=cfg.data_dir,
+        ext_list=[
+            '.png',
+            '.jpg',
+            '.jpeg',
+            '.bmp',
+        ],
+    )
+    log.info(f'Number of images..........: {len(img_paths)}')
+
+    edema_net = build_edema_net(cfg)
+
+    df_list = []
     for img_path in tqdm(img_paths, desc='Prediction', unit='image'):
-        log.info(f'Processing: {Path(img_path).stem}')
-        df_img = edema_net.predict(
-            img_path=img_path,
-            save_dir=cfg.save_dir,
+        img_stem = Path(img_path).stem
+        log.info(f'Processing: {img_stem}')
+        timer = (
+            StageTimer(track_memory=cfg.profiling.track_memory) if cfg.profiling.enabled else None
         )
-        df = pd.concat([df, df_img])
+        with torch_profiler(
+            save_path=os.path.join(cfg.profiling.trace_dir, f'{img_stem}_torch.json'),
+            enabled=cfg.profiling.torch_profiler,
+        ):
+            df_img = edema_net.predict(
+                img_path=img_path,
+                save_dir=cfg.save_dir,
+                classify=False,
+                timer=timer,
+            )
+        if timer is not None:
+            timer.export_chrome_trace(os.path.join(cfg.profiling.trace_dir, f'{img_stem}.json'))
+        df_list.append(df_img)
+
+    # Assign edema classes to all images at once
+    df = edema_net.edema_classifier.classify(df=pd.concat(df_list))
 
     # Save metadata
-    metadata_path = os.path.join(cfg.save_dir, 'metadata.xlsx')
-    df.reset_index(drop=True, inplace=True)
-    df.index += 1
-    df.to_excel(
-        metadata_path,
-        sheet_name='Metadata',
-        index=True,
-        index_label='ID',
+    write_metadata(
+        df=df,
+        path=os.path.join(cfg.save_dir, METADATA_NAME),
+        export_excel=cfg.export_excel,
     )
 
     log.info('Complete')
@@ -2,39 +2,35 @@ import gc
 import logging
 import os
 from pathlib import Path
+from typing import List
 
 import cv2
 import hydra
+import numpy as np
+import pandas as pd
 import torch
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
+import src.data.utils_rle as utils_rle
+import src.data.utils_sly as utils_sly
 from src.data.utils import get_file_list
+from src.data.utils_manifest import MANIFEST_NAME, StageManifest, hash_file
+from src.data.utils_sly import METADATA_COLUMNS
+from src.fuse_maps import fuse_prob_maps, get_output_paths, save_metadata
 from src.models.lung_segmenter import LungSegmenter
+from src.models.map_fuser import MapFuser
+from src.models.mask_processor import MaskProcessor
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
-@hydra.main(
-    config_path=os.path.join(os.getcwd(), 'configs'),
-    config_name='segment_lungs',
-    version_base=None,
-)
-def main(cfg: DictConfig) -> None:
-    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
-
-    img_paths = get_file_list(
-        src_dirs=cfg.img_dir,
-        ext_list=[
-            '.png',
-            '.jpg',
-            '.jpeg',
-            '.bmp',
-        ],
-    )
-    log.info(f'Number of images..........: {len(img_paths)}')
-
+def segment_model_major(
+    img_paths: List[str],
+    cfg: DictConfig,
+) -> None:
+    """Run models one by one over all images and save their probability maps."""
     for model_name in cfg.model_names:
         log.info(f'Model in use: {model_name}')
         print(f'Model in use: {model_name}')
@@ -66,6 +62,137 @@ def main(cfg: DictConfig) -> None:
         gc.collect()
         torch.cuda.empty_cache()
 
+
+def segment_image_major(
+    img_paths: List[str],
+    cfg: DictConfig,
+) -> pd.DataFrame:
+    """Decode each image once, run the whole ensemble on it and fuse the maps in memory.
+
+    Only new or changed images are segmented if cfg.incremental is set, the metadata of the
+    others is taken from the stage manifest.
+
+    Args:
+        img_paths: list of images to segment
+        cfg: segmentation config
+    Returns:
+        metadata: lungs metadata of all images, the same as produced by fuse_maps.py
+    """
+    # Changing any of the models invalidates all images
+    model_dirs = [os.path.join(cfg.model_dirs, model_name) for model_name in cfg.model_names]
+    manifest = StageManifest(
+        manifest_path=os.path.join(cfg.fused_dir, MANIFEST_NAME),
+        config={
+            'model_names': list(cfg.model_names),
+            'weights': [
+                hash_file(os.path.join(model_dir, 'weights.pth')) for model_dir in model_dirs
+            ],
+            'save_maps': cfg.save_maps,
+        },
+        # modules are given by their classes, map_fuser and mask_processor name local objects
+        sources=[
+            __file__,
+            fuse_prob_maps,
+            MapFuser,
+            MaskProcessor,
+            LungSegmenter,
+            utils_rle,
+            utils_sly,
+        ],
+        enabled=cfg.incremental,
+    )
+    img_paths_ = {Path(img_path).name: img_path for img_path in img_paths}
+    manifest.remove_deleted_items(list(img_paths_))
+    stale_keys = manifest.get_stale_items(
+        inputs={img_name: [img_path] for img_name, img_path in img_paths_.items()},
+    )
+    log.info(f'{len(stale_keys)}/{len(img_paths_)} images are new or changed')
+    img_paths = [img_paths_[key] for key in stale_keys]
+
+    models = [
+        LungSegmenter(
+            model_dir=model_dir,
+            device='auto',
+        )
+        for model_dir in model_dirs
+    ]
+    map_fuser = MapFuser()
+    mask_processor = MaskProcessor()
+
+    batches = [
+        img_paths[idx : idx + cfg.batch_size] for idx in range(0, len(img_paths), cfg.batch_size)
+    ]
+    for batch_paths in tqdm(batches, desc='Lung segmentation', unit='batches'):
+        imgs = [cv2.imread(img_path) for img_path in batch_paths]
+
+        # Retrieve probability maps of all models in the original image resolution
+        prob_maps: List[List[np.ndarray]] = [[] for _ in imgs]
+        for model in models:
+            maps_ = model.predict_batch(
+                imgs=imgs,
+                scale_output=True,
+            )
+            for img_idx, (img_path, img, map_) in enumerate(zip(batch_paths, imgs, maps_)):
+                img_height, img_width = img.shape[:2]
+                map = cv2.resize(map_, (img_width, img_height), interpolation=cv2.INTER_LANCZOS4)
+                prob_maps[img_idx].append(map)
+
+                if cfg.save_maps:
+                    img_dir = os.path.join(cfg.save_dir, model.model_name)
+                    os.makedirs(img_dir, exist_ok=True)
+                    cv2.imwrite(os.path.join(img_dir, Path(img_path).name), map)
+
+        # Fuse maps and extract lungs without writing them to disk first
+        for img_path, img_maps in zip(batch_paths, prob_maps):
+            img_name = Path(img_path).name
+            lungs_info = fuse_prob_maps(
+                prob_maps=img_maps,
+                img_name=img_name,
+                save_dir=cfg.fused_dir,
+                map_fuser=map_fuser,
+                mask_processor=mask_processor,
+            )
+            outputs = get_output_paths(img_name=img_name, save_dir=cfg.fused_dir)
+            if cfg.save_maps:
+                outputs += [
+                    os.path.join(cfg.save_dir, model.model_name, img_name) for model in models
+                ]
+            manifest.update(key=img_name, records=[lungs_info], outputs=outputs)
+
+    manifest.save()
+    metadata = pd.DataFrame(manifest.get_records(), columns=METADATA_COLUMNS)
+
+    return metadata
+
+
+@hydra.main(
+    config_path=os.path.join(os.getcwd(), 'configs'),
+    config_name='segment_lungs',
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f'Config:\n\n{OmegaConf.to_yaml(cfg)}')
+
+    img_paths = get_file_list(
+        src_dirs=cfg.img_dir,
+        ext_list=[
+            '.png',
+            '.jpg',
+            '.jpeg',
+            '.bmp',
+        ],
+    )
+    log.info(f'Number of images..........: {len(img_paths)}')
+    log.info(f'Mode......................: {cfg.mode}')
+
+    if cfg.mode == 'model_major':
+        segment_model_major(img_paths=img_paths, cfg=cfg)
+    elif cfg.mode == 'image_major':
+        metadata = segment_image_major(img_paths=img_paths, cfg=cfg)
+        save_metadata(metadata=metadata, save_dir=cfg.fused_dir, export_excel=cfg.export_excel)
+    else:
+        raise ValueError(f'Unknown mode: {cfg.mode}')
+
     log.info('Complete')
 
 
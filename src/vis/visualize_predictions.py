@@ -8,79 +8,21 @@ import hydra
 import pandas as pd
 from omegaconf import DictConfig, OmegaConf
 
+from src.data.utils import load_conf_thresholds
+from src.data.utils_metadata import read_metadata
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
 def get_conf_thresholds(
     model_name: str,
+    thresholds_path: str = 'configs/conf_thresholds.yaml',
 ) -> dict:
-    if model_name == 'ATSS':
-        conf_thresholds = {
-            'Cephalization': 0.27,
-            'Kerley': 0.54,
-            'Effusion': 0.36,
-            'Bat': 0.21,
-            'Infiltrate': 0.48,
-        }
-    elif model_name == 'Cascade_RPN':
-        conf_thresholds = {
-            'Cephalization': 0.42,
-            'Kerley': 0.70,
-            'Effusion': 0.96,
-            'Bat': 0.50,
-            'Infiltrate': 0.75,
-        }
-    elif model_name == 'Faster_RCNN':
-        conf_thresholds = {
-            'Cephalization': 0.71,
-            'Kerley': 0.65,
-            'Effusion': 0.77,
-            'Bat': 0.62,
-            'Infiltrate': 0.99,
-        }
-    elif model_name == 'FSAF':
-        conf_thresholds = {
-            'Cephalization': 0.44,
-            'Kerley': 0.54,
-            'Effusion': 0.47,
-            'Bat': 0.45,
-            'Infiltrate': 0.39,
-        }
-    elif model_name == 'GFL':
-        conf_thresholds = {
-            'Cephalization': 0.32,
-            'Kerley': 0.60,
-            'Effusion': 0.51,
-            'Bat': 0.35,
-            'Infiltrate': 0.72,
-        }
-    elif model_name == 'PAA':
-        conf_thresholds = {
-            'Cephalization': 0.46,
-            'Kerley': 0.48,
-            'Effusion': 0.71,
-            'Bat': 0.56,
-            'Infiltrate': 0.71,
-        }
-    elif model_name == 'SABL':
-        conf_thresholds = {
-            'Cephalization': 0.37,
-            'Kerley': 0.53,
-            'Effusion': 0.77,
-            'Bat': 0.48,
-            'Infiltrate': 0.38,
-        }
-    elif model_name == 'TOOD':
-        conf_thresholds = {
-            'Cephalization': 0.25,
-            'Kerley': 0.41,
-            'Effusion': 0.36,
-            'Bat': 0.32,
-            'Infiltrate': 0.24,
-        }
-    else:
-        raise ValueError(f'Unknown model: {model_name}')
+    conf_thresholds = load_conf_thresholds(
+        thresholds_path=thresholds_path,
+        model_name=model_name,
+    )
 
     return conf_thresholds
 
@@ -92,8 +34,8 @@ def combine_data(
     include_features: List[str],
 ) -> Dict[str, Any]:
     # Read ground truth and predictions
-    df_gt = pd.read_excel(gt_path)
-    df_pred = pd.read_excel(pred_path)
+    df_gt = read_metadata(gt_path)
+    df_pred = read_metadata(pred_path)
     df_pred['Image name'] = df_pred.apply(
         func=lambda row: f'{Path(str(row["Image path"])).parts[-2]}.png',
         axis=1,
@@ -237,7 +179,10 @@ def main(cfg: DictConfig) -> None:
 
     # Get optimal thresholds
     model_name = Path(cfg.pred_path).parent.name
-    conf_thresholds = get_conf_thresholds(model_name)
+    conf_thresholds = get_conf_thresholds(
+        model_name=model_name,
+        thresholds_path=cfg.conf_thresholds_path,
+    )
 
     # Combine ground truth and predictions
     dets = combine_data(
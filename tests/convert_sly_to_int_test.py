@@ -1,4 +1,23 @@
-from src.data.utils_sly import get_box_sizes, get_class_name, get_object_box, get_tag_value
+import base64
+import json
+import os
+import zlib
+
+import cv2
+import numpy as np
+
+from src.data.utils_sly import (
+    convert_base64_to_mask,
+    convert_base64_to_rle,
+    decode_mask,
+    get_bitmap_size,
+    get_box_sizes,
+    get_class_name,
+    get_object_box,
+    get_tag_value,
+    load_json,
+    scan_sly_project,
+)
 
 ann_test_ok = {
     'description': '',
@@ -207,6 +226,44 @@ def test_get_object_box():
     assert get_object_box(object_test_rectangle) == {'x1': 485, 'y1': 915, 'x2': 1260, 'y2': 985}
 
 
+def test_get_bitmap_size():
+    encoded_mask = object_test_bitmap['bitmap']['data']
+    mask = convert_base64_to_mask(encoded_mask)
+    assert get_bitmap_size(encoded_mask) == mask.shape[:2]
+
+    # Non-PNG data falls back to the full decode
+    _, bmp_bytes = cv2.imencode('.bmp', np.zeros((5, 7), dtype=np.uint8))
+    encoded_bmp = base64.b64encode(zlib.compress(bmp_bytes.tobytes())).decode()
+    assert get_bitmap_size(encoded_bmp) == (5, 7)
+
+
+def test_convert_base64_to_rle():
+    encoded_mask = object_test_bitmap['bitmap']['data']
+    mask = convert_base64_to_mask(encoded_mask)
+    rle_string = convert_base64_to_rle(encoded_mask)
+    assert np.array_equal(decode_mask(rle_string), mask)
+    assert np.array_equal(decode_mask(encoded_mask), mask)
+
+
+def test_scan_sly_project(tmp_path):
+    (tmp_path / 'meta.json').write_text('{}')
+    for subset in ['DS2', 'DS1']:
+        (tmp_path / subset / 'img').mkdir(parents=True)
+        (tmp_path / subset / 'ann').mkdir()
+        for item_name in ['b.png', 'a.png']:
+            (tmp_path / subset / 'img' / item_name).write_bytes(b'image')
+            (tmp_path / subset / 'ann' / f'{item_name}.json').write_text(json.dumps(ann_test_ok))
+    # An annotation without an image is skipped
+    (tmp_path / 'DS1' / 'ann' / 'c.png.json').write_text('{}')
+
+    records = scan_sly_project(str(tmp_path), exclude_dirs=['DS2'], num_threads=1)
+    assert [(os.path.basename(img_path), subset) for img_path, _, subset in records] == [
+        ('a.png', 'DS1'),
+        ('b.png', 'DS1'),
+    ]
+    assert load_json(records[0][1]) == ann_test_ok
+
+
 def test_get_box_sizes():
     assert get_box_sizes(0, 0, 0, 0) == {'xc': 0, 'yc': 0, 'Box width': 0, 'Box height': 0}
     assert get_box_sizes(0, 0, 1, 1) == {'xc': 0, 'yc': 0, 'Box width': 1, 'Box height': 1}
@@ -0,0 +1,107 @@
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip('torch')
+
+from src.data.data_classes_utils import (  # noqa: E402
+    create_resized_masks,
+    pack_masks,
+    resize_and_create_masks,
+    split_dataset,
+    unpack_mask_tensor,
+    unpack_masks,
+)
+
+
+def _make_annotations():
+    annotations = {
+        'Effusion': defaultdict(list),
+        'Kerley': defaultdict(list),
+    }
+    annotations['Effusion']['polygons'].append(
+        np.array([[10, 12], [90, 20], [70, 80], [15, 60]], dtype=np.int32),
+    )
+    annotations['Kerley']['polygons'].append(np.array([[5, 5], [100, 90]], dtype=np.int32))
+    return annotations
+
+
+@pytest.mark.parametrize('image_size', [(120, 100), (100, 120), (64, 64)])
+def test_create_resized_masks(image_size):
+    target_size = (48, 32)
+    image = Image.new('RGB', image_size)
+    _, masks_expected, findings_expected = resize_and_create_masks(
+        image,
+        _make_annotations(),
+        target_size,
+    )
+    masks, findings = create_resized_masks(image_size, _make_annotations(), target_size)
+
+    assert masks.dtype == np.uint8
+    assert masks.shape == (len(masks_expected), target_size[1], target_size[0])
+    np.testing.assert_array_equal(masks, np.stack(masks_expected).astype(np.uint8))
+    np.testing.assert_array_equal(findings, findings_expected.numpy().astype(np.uint8))
+
+
+@pytest.mark.parametrize('mask_size', [(8, 4), (7, 5)])
+def test_pack_masks_round_trip(mask_size):
+    width, height = mask_size
+    masks = np.random.default_rng(0).integers(0, 2, (2, 3, height, width), dtype=np.uint8)
+    packed_masks = pack_masks(masks)
+    assert packed_masks.shape == (2, 3, (height * width + 7) // 8)
+
+    np.testing.assert_array_equal(unpack_masks(packed_masks, mask_size), masks)
+    masks_tensor = unpack_mask_tensor(torch.from_numpy(packed_masks), mask_size)
+    assert masks_tensor.dtype == torch.uint8
+    np.testing.assert_array_equal(masks_tensor.numpy(), masks)
+
+
+def _make_split_metadata(num_subjects=20):
+    rng = np.random.default_rng(1)
+    rows = []
+    for subject_id in range(num_subjects):
+        class_id = subject_id % 4
+        for study_idx in range(1 + subject_id % 3):
+            img_path = f'img/{subject_id}_{study_idx}.png'
+            for _ in range(rng.integers(1, 4)):
+                rows.append(
+                    {'Image path': img_path, 'Subject ID': subject_id, 'Class ID': class_id},
+                )
+    return pd.DataFrame(rows)
+
+
+def _split(metadata_df, **kwargs):
+    dataset = list(range(metadata_df['Image path'].nunique()))
+    train_subset, test_subset = split_dataset(dataset, 0.8, metadata_df, **kwargs)
+    return list(train_subset.indices), list(test_subset.indices)
+
+
+def test_split_dataset():
+    metadata_df = _make_split_metadata()
+    train_indices, test_indices = _split(metadata_df, n_split_trials=300, seed=3)
+
+    # every image is in one subset and no subject is in both
+    img_paths = metadata_df['Image path'].unique()
+    assert sorted(train_indices + test_indices) == list(range(img_paths.size))
+    img_subjects = metadata_df.groupby('Image path', sort=False)['Subject ID'].first()
+    train_subjects = set(img_subjects[img_paths[train_indices]])
+    test_subjects = set(img_subjects[img_paths[test_indices]])
+    assert train_subjects and test_subjects
+    assert not train_subjects & test_subjects
+
+    # the split depends only on the seed and the number of trials
+    for trials_per_batch in [1, 7, 1000]:
+        split = _split(metadata_df, n_split_trials=300, seed=3, trials_per_batch=trials_per_batch)
+        assert split == (train_indices, test_indices)
+
+
+def test_split_dataset_without_valid_trials():
+    # class 4 belongs to a single subject, so it cannot be in both subsets
+    metadata_df = _make_split_metadata()
+    metadata_df.loc[metadata_df['Subject ID'] == 0, 'Class ID'] = 4
+    with pytest.raises(RuntimeError):
+        _split(metadata_df, n_split_trials=50)
+    _split(metadata_df, n_split_trials=50, ensure_all_classes_in_splits=False)
@@ -0,0 +1,44 @@
+import pandas as pd
+
+from src.data.utils_metadata import read_metadata, write_metadata
+from src.evaluate_model import evaluate
+
+df_gt = pd.DataFrame(
+    {
+        'Image path': ['img/10000032_1.png', 'img/10000032_2.png'],
+        'Image name': ['10000032_1.png', '10000032_2.png'],
+        'Subject ID': [10000032, 10000032],
+        'Feature': ['Effusion', 'Effusion'],
+        'x1': [10, 200],
+        'y1': [10, 200],
+        'x2': [60, 260],
+        'y2': [60, 260],
+    },
+)
+
+
+def _evaluate(tmp_path, df_pred):
+    write_metadata(df_gt, str(tmp_path / 'gt.parquet'))
+    write_metadata(df_pred, str(tmp_path / 'pred.parquet'))
+    result = evaluate(
+        confidence_threshold=0.0,
+        df_gt=read_metadata(str(tmp_path / 'gt.parquet')),
+        df_pred=read_metadata(str(tmp_path / 'pred.parquet')),
+    )
+    return result['metrics'][0]
+
+
+def test_evaluate_matches_images(tmp_path):
+    df_pred = df_gt.assign(Confidence=[0.9, 0.8])
+    metrics = _evaluate(tmp_path, df_pred)
+    assert metrics['total TP'] == 2
+    assert metrics['AP'] == 1.0
+
+
+def test_evaluate_does_not_match_images_of_one_subject(tmp_path):
+    # Boxes of the two images of a subject are swapped
+    df_pred = df_gt.assign(
+        **{'Image name': df_gt['Image name'][::-1].tolist(), 'Confidence': [0.9, 0.8]},
+    )
+    metrics = _evaluate(tmp_path, df_pred)
+    assert metrics['total TP'] == 0
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from src.optimize_thresholds import (
+    compute_iou_matrix,
+    compute_threshold_curve,
+    find_optimal_threshold,
+    match_detections,
+)
+
+df_gt = pd.DataFrame(
+    {
+        'Image name': ['1.png', '1.png', '2.png'],
+        'Feature': ['Bat', 'Bat', 'Bat'],
+        'x1': [0, 100, 0],
+        'y1': [0, 100, 0],
+        'x2': [49, 149, 49],
+        'y2': [49, 149, 49],
+    },
+)
+
+df_pred = pd.DataFrame(
+    {
+        'Image name': ['1.png', '1.png', '1.png', '2.png', '2.png'],
+        'Feature': ['Bat', 'Bat', 'Bat', 'Bat', 'Bat'],
+        'x1': [0, 1, 300, 0, 100],
+        'y1': [0, 1, 300, 0, 100],
+        'x2': [49, 49, 349, 49, 149],
+        'y2': [49, 49, 349, 49, 149],
+        'Confidence': [0.9, 0.8, 0.7, 0.6, 0.5],
+    },
+)
+
+
+def test_compute_iou_matrix():
+    boxes = np.array([[0, 0, 9, 9], [10, 10, 19, 19]])
+    iou = compute_iou_matrix(boxes, boxes)
+    assert np.allclose(iou, np.eye(2))
+
+
+def test_match_detections():
+    scores, is_tp, num_positives = match_detections(df_gt, df_pred, iou_threshold=0.5)
+    assert num_positives == 3
+    assert scores.tolist() == [0.9, 0.8, 0.7, 0.6, 0.5]
+    # The second box on 1.png duplicates an already matched ground truth box
+    assert is_tp.tolist() == [1, 0, 0, 1, 0]
+
+
+def test_find_optimal_threshold():
+    scores, is_tp, num_positives = match_detections(df_gt, df_pred, iou_threshold=0.5)
+    df_curve = compute_threshold_curve(scores, is_tp, num_positives)
+    assert find_optimal_threshold(df_curve, objective='f1')['Confidence'] == 0.6
+    assert find_optimal_threshold(df_curve, objective='f2')['Confidence'] == 0.6
+    row = find_optimal_threshold(df_curve, objective='recall_at_precision', min_precision=0.9)
+    assert row['Confidence'] == 0.9
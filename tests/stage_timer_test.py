@@ -0,0 +1,28 @@
+import json
+
+from src.models.stage_timer import NULL_TIMER, StageTimer
+
+
+def test_stage_timer(tmp_path):
+    timer = StageTimer()
+    with timer.span('total'):
+        for _ in range(3):
+            with timer.span('write'):
+                pass
+
+    assert set(timer.durations) == {'total', 'write'}
+    assert timer.durations['total'] >= timer.durations['write']
+    assert len(timer.events) == 4
+    assert set(timer.get_metadata()) == {'Time total, ms', 'Time write, ms'}
+
+    trace_path = tmp_path / 'trace.json'
+    timer.export_chrome_trace(str(trace_path))
+    with open(trace_path) as file:
+        trace = json.load(file)
+    assert [event['name'] for event in trace['traceEvents']] == ['write'] * 3 + ['total']
+
+
+def test_null_timer():
+    with NULL_TIMER.span('total'):
+        pass
+    assert NULL_TIMER.durations == {} and NULL_TIMER.events == []
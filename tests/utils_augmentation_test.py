@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from src.data.utils_augmentation import BatchAugmentation  # noqa: E402
+
+
+def _make_batch():
+    images = torch.rand(2, 3, 16, 16)
+    masks = torch.stack(
+        [
+            torch.zeros(4, 16, 16, dtype=torch.uint8),
+            torch.ones(4, 16, 16, dtype=torch.uint8),
+        ],
+    )
+    return images, masks
+
+
+def test_identity_augmentation():
+    augmentation = BatchAugmentation(
+        brightness_contrast_p=0,
+        gamma_p=0,
+        blur_p=0,
+        affine_p=0,
+    )
+    images, masks = _make_batch()
+    images_augmented, masks_augmented = augmentation(images, masks, torch.tensor([1, 0]))
+    assert torch.equal(images_augmented, images)
+    assert torch.equal(masks_augmented, masks)
+
+
+def test_affine_mask_fill():
+    # every transform takes the lower limit, so the batch is only scaled down twice
+    augmentation = BatchAugmentation(
+        brightness_limit=0,
+        contrast_limit=0,
+        gamma_limit=(100, 100),
+        blur_sigma_limit=(0, 0),
+        rotate_limit=0,
+        scale_limit=0.5,
+        shift_limit=0,
+    )
+    augmentation._sample = lambda images, limits, p, identity: torch.full(
+        (len(images),),
+        float(limits[0]),
+    )
+    images, masks = _make_batch()
+    mask_fill = torch.tensor([True, False])
+    _, masks_augmented = augmentation(images, masks, mask_fill=mask_fill)
+
+    assert masks_augmented.dtype == masks.dtype
+    # the corners are outside of the image and get the fill of their image, the center is kept
+    corner_fill = mask_fill.to(torch.uint8).view(-1, 1).expand(-1, 4)
+    assert torch.equal(masks_augmented[:, :, 0, 0], corner_fill)
+    assert torch.equal(masks_augmented[:, :, 8, 8], masks[:, :, 8, 8])
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('torch')
+
+from src.data.utils_cache import DatasetCache, build_dataset_cache, get_cache_dir  # noqa: E402
+
+TARGET_SIZE = (32, 32)
+
+
+def _make_metadata(tmp_path):
+    img_paths = []
+    for idx in range(2):
+        img_path = str(tmp_path / f'10000032_{idx}.png')
+        cv2.imwrite(img_path, np.full((40, 50, 3), 100 * idx, dtype=np.uint8))
+        img_paths.append(img_path)
+    return pd.DataFrame(
+        {
+            'Image path': img_paths,
+            'Class': ['Interstitial edema'] * 2,
+            'Class ID': pd.array([2, 2], dtype='Int64'),
+            'Feature': ['Effusion', 'Kerley'],
+            'x1': [np.nan, np.nan],
+            'y1': [np.nan, np.nan],
+            'Mask': [np.nan, np.nan],
+            'Points': [
+                np.array([[2, 2], [40, 5], [30, 30]], dtype=np.int32),
+                np.array([[5, 5], [45, 35]], dtype=np.int32),
+            ],
+        },
+    )
+
+
+def test_dataset_cache(tmp_path):
+    metadata_df = _make_metadata(tmp_path)
+    cache_root = str(tmp_path / 'cache')
+    build_dataset_cache(
+        metadata_df=metadata_df,
+        cache_dir=get_cache_dir(cache_root, TARGET_SIZE),
+        target_size=TARGET_SIZE,
+        num_workers=1,
+    )
+
+    cache = DatasetCache.from_dir(cache_root, TARGET_SIZE, metadata_df=metadata_df)
+    assert cache is not None
+    image = cache.get_image(metadata_df.at[1, 'Image path'])
+    assert image.shape == (TARGET_SIZE[1], TARGET_SIZE[0], 3)
+    masks, _ = cache.get_masks(metadata_df.at[1, 'Image path'])
+    assert masks.shape[1:] == (TARGET_SIZE[1], TARGET_SIZE[0])
+
+    # A cache built from other annotations or settings is ignored
+    metadata_df_changed = metadata_df.copy()
+    metadata_df_changed.at[1, 'Points'] = np.array([[5, 5], [45, 30]], dtype=np.int32)
+    assert DatasetCache.from_dir(cache_root, TARGET_SIZE, metadata_df=metadata_df_changed) is None
+    assert (
+        DatasetCache.from_dir(
+            cache_root,
+            TARGET_SIZE,
+            metadata_df=metadata_df,
+            linelike_finding_width=5,
+        )
+        is None
+    )
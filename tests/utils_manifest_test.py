@@ -0,0 +1,69 @@
+import os
+
+from src.data.utils_manifest import StageManifest
+
+
+def _write(path, content):
+    with open(path, 'w') as file:
+        file.write(content)
+
+
+def _run_stage(tmp_path, inputs, config=None, sources=None):
+    manifest = StageManifest(
+        str(tmp_path / 'out' / 'manifest.json'),
+        config=config,
+        sources=sources,
+    )
+    manifest.remove_deleted_items(list(inputs))
+    stale_keys = manifest.get_stale_items(inputs=inputs)
+    for key in stale_keys:
+        output_path = str(tmp_path / 'out' / os.path.basename(key))
+        _write(output_path, key)
+        manifest.update(key, records=[{'name': os.path.basename(key)}], outputs=[output_path])
+    manifest.save()
+    return stale_keys, manifest.get_records()
+
+
+def test_stage_manifest(tmp_path):
+    os.makedirs(tmp_path / 'out')
+    paths = [str(tmp_path / f'{name}.png') for name in 'abc']
+    for path in paths:
+        _write(path, path)
+    inputs = {path: [path] for path in paths}
+
+    stale_keys, records = _run_stage(tmp_path, inputs)
+    assert stale_keys == paths
+    assert [record['name'] for record in records] == ['a.png', 'b.png', 'c.png']
+
+    # Nothing changed, a touched file with the same content is not reprocessed
+    os.utime(paths[0], ns=(0, 0))
+    stale_keys, _ = _run_stage(tmp_path, inputs)
+    assert stale_keys == []
+
+    # A changed input and a missing output are reprocessed
+    _write(paths[1], 'changed')
+    os.remove(tmp_path / 'out' / 'c.png')
+    stale_keys, _ = _run_stage(tmp_path, inputs)
+    assert stale_keys == paths[1:]
+
+    # Outputs of a deleted input are removed
+    del inputs[paths[2]]
+    stale_keys, records = _run_stage(tmp_path, inputs)
+    assert stale_keys == []
+    assert len(records) == 2
+    assert not os.path.exists(tmp_path / 'out' / 'c.png')
+
+    # A changed config invalidates all items and removes their outputs
+    manifest = StageManifest(str(tmp_path / 'out' / 'manifest.json'), config={'size': 1536})
+    assert os.listdir(tmp_path / 'out') == ['manifest.json']
+    assert manifest.get_stale_items(inputs=inputs) == paths[:2]
+
+    # A changed source of the stage invalidates all items
+    source_path = str(tmp_path / 'stage.py')
+    _write(source_path, 'SIZE = 1536')
+    _run_stage(tmp_path, inputs, sources=[source_path])
+    stale_keys, _ = _run_stage(tmp_path, inputs, sources=[source_path])
+    assert stale_keys == []
+    _write(source_path, 'SIZE = 2048')
+    stale_keys, _ = _run_stage(tmp_path, inputs, sources=[source_path])
+    assert stale_keys == paths[:2]
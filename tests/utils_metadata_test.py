@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from src.data.utils_metadata import PointStore, read_metadata, write_metadata
+
+df = pd.DataFrame(
+    {
+        'Image path': ['data/interim/img/10000032_50414267.png'] * 3,
+        'Subject ID': ['10000032', '10000032', '10000032'],
+        'Feature': ['Kerley', np.nan, 'Effusion'],
+        'x1': [10, 12.5, 12],
+        'Points': [[[237, 1018], [298, 1009]], np.nan, [12, 7]],
+        'RP': ['3', np.nan, '4'],
+        'Class ID': [2.0, np.nan, 2.0],
+    },
+)
+
+
+def test_metadata_round_trip(tmp_path):
+    save_path = str(tmp_path / 'metadata.parquet')
+    write_metadata(df, save_path, export_excel=True)
+
+    df_parquet = read_metadata(save_path)
+    df_excel = read_metadata(str(tmp_path / 'metadata.xlsx'))
+    pd.testing.assert_frame_equal(df_parquet, df_excel)
+
+    assert df_parquet['Subject ID'].dtype == 'Int64'
+    assert df_parquet['x1'].tolist() == [10.0, 12.5, 12.0]
+    assert df_parquet.at[0, 'RP'] == '3'
+    assert df_parquet['Class ID'].isna().tolist() == [False, True, False]
+
+
+def test_points_are_typed(tmp_path):
+    save_path = str(tmp_path / 'metadata.parquet')
+    write_metadata(df, save_path)
+
+    points = read_metadata(save_path)['Points']
+    assert points.at[0].dtype == np.int32
+    np.testing.assert_array_equal(points.at[0], [[237, 1018], [298, 1009]])
+    assert np.isnan(points.at[1])
+    np.testing.assert_array_equal(points.at[2], [[12, 7]])
+
+    store = PointStore.from_parquet(save_path)
+    assert len(store) == 3
+    assert store[0].shape == (2, 2)
+    assert store[0].base is not None
+    assert store[1] is None
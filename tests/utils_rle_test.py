@@ -0,0 +1,47 @@
+import numpy as np
+
+from src.data.utils_rle import (
+    compress_counts,
+    decode_rle,
+    decompress_counts,
+    encode_rle,
+    get_rle_area,
+    get_rle_bbox,
+    rle_from_string,
+    rle_to_string,
+)
+
+
+def test_encode_rle():
+    # Runs are counted in column-major order starting with zeros, as in pycocotools
+    rle = encode_rle(np.array([[0, 1], [1, 1]], dtype=np.uint8))
+    assert rle['size'] == [2, 2]
+    assert list(rle['counts']) == [1, 3]
+    assert compress_counts(rle['counts']) == '13'
+
+    rle = encode_rle(np.ones((3, 2), dtype=np.uint8))
+    assert list(rle['counts']) == [0, 6]
+
+
+def test_rle_string():
+    rng = np.random.default_rng(0)
+    for mask in [
+        rng.random((37, 53)) < 0.3,
+        np.zeros((5, 7), dtype=np.uint8),
+        np.pad(np.full((10, 4), 255, dtype=np.uint8), ((3, 8), (20, 2))),
+    ]:
+        rle = rle_from_string(rle_to_string(encode_rle(mask)))
+        assert np.array_equal(decode_rle(rle), mask != 0)
+        assert get_rle_area(rle) == np.count_nonzero(mask)
+
+    # A run spanning columns covers their whole height
+    assert get_rle_bbox(rle) == [20, 3, 4, 10]
+    mask = np.zeros((6, 6), dtype=np.uint8)
+    mask[4:, 1] = mask[:2, 2] = 1
+    assert get_rle_bbox(encode_rle(mask)) == [1, 0, 2, 6]
+
+
+def test_compress_counts():
+    # Differences with the values two positions before can be negative
+    counts = np.array([5, 10**9, 3, 7, 10**9 + 5, 2, 0, 1])
+    assert np.array_equal(decompress_counts(compress_counts(counts)), counts)
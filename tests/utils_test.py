@@ -0,0 +1,72 @@
+import os
+import struct
+
+import cv2
+import numpy as np
+import pytest
+
+from src.data.utils import materialize_file, probe_image_size
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'symlink', 'copy'])
+def test_materialize_file(tmp_path, mode):
+    src_path = str(tmp_path / 'src.png')
+    dst_path = str(tmp_path / 'dst.png')
+    with open(src_path, 'wb') as file:
+        file.write(b'image')
+
+    assert materialize_file(src_path, dst_path, mode) == mode
+    assert materialize_file(src_path, dst_path, mode) == 'skip'
+    with open(dst_path, 'rb') as file:
+        assert file.read() == b'image'
+
+    # A stale destination is replaced rather than written through, a symlink follows the new file
+    os.remove(src_path)
+    with open(src_path, 'wb') as file:
+        file.write(b'new image')
+    assert materialize_file(src_path, dst_path, mode) == ('skip' if mode == 'symlink' else mode)
+    with open(dst_path, 'rb') as file:
+        assert file.read() == b'new image'
+
+
+def test_materialize_file_fallback(tmp_path, monkeypatch):
+    def link(*args):
+        raise OSError('Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', link)
+    src_path = str(tmp_path / 'src.png')
+    with open(src_path, 'wb') as file:
+        file.write(b'image')
+
+    mode_used = materialize_file(src_path, str(tmp_path / 'dst.png'), 'hardlink')
+    assert mode_used in {'reflink', 'copy'}
+
+
+@pytest.mark.parametrize('ext', ['.png', '.jpg', '.bmp', '.tiff'])
+def test_probe_image_size(tmp_path, ext):
+    img_path = str(tmp_path / f'img{ext}')
+    cv2.imwrite(img_path, np.zeros((37, 53, 3), dtype=np.uint8), [cv2.IMWRITE_JPEG_PROGRESSIVE, 1])
+    assert probe_image_size(img_path) == (37, 53)
+
+    # A rewritten image is probed again
+    cv2.imwrite(img_path, np.zeros((64, 48), dtype=np.uint8))
+    os.utime(img_path, ns=(0, 0))
+    assert probe_image_size(img_path) == (64, 48)
+
+
+@pytest.mark.parametrize('byte_order', ['<', '>'])
+@pytest.mark.parametrize('orientation', [1, 3, 6, 8])
+def test_probe_image_size_exif(tmp_path, byte_order, orientation):
+    # A JPEG image with an EXIF orientation, cv2.imread applies it
+    tiff = (b'II' if byte_order == '<' else b'MM') + struct.pack(byte_order + 'HI', 42, 8)
+    tiff += struct.pack(byte_order + 'HHHIHHI', 1, 0x0112, 3, 1, orientation, 0, 0)
+    exif = b'Exif\x00\x00' + tiff
+    _, jpeg_bytes = cv2.imencode('.jpg', np.zeros((37, 53, 3), dtype=np.uint8))
+    jpeg_bytes = jpeg_bytes.tobytes()
+    img_path = str(tmp_path / 'img.jpg')
+    with open(img_path, 'wb') as file:
+        file.write(jpeg_bytes[:2] + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif)
+        file.write(jpeg_bytes[2:])
+
+    assert probe_image_size(img_path) == cv2.imread(img_path).shape[:2]
+    assert probe_image_size(img_path) == ((53, 37) if orientation >= 5 else (37, 53))